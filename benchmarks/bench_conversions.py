@@ -0,0 +1,46 @@
+"""Benchmarks of the projection of FITS chips to the HPX grid"""
+from spheredb.conversions import FITS_to_HPX, FITS_to_HPX_mosaic
+from spheredb.resampling import ResamplingPlanCache
+
+from .synthetic import CASES, random_chip
+
+
+class FITSToHPX:
+    params = (sorted(CASES), [256, 1024], [2 ** 15, 2 ** 16])
+    param_names = ['case', 'size', 'Nside']
+
+    def setup(self, case, size, Nside):
+        self.header, self.data = random_chip(case, size, size)
+        self.plans = ResamplingPlanCache()
+        FITS_to_HPX(self.header, self.data, Nside, plans=self.plans)
+
+    def time_FITS_to_HPX(self, case, size, Nside):
+        FITS_to_HPX(self.header, self.data, Nside)
+
+    def peakmem_FITS_to_HPX(self, case, size, Nside):
+        FITS_to_HPX(self.header, self.data, Nside)
+
+    def time_FITS_to_HPX_approx_wcs(self, case, size, Nside):
+        FITS_to_HPX(self.header, self.data, Nside, wcs_tol=1E-3)
+
+    def time_FITS_to_HPX_cached_plan(self, case, size, Nside):
+        FITS_to_HPX(self.header, self.data, Nside, plans=self.plans)
+
+    def track_n_pixels(self, case, size, Nside):
+        return len(FITS_to_HPX(self.header, self.data, Nside,
+                               plans=self.plans))
+
+
+class Mosaic:
+    params = ([4, 16], [1, 4])
+    param_names = ['n_chips', 'n_threads']
+
+    def setup(self, n_chips, n_threads):
+        self.chips = [random_chip('equator', 256, 256, rseed=i)
+                      for i in range(n_chips)]
+
+    def time_mosaic(self, n_chips, n_threads):
+        FITS_to_HPX_mosaic(self.chips, 2 ** 15, n_threads=n_threads)
+
+    def peakmem_mosaic(self, n_chips, n_threads):
+        FITS_to_HPX_mosaic(self.chips, 2 ** 15, n_threads=n_threads)
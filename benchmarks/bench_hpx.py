@@ -0,0 +1,89 @@
+"""Benchmarks of the low-level HPX and interpolation routines"""
+import numpy as np
+
+from spheredb.hpx_utils import (RAdec_to_HPX, HPX_to_RAdec,
+                                HPX_grid_to_RAdec)
+from spheredb.util import regrid, reduce_duplicates
+
+
+class HPXTransforms:
+    params = [10 ** 4, 10 ** 6]
+    param_names = ['n_points']
+
+    def setup(self, n):
+        rng = np.random.RandomState(0)
+        self.RA = 360 * rng.rand(n)
+        self.dec = np.degrees(np.arcsin(2 * rng.rand(n) - 1))
+        self.x, self.y = RAdec_to_HPX(self.RA, self.dec)
+
+    def time_RAdec_to_HPX(self, n):
+        RAdec_to_HPX(self.RA, self.dec)
+
+    def time_HPX_to_RAdec(self, n):
+        HPX_to_RAdec(self.x, self.y)
+
+    def peakmem_RAdec_to_HPX(self, n):
+        RAdec_to_HPX(self.RA, self.dec)
+
+
+class HPXGridTables:
+    params = [10 ** 4, 10 ** 6]
+    param_names = ['n_points']
+    Nside = 2 ** 12
+
+    def setup(self, n):
+        rng = np.random.RandomState(0)
+        self.i = rng.randint(0, 8 * self.Nside, n)
+        self.j = rng.randint(0, 4 * self.Nside + 1, n)
+        self.x = self.i * 45. / self.Nside - 180.
+        self.y = self.j * 45. / self.Nside - 90.
+        # build the memoized tables outside of the timing
+        HPX_grid_to_RAdec(0, 0, self.Nside)
+
+    def time_grid_to_RAdec_tables(self, n):
+        HPX_grid_to_RAdec(self.i, self.j, self.Nside)
+
+    def time_grid_to_RAdec_direct(self, n):
+        HPX_to_RAdec(self.x, self.y)
+
+
+class GridInterpolation:
+    params = [256, 1024]
+    param_names = ['size']
+
+    def setup(self, size):
+        # grid_interpolation imports matplotlib
+        from spheredb.grid_interpolation import GridInterpolation
+        rng = np.random.RandomState(0)
+        self.interp = GridInterpolation(rng.rand(size, size), [0, 0], [1, 1])
+        self.X = (size - 1) * rng.rand(size * size, 2)
+
+    def time_interpolate(self, size):
+        self.interp(self.X)
+
+    def peakmem_interpolate(self, size):
+        self.interp(self.X)
+
+
+class Regrid:
+    params = ([512, 2048], [2, 16])
+    param_names = ['size', 'factor']
+
+    def setup(self, size, factor):
+        self.X = np.random.RandomState(0).rand(size, size)
+
+    def time_regrid(self, size, factor):
+        regrid(self.X, factor)
+
+
+class ReduceDuplicates:
+    params = (['sum', 'mean', 'last'],)
+    param_names = ['reduction']
+
+    def setup(self, reduction):
+        rng = np.random.RandomState(0)
+        self.index = rng.randint(0, 10 ** 5, 10 ** 6)
+        self.values = rng.rand(10 ** 6)
+
+    def time_reduce_duplicates(self, reduction):
+        reduce_duplicates(self.index, self.values, reduction)
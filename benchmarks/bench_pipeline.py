@@ -0,0 +1,64 @@
+"""End-to-end benchmarks: ingest of several epochs, then queries
+
+The storage backend is the local record-array backend of
+:mod:`spheredb.query`, which stands in for SciDB.
+"""
+import numpy as np
+
+from spheredb.conversions import FITS_to_HPX, HPX_grid_size
+from spheredb.query import LazyArray
+from spheredb.resampling import ResamplingPlanCache
+
+from .synthetic import random_chip
+
+NSIDE = 2 ** 15
+
+
+def ingest(chips, plans=None):
+    """Project all chips and stack them into one record array"""
+    return np.concatenate([FITS_to_HPX(header, data, NSIDE, plans=plans)
+                           for (header, data) in chips])
+
+
+class Pipeline:
+    params = ([4, 16],)
+    param_names = ['n_epochs']
+    timeout = 300
+
+    def setup(self, n_epochs):
+        # the same pointing, observed at n_epochs times
+        header, data = random_chip('equator', 512, 512)
+        self.chips = []
+        for i in range(n_epochs):
+            header = dict(header, TAI=50000. + i)
+            self.chips.append((header, data + i))
+
+        self.records = ingest(self.chips)
+        times = np.unique(self.records['time'])
+        self.records['time'] = np.searchsorted(times, self.records['time'])
+        Nx, Ny = HPX_grid_size(NSIDE)
+        self.pixels = LazyArray.from_records(self.records,
+                                             (Nx, Ny, n_epochs))
+        self.x0, self.y0 = self.records['x'].min(), self.records['y'].min()
+
+    def time_ingest(self, n_epochs):
+        ingest(self.chips)
+
+    def time_ingest_cached_plans(self, n_epochs):
+        ingest(self.chips, ResamplingPlanCache())
+
+    def peakmem_ingest(self, n_epochs):
+        ingest(self.chips)
+
+    def time_coadd(self, n_epochs):
+        self.pixels.sum('time').subarray((self.x0, self.x0 + 256),
+                                         (self.y0, self.y0 + 256)).toarray()
+
+    def time_time_slice_regrid(self, n_epochs):
+        self.pixels.slice('time', 0).subarray(
+            (self.x0, self.x0 + 256), (self.y0, self.y0 + 256)).regrid(
+                4).toarray()
+
+    def peakmem_coadd(self, n_epochs):
+        self.pixels.sum('time').subarray((self.x0, self.x0 + 256),
+                                         (self.y0, self.y0 + 256)).toarray()
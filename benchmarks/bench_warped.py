@@ -0,0 +1,36 @@
+"""Benchmarks of reading pre-warped HPX FITS files"""
+import os
+import shutil
+import tempfile
+
+from spheredb.sdb_from_warped import sdb_from_warped, sdb_from_warped_files
+
+from .synthetic import write_warped
+
+SIZES = [512, 2048]
+
+
+class SdbFromWarped:
+    params = (SIZES, [None, 256])
+    param_names = ['size', 'strip_rows']
+    timeout = 120
+
+    def setup_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        files = {}
+        for size in SIZES:
+            files[size] = [write_warped(os.path.join(tmpdir, '{0}_{1}.fits'
+                                                     ''.format(size, i)),
+                                        (size, size), rseed=i)
+                           for i in range(4)]
+        return files
+
+    def time_sdb_from_warped(self, files, size, strip_rows):
+        sdb_from_warped(files[size][0], strip_rows=strip_rows)
+
+    def peakmem_sdb_from_warped(self, files, size, strip_rows):
+        sdb_from_warped(files[size][0], strip_rows=strip_rows)
+
+    def time_sdb_from_warped_files(self, files, size, strip_rows):
+        sdb_from_warped_files(files[size], processes=1,
+                              strip_rows=strip_rows)
@@ -0,0 +1,66 @@
+"""
+Synthetic inputs for the benchmarks
+
+Chips are small TAN images with a random (but seeded) pointing near one of
+a few reference positions, including the cases which are hard for the HPX
+projection: chips across the RA wrap and polar facet seams, and on a pole.
+"""
+import numpy as np
+
+from spheredb.testing import chip_header
+
+# name: (RA, dec) of the chip center
+CASES = {'equator': (30., 10.),
+         'seam': (180., 5.),
+         'polar': (0., 70.),
+         'pole': (0., 89.9)}
+
+
+def chip_data(Nx, Ny, rseed=0):
+    """A smooth random image with a few point sources and noise"""
+    rng = np.random.RandomState(rseed)
+    y, x = np.mgrid[:Ny, :Nx]
+    img = rng.normal(100, 5, (Ny, Nx))
+    for i in range(10):
+        x0, y0 = rng.rand(2) * (Nx, Ny)
+        img += 1000 * rng.rand() * np.exp(-0.5 * ((x - x0) ** 2
+                                                  + (y - y0) ** 2) / 4.)
+    return img
+
+
+def random_chip(case, Nx, Ny, rseed=0, scale=None, mjd=50000.):
+    """Return (header, data) of a chip with a random offset and rotation"""
+    rng = np.random.RandomState(rseed)
+    RA, dec = CASES[case]
+    if scale is None:
+        scale = 1. / 3600
+    offset = 0.1 * scale * max(Nx, Ny) * (rng.rand(2) - 0.5)
+    header = chip_header((RA + offset[0]) % 360,
+                         np.clip(dec + offset[1], -89.99, 89.99),
+                         Nx, Ny, scale, rotation=360 * rng.rand(), mjd=mjd)
+    return header, chip_data(Nx, Ny, rseed)
+
+
+def write_warped(path, shape, cdelt=1. / 3600, rseed=0, fill=0.3):
+    """Write an HPX image, with NaN outside the footprint, to a FITS file"""
+    from astropy.io import fits
+
+    rng = np.random.RandomState(rseed)
+    img = rng.rand(*shape)
+    img[rng.rand(*shape) < fill] = np.nan
+
+    header = fits.Header()
+    header['CTYPE1'] = 'RA---HPX'
+    header['CTYPE2'] = 'DEC--HPX'
+    header['CUNIT1'] = 'deg'
+    header['CUNIT2'] = 'deg'
+    header['CDELT1'] = cdelt
+    header['CDELT2'] = cdelt
+    header['CRPIX1'] = -1000
+    header['CRPIX2'] = -2000
+    header['CRVAL1'] = 0
+    header['CRVAL2'] = 0
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.ImageHDU(img, header=header)]).writeto(path,
+                                                              overwrite=True)
+    return path
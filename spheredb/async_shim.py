@@ -0,0 +1,511 @@
+"""
+Asyncio client for the SciDB shim
+
+SciDBShimInterface runs one blocking HTTP request at a time.  The
+AsyncShimClient here keeps a bounded pool of shim sessions and of
+keep-alive HTTP connections, so that independent queries, uploads and
+downloads run concurrently from a single event loop.  Only the standard
+library is used for HTTP.
+
+Query strings use the same conventions as scidbpy: ``{0}``, ``{1}``... (or
+named fields) are replaced by the names of the array arguments.
+"""
+import asyncio
+import contextlib
+import itertools
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from urllib.parse import urlencode, urlparse
+
+import numpy as np
+from numpy.lib.recfunctions import rename_fields
+
+from .query import Array, Aggregate, Regrid, to_afl, index_bounds_afl
+
+__all__ = ['AsyncShimClient', 'ShimError', 'find_index_bounds_async',
+           'load_files_async']
+
+SHIM_DEFAULT = 'http://localhost:8080'
+
+SCIDB_TYPES = {np.dtype(np.int64): 'int64',
+               np.dtype(np.int32): 'int32',
+               np.dtype(np.float64): 'double',
+               np.dtype(np.float32): 'float'}
+
+
+class ShimError(Exception):
+    """Error returned by the shim server"""
+    pass
+
+
+def binary_format(dtype, nullable=()):
+    """Return the SciDB binary format and packed numpy dtype of records
+
+    Parameters
+    ----------
+    dtype : numpy dtype
+        structured dtype of the records
+    nullable : sequence of str
+        names of the fields which are nullable in SciDB.  In the binary
+        format each such value is preceded by a one-byte null code.
+
+    Returns
+    -------
+    fmt : str
+        the SciDB format string, e.g. ``'(int64,double null)'``
+    packed : numpy dtype
+        the dtype matching the bytes of the format
+    """
+    dtype = np.dtype(dtype)
+    types, fields = [], []
+    for name in dtype.names:
+        ftype = dtype[name]
+        try:
+            stype = SCIDB_TYPES[ftype]
+        except KeyError:
+            raise ValueError("type {0} of field '{1}' not "
+                             "supported".format(ftype, name))
+        if name in nullable:
+            types.append(stype + ' null')
+            fields.append(('_null_' + name, np.uint8))
+        else:
+            types.append(stype)
+        fields.append((name, ftype.newbyteorder('<')))
+    return '({0})'.format(','.join(types)), np.dtype(fields)
+
+
+class _ArrayRef(object):
+    """Formats as an array name, with dimension names as d0, d1..."""
+    def __init__(self, name, dim_names):
+        self.name = name
+        self.dim_names = tuple(dim_names)
+
+    def __format__(self, spec):
+        return format(self.name, spec)
+
+    def __getattr__(self, attr):
+        if attr.startswith('d') and attr[1:].isdigit():
+            return self.dim_names[int(attr[1:])]
+        raise AttributeError(attr)
+
+
+class _ConnectionPool(object):
+    """Bounded pool of keep-alive HTTP/1.1 connections to one host"""
+    def __init__(self, host, port, max_connections):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.n_opened = 0
+        self._idle = []
+        self._semaphore = None
+
+    async def request(self, method, path, params=None, body=b'',
+                      headers=None):
+        """Send a request and return (status, body bytes)"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        target = path
+        if params:
+            target += '?' + urlencode(params)
+
+        async with self._semaphore:
+            # an idle connection may have been closed by the server:
+            # retry once on a fresh connection
+            for attempt in range(2):
+                reused = bool(self._idle)
+                if reused:
+                    reader, writer = self._idle.pop()
+                else:
+                    reader, writer = await asyncio.open_connection(self.host,
+                                                                   self.port)
+                    self.n_opened += 1
+                try:
+                    status, data, keep_alive = await self._roundtrip(
+                        reader, writer, method, target, body, headers or {})
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused and attempt == 0:
+                        continue
+                    raise
+
+                if keep_alive:
+                    self._idle.append((reader, writer))
+                else:
+                    writer.close()
+                return status, data
+
+    async def _roundtrip(self, reader, writer, method, target, body,
+                         headers):
+        lines = ['{0} {1} HTTP/1.1'.format(method, target),
+                 'Host: {0}:{1}'.format(self.host, self.port),
+                 'Content-Length: {0}'.format(len(body))]
+        lines.extend('{0}: {1}'.format(*item) for item in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+                     + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed by server")
+        version, status = status_line.split()[:2]
+
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, value = line.decode('latin-1').split(':', 1)
+            response_headers[key.strip().lower()] = value.strip()
+
+        keep_alive = (version == b'HTTP/1.1' and
+                      response_headers.get('connection', '').lower()
+                      != 'close')
+        if 'content-length' in response_headers:
+            data = await reader.readexactly(
+                int(response_headers['content-length']))
+        elif (response_headers.get('transfer-encoding', '').lower()
+              == 'chunked'):
+            data = await self._read_chunked(reader)
+        else:
+            data = await reader.read()
+            keep_alive = False
+        return int(status), data, keep_alive
+
+    @staticmethod
+    async def _read_chunked(reader):
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await reader.readline()
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+
+    def close(self):
+        while self._idle:
+            reader, writer = self._idle.pop()
+            writer.close()
+
+
+class AsyncShimClient(object):
+    """Asyncio client for the SciDB shim with pooled sessions
+
+    Parameters
+    ----------
+    address : str
+        URL of the shim server (default = 'http://localhost:8080')
+    max_sessions : int
+        maximum number of shim sessions, and so of queries, in flight at
+        once (default = 4)
+    max_connections : int (optional)
+        maximum number of HTTP connections.  By default, one per session.
+
+    The client can be used as an async context manager, which releases all
+    sessions on exit::
+
+        async with AsyncShimClient() as client:
+            await asyncio.gather(client.query(q1), client.query(q2))
+    """
+    def __init__(self, address=SHIM_DEFAULT, max_sessions=4,
+                 max_connections=None):
+        url = urlparse(address)
+        self.address = address
+        self.max_sessions = max_sessions
+        self._pool = _ConnectionPool(url.hostname, url.port or 80,
+                                     max_connections or max_sessions)
+        self._sessions = set()
+        self._idle_sessions = []
+        self._semaphore = None
+        self._names = itertools.count()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _get(self, path, **params):
+        status, data = await self._pool.request('GET', path, params)
+        if status != 200:
+            raise ShimError("{0} failed ({1}): {2}".format(
+                path, status, data.decode('utf-8', 'replace').strip()))
+        return data
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        """Context manager yielding a session id from the pool"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_sessions)
+
+        async with self._semaphore:
+            if self._idle_sessions:
+                session_id = self._idle_sessions.pop()
+            else:
+                session_id = (await self._get('/new_session')).decode().strip()
+                self._sessions.add(session_id)
+
+            try:
+                yield session_id
+            except BaseException:
+                # the state of the session is unknown: do not reuse it
+                self._sessions.discard(session_id)
+                await self._release(session_id)
+                raise
+            else:
+                self._idle_sessions.append(session_id)
+
+    async def _release(self, session_id):
+        try:
+            await self._get('/release_session', id=session_id)
+        except (ShimError, ConnectionError, OSError):
+            pass
+
+    async def close(self):
+        """Release all sessions and close all connections"""
+        sessions, self._sessions = self._sessions, set()
+        self._idle_sessions = []
+        await asyncio.gather(*[self._release(s) for s in sessions])
+        self._pool.close()
+
+    def new_name(self):
+        """Return a new unique array name"""
+        return 'py_async_{0}_{1}'.format(os.getpid(), next(self._names))
+
+    @staticmethod
+    def format_query(query, *args, **kwargs):
+        """Substitute array names into a query string
+
+        Arrays (objects with a ``name``) format as their name; as in
+        scidbpy, ``{A.d0}``, ``{A.d1}``... give their dimension names.
+        """
+        ref = lambda arr: (_ArrayRef(arr.name, getattr(arr, 'dim_names', ()))
+                           if hasattr(arr, 'name') else arr)
+        return query.format(*[ref(arg) for arg in args],
+                            **dict((key, ref(val))
+                                   for (key, val) in kwargs.items()))
+
+    async def _execute(self, session_id, afl, save=None):
+        params = dict(id=session_id, query=afl, release=0)
+        if save is not None:
+            params['save'] = save
+        return await self._get('/execute_query', **params)
+
+    async def _upload(self, session_id, data):
+        boundary = uuid.uuid4().hex
+        body = b''.join([b'--', boundary.encode(), b'\r\n',
+                         b'Content-Disposition: form-data; name="file"; '
+                         b'filename="data"\r\n',
+                         b'Content-Type: application/octet-stream\r\n\r\n',
+                         data, b'\r\n--', boundary.encode(), b'--\r\n'])
+        status, path = await self._pool.request(
+            'POST', '/upload_file', dict(id=session_id), body,
+            {'Content-Type': 'multipart/form-data; '
+                             'boundary={0}'.format(boundary)})
+        if status != 200:
+            raise ShimError("upload failed ({0})".format(status))
+        return path.decode().strip()
+
+    async def query(self, query, *args, **kwargs):
+        """Execute a query, discarding any output"""
+        afl = self.format_query(query, *args, **kwargs)
+        async with self.session() as session_id:
+            await self._execute(session_id, afl)
+
+    async def query_records(self, query, *args, **kwargs):
+        """Execute a query and return its output as a record array
+
+        The keyword arguments ``dtype`` (the structured dtype of the
+        output, required) and ``nullable`` (names of nullable attributes)
+        describe the output; the others are substituted into the query.
+        """
+        dtype = np.dtype(kwargs.pop('dtype'))
+        nullable = kwargs.pop('nullable', ())
+        fmt, packed = binary_format(dtype, nullable)
+        afl = self.format_query(query, *args, **kwargs)
+        async with self.session() as session_id:
+            await self._execute(session_id, afl, save=fmt)
+            data = await self._get('/read_bytes', id=session_id, n=0)
+
+        records = np.frombuffer(data, dtype=packed)
+
+        # a null code of -1 marks a present value: drop rows with nulls
+        present = np.ones(len(records), dtype=bool)
+        for name in nullable:
+            present &= (records['_null_' + name] == 255)
+        records = records[present]
+
+        out = np.empty(len(records), dtype=dtype)
+        for name in dtype.names:
+            out[name] = records[name]
+        return out
+
+    async def from_records(self, records, name=None, chunk_size=1000000):
+        """Upload a record array to a new one-dimensional array
+
+        Returns the name of the new array.
+        """
+        records = np.ascontiguousarray(records)
+        if name is None:
+            name = self.new_name()
+        fmt, packed = binary_format(records.dtype)
+        schema = '<{0}>[i=0:*,{1},0]'.format(
+            ','.join('{0}:{1}'.format(field, SCIDB_TYPES[records.dtype[field]])
+                     for field in records.dtype.names), chunk_size)
+
+        async with self.session() as session_id:
+            path = await self._upload(session_id,
+                                      records.astype(packed).tobytes())
+            await self._execute(session_id,
+                                "store(input({0}, '{1}', -2, '{2}'), {3})"
+                                "".format(schema, path, fmt, name))
+        return name
+
+    async def remove(self, arr):
+        """Remove an array"""
+        await self.query('remove({0})', arr)
+
+    async def compute(self, lazy, name=None):
+        """Store the result of a :class:`LazyArray` in a new array
+
+        Returns the name of the new array.
+        """
+        expr = lazy.optimized()
+        sources = [a.source for a in expr.sources()]
+        if name is None:
+            name = self.new_name()
+        await self.query('store(' + to_afl(expr, lazy.attr) + ', '
+                         + name + ')', *sources)
+        return name
+
+    async def fetch(self, lazy):
+        """Evaluate a :class:`LazyArray` as a dense numpy array
+
+        Empty cells are zero.
+        """
+        expr = lazy.optimized()
+        sources = [a.source for a in expr.sources()]
+        dims = expr.dims
+        afl = to_afl(expr, lazy.attr)
+        if dims:
+            afl = 'project(apply({0}, {1}), {2}, {3})'.format(
+                afl, ', '.join('_{0}, {0}'.format(d) for d in dims),
+                ', '.join('_' + d for d in dims), lazy.attr)
+        dtype = [('_' + d, np.int64) for d in dims] + [
+            (lazy.attr, _value_dtype(expr, lazy.attr))]
+        records = await self.query_records(afl, *sources, dtype=dtype,
+                                           nullable=(lazy.attr,))
+        out = np.zeros(expr.shape)
+        out[tuple(records['_' + d] for d in dims)] = records[lazy.attr]
+        return out
+
+
+def _value_dtype(expr, attr):
+    """Return the dtype of the value attribute of an expression
+
+    SciDB computes sums and averages in double precision; the other
+    operations keep the type of the source array, taken from its ``dtype``
+    (double if it has none).
+    """
+    if isinstance(expr, (Aggregate, Regrid)) and expr.func in ('sum',
+                                                                'mean'):
+        return np.dtype(np.float64)
+    if isinstance(expr, Array):
+        dtype = np.dtype(getattr(expr.source, 'dtype', np.float64))
+        return dtype[attr] if dtype.names else dtype
+    return _value_dtype(expr.children[0], attr)
+
+
+async def find_index_bounds_async(client, arr, dims=None):
+    """Asynchronous version of :func:`spheredb.scidb_tools.find_index_bounds`
+
+    Parameters
+    ----------
+    client : AsyncShimClient
+    arr : SciDB array
+        any object with ``name``, ``shape`` and ``dim_names`` attributes
+    dims : int, tuple, or None
+    """
+    afl, dim_names = index_bounds_afl(len(arr.shape), dims)
+    dtype = [('{0}_{1}'.format(d, agg), np.int64)
+             for d in dim_names for agg in ('min', 'max')]
+    records = await client.query_records(afl, A=arr, dtype=dtype,
+                                         nullable=[n for (n, t) in dtype])
+    return np.asarray([records[name][0] for (name, t) in dtype])
+
+
+async def load_files_async(client, warper, files, name, create=True,
+                           chunk_sizes=(1000, 1000, 1), max_pending=None,
+                           stats=None):
+    """Warp files and load them into one (x, y, time) array, concurrently
+
+    Warping runs in a worker thread while earlier files are uploaded, so
+    that the warp of one file overlaps the upload of the next.  The warper
+    (with its cached setup and warp cache) is not thread-safe, so files are
+    warped one at a time; the inserts into the target array are serialized.
+
+    Parameters
+    ----------
+    client : AsyncShimClient
+    warper : LSSTWarper
+        the warper, which provides ``records_from_fits`` and the grid size
+    files : list
+        (fitsfile, hpx_bounds) pairs
+    name : str
+        name of the target array
+    create : bool
+        if True (default), create the target array first
+    chunk_sizes : tuple
+        chunk sizes of the target array along (x, y, time)
+    max_pending : int (optional)
+        maximum number of warped files held in memory, from their warp
+        until their insert completes.  By default, twice the number of
+        client sessions.
+    stats : TileStats (optional)
+        if specified, updated with the records of each file once inserted
+    """
+    loop = asyncio.get_running_loop()
+    pending = asyncio.Semaphore(max_pending or 2 * client.max_sessions)
+    insert_lock = asyncio.Lock()
+
+    if create:
+        dims = ','.join('{0}=0:{1},{2},0'.format(d, n - 1, c) for (d, n, c)
+                        in zip(('x', 'y', 'time'),
+                               (warper.Nx, warper.Ny, warper.Nt),
+                               chunk_sizes))
+        await client.query('create array {0} {1}[{2}]'.format(
+            name, warper.schema.scidb_attribute, dims))
+
+    async def load(fitsfile, hpx_bounds):
+        async with pending:
+            records = await loop.run_in_executor(warp_executor,
+                                                 warper.records_from_fits,
+                                                 fitsfile, hpx_bounds)
+
+            # dimensions must be int64: compact indices are uploaded under
+            # another name and converted on the server
+            narrow = [d for d in ('time', 'x', 'y')
+                      if records.dtype[d] != np.int64]
+            uploaded = await client.from_records(
+                rename_fields(records, dict((d, '_' + d) for d in narrow)))
+
+            source = uploaded
+            if narrow:
+                source = 'apply({0}, {1})'.format(
+                    uploaded, ', '.join('{0}, int64(_{0})'.format(d)
+                                        for d in narrow))
+            try:
+                async with insert_lock:
+                    await client.query('insert(redimension({0}, {1}), {1})'
+                                       ''.format(source, name))
+                    if stats is not None:
+                        stats.update(records)
+            finally:
+                await client.remove(uploaded)
+
+    with ThreadPoolExecutor(max_workers=1) as warp_executor:
+        await asyncio.gather(*[load(fitsfile, hpx_bounds)
+                               for (fitsfile, hpx_bounds) in files])
+    return name
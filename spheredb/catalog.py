@@ -0,0 +1,224 @@
+"""
+Persistent catalog of exposures
+
+The catalog holds the metadata of a collection of FITS exposures in a
+SQLite database: file path, modification time and size, exposure time,
+filter, the corners of the footprint on the sky and its HPX bounds (two
+boxes for a footprint straddling the RA wrap, one on each side).  It is
+built from a (parallel) header-only scan and refreshed incrementally, so
+that queries by sky region and time window never touch a FITS file.
+"""
+import os
+import sqlite3
+from multiprocessing import Pool
+
+import numpy as np
+
+from .fits_headers import read_header, header_mjd
+from .footprint import (header_footprint, bounding_circle, HPX_wrap_bounds,
+                        angular_separation)
+
+__all__ = ['ExposureCatalog']
+
+COLUMNS = [('path', 'TEXT PRIMARY KEY'),
+           ('mtime', 'REAL'),
+           ('size', 'INTEGER'),
+           ('mjd', 'REAL'),
+           ('tai', 'REAL'),
+           ('filter', 'TEXT'),
+           ('ra0', 'REAL'), ('dec0', 'REAL'),
+           ('ra1', 'REAL'), ('dec1', 'REAL'),
+           ('ra2', 'REAL'), ('dec2', 'REAL'),
+           ('ra3', 'REAL'), ('dec3', 'REAL'),
+           ('ra_c', 'REAL'), ('dec_c', 'REAL'), ('radius', 'REAL'),
+           ('hpx_xmin', 'REAL'), ('hpx_xmax', 'REAL'),
+           ('hpx_ymin', 'REAL'), ('hpx_ymax', 'REAL'),
+           ('hpx_xmin2', 'REAL'), ('hpx_xmax2', 'REAL'),
+           ('hpx_ymin2', 'REAL'), ('hpx_ymax2', 'REAL')]
+COLUMN_NAMES = [name for (name, sqltype) in COLUMNS]
+
+
+def scan_exposure(args):
+    """Return the catalog row of one exposure, reading only its header"""
+    path, hdunum = args
+    stat = os.stat(path)
+    header = read_header(path, hdunum)
+
+    RA, dec = header_footprint(header)
+    RA_c, dec_c, radius = bounding_circle(RA, dec)
+    corners = sum(zip(RA, dec), ())
+
+    # sample the edges more finely for the HPX bounds; the second box is
+    # NULL unless the footprint straddles the RA wrap
+    boxes = HPX_wrap_bounds(*header_footprint(header, 8))
+    bounds = sum((tuple(float(b) for b in box) for box in boxes), ())
+    bounds += (None,) * (8 - len(bounds))
+
+    tai = header.get('TAI', None)
+    filt = str(header.get('FILTER', '')).strip()
+
+    return ((path, stat.st_mtime, stat.st_size, header_mjd(header),
+             None if tai is None else float(tai), filt)
+            + tuple(float(c) for c in corners)
+            + (RA_c, dec_c, radius) + bounds)
+
+
+class ExposureCatalog(object):
+    """SQLite-backed catalog of exposure metadata
+
+    Parameters
+    ----------
+    db_path : str
+        path of the SQLite database; it is created if it does not exist.
+    hdunum : int
+        the HDU whose header is scanned (default = 1)
+    """
+    def __init__(self, db_path, hdunum=1):
+        self.db_path = db_path
+        self.hdunum = hdunum
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS exposures "
+                          "({0})".format(', '.join(' '.join(c)
+                                                   for c in COLUMNS)))
+        self.conn.execute("CREATE INDEX IF NOT EXISTS exposures_mjd "
+                          "ON exposures (mjd)")
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) "
+                                 "FROM exposures").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+    def update(self, files, processes=None, prune=False):
+        """Add new or modified files to the catalog
+
+        Parameters
+        ----------
+        files : iterable of str
+            paths of the exposures.  Files whose modification time and
+            size match the catalog are not scanned again.
+        processes : int (optional)
+            number of worker processes used for the header scan.  By default
+            the number of cpus is used.
+        prune : bool
+            if True, remove catalog entries for files not in ``files``
+
+        Returns
+        -------
+        n_scanned : int
+            the number of files whose headers were read
+        """
+        files = [os.path.abspath(f) for f in files]
+        known = dict((path, (mtime, size)) for (path, mtime, size)
+                     in self.conn.execute("SELECT path, mtime, size "
+                                          "FROM exposures"))
+        to_scan = []
+        for path in files:
+            stat = os.stat(path)
+            if known.get(path) != (stat.st_mtime, stat.st_size):
+                to_scan.append((path, self.hdunum))
+
+        if processes == 1 or len(to_scan) <= 1:
+            rows = list(map(scan_exposure, to_scan))
+        else:
+            pool = Pool(processes)
+            try:
+                rows = pool.map(scan_exposure, to_scan)
+            finally:
+                pool.close()
+                pool.join()
+
+        self.conn.executemany("INSERT OR REPLACE INTO exposures VALUES "
+                              "({0})".format(', '.join(len(COLUMNS) * '?')),
+                              rows)
+        if prune:
+            removed = set(known) - set(files)
+            self.conn.executemany("DELETE FROM exposures WHERE path = ?",
+                                  [(path,) for path in removed])
+        self.conn.commit()
+        return len(rows)
+
+    def update_directory(self, directory, match=None, **kwargs):
+        """Add all files below a directory to the catalog
+
+        ``match`` is an optional function of the file name selecting the
+        files to include (e.g. a compiled regex's ``match`` method).
+        Additional keyword arguments are passed to :meth:`update`.
+        """
+        files = []
+        for dirpath, dirnames, filenames in os.walk(directory):
+            if match is not None:
+                filenames = filter(match, filenames)
+            files.extend(os.path.join(dirpath, f) for f in filenames)
+        return self.update(files, **kwargs)
+
+    def _select(self, where='', args=()):
+        rows = self.conn.execute("SELECT {0} FROM exposures {1} "
+                                 "ORDER BY mjd, path"
+                                 "".format(', '.join(COLUMN_NAMES), where),
+                                 args).fetchall()
+        dtype = [(name, 'O' if sqltype.startswith('TEXT') else float)
+                 for (name, sqltype) in COLUMNS]
+        dtype[COLUMN_NAMES.index('size')] = ('size', np.int64)
+        rows = [tuple(np.nan if v is None else v for v in row)
+                for row in rows]
+        return np.array(rows, dtype=dtype)
+
+    def query(self, RA=None, dec=None, radius=None,
+              tmin=None, tmax=None, filter=None):
+        """Find exposures overlapping a cone and a time window
+
+        Parameters
+        ----------
+        RA, dec, radius : float (optional)
+            the cone, in degrees.  If not specified, the whole sky is used.
+        tmin, tmax : float (optional)
+            bounds of the time window (MJD, inclusive)
+        filter : str (optional)
+            the filter name
+
+        Returns
+        -------
+        exposures : record array
+            the catalog entries of matching exposures, ordered by time.
+            Overlap with the cone is judged from the bounding circle of each
+            footprint, so a few exposures lying just outside may be included.
+        """
+        conditions = []
+        args = []
+        if tmin is not None:
+            conditions.append('mjd >= ?')
+            args.append(tmin)
+        if tmax is not None:
+            conditions.append('mjd <= ?')
+            args.append(tmax)
+        if filter is not None:
+            conditions.append('filter = ?')
+            args.append(filter)
+        if radius is not None:
+            # cheap pre-selection in dec; the chip radius is bounded by the
+            # largest radius in the catalog
+            max_radius = self.conn.execute("SELECT MAX(radius) "
+                                           "FROM exposures").fetchone()[0]
+            max_radius = max_radius or 0
+            conditions.append('dec_c BETWEEN ? AND ?')
+            args.extend([dec - radius - max_radius,
+                         dec + radius + max_radius])
+
+        where = ''
+        if conditions:
+            where = 'WHERE ' + ' AND '.join(conditions)
+        exposures = self._select(where, args)
+
+        if radius is not None and len(exposures) > 0:
+            sep = angular_separation(RA, dec,
+                                     exposures['ra_c'], exposures['dec_c'])
+            exposures = exposures[sep <= radius + exposures['radius']]
+
+        return exposures
+
+    def times(self):
+        """Return the sorted array of exposure times (MJD)"""
+        return self._select()['mjd']
@@ -1,22 +1,26 @@
-__all__ = ['HPX_grid_step', 'HPX_grid_size', 'FITS_to_HPPX']
+__all__ = ['HPX_grid_step', 'HPX_grid_size', 'FITS_to_HPPX',
+           'FITS_to_HPX_mosaic']
 
-import numpy as np
-from scipy import sparse
+from multiprocessing.pool import ThreadPool
 
-# Kapteyn software contains tie-ins to WCS standard.
-try:
-    from kapteyn import wcs
-except ImportError:
-    print ("kapteyn package required: download at\n"
-           "http://www.astro.rug.nl/software/kapteyn/")
-    raise
+import numpy as np
 
 from .grid_interpolation import GridInterpolation
-from .util import regrid
+from .grid_transform import CoarseGridTransform
+from .resampling import ResamplingPlan
+from .footprint import (image_boundary, split_HPX_bounds, sample_spacing,
+                        HPX_pole_points, HPX_valid)
+from .records import DEFAULT_SCHEMA
+from .metrics import NULL_METRICS
+from .util import regrid, partition_records
 
 
 def HPX_grid_size(Nside):
-    """Return the size of the pixel grid (Nx, Ny) for a given Nside"""
+    """Return the size of the pixel grid (Nx, Ny) for a given Nside
+
+    Pixel (x, y) of the grid is at HPX-plane position
+    (-180 + x * step, -90 + y * step), with step = HPX_grid_step(Nside).
+    """
     Nx = 8 * Nside
     Ny = 4 * Nside + 1
     return Nx, Ny
@@ -27,7 +31,9 @@ def HPX_grid_step(Nside):
     return 45. / Nside
 
 
-def FITS_to_HPX(header, data, Nside, return_sparse=False):
+def FITS_to_HPX(header, data, Nside, return_sparse=False, cache=None,
+                hpx_bounds=None, plans=None, tile_shape=None, schema=None,
+                metrics=None, wcs_tol=None, coverage=None):
     """Convert data from FITS format to sparse HPX grid
 
     Parameters
@@ -38,11 +44,236 @@ def FITS_to_HPX(header, data, Nside, return_sparse=False):
         Input data array
     Nside : int
         HEALPix gridding parameter
+    return_sparse : bool (optional)
+        if True, return a coo_matrix rather than a record array
+    cache : WarpCache (optional)
+        if specified, the projected pixels are looked up in and stored to
+        this cache, keyed by the header, the data and Nside.
+    hpx_bounds : tuple (optional)
+        (xmin, xmax, ymin, ymax) in HPX degrees.  If specified, only the
+        part of the image within these bounds is projected.
+    plans : ResamplingPlanCache (optional)
+        if specified, the resampling plan for the WCS of this header is
+        taken from (or added to) this cache, so that exposures sharing the
+        same WCS skip all the projection computations.
+    tile_shape : tuple (optional)
+        (tile_x, tile_y) size of the storage chunks.  If specified, the
+        records are returned partitioned by this grid of tiles (see
+        :func:`spheredb.util.partition_records`).
+    schema : RecordSchema (optional)
+        layout of the output records (see :mod:`spheredb.records`).  By
+        default, int64 indices and time in seconds with float64 values.
+    metrics : Metrics (optional)
+        if specified, the time spent projecting and building the output,
+        and the number of output pixels, are recorded there.
+    wcs_tol : float (optional)
+        if specified, the image locations of the HPX pixels are
+        interpolated from the exact WCS transform on a coarse grid,
+        refined until the error measured on the grid is below ``wcs_tol``
+        (in image pixels).  See
+        :class:`spheredb.grid_transform.CoarseGridTransform`.
+    coverage : CoverageMap (optional)
+        if specified, the footprint of the image (within ``hpx_bounds``)
+        is added to this coarse coverage map.
+
+    Returns
+    -------
+    hpx_data : coo matrix, record array or OrderedDict
+        The HPX-projected data.  If ``tile_shape`` is specified, this is an
+        OrderedDict mapping each (i_tile, j_tile) to a block of records
+        sorted by (x, y).  Indices are those of the grid of
+        :func:`HPX_grid_size`, with x counted from the RA wrap at
+        HPX x = -180 degrees, so that they are never negative.
+    """
+    if return_sparse and tile_shape is not None:
+        raise ValueError("tile_shape cannot be used with return_sparse")
+    from scipy import sparse
+
+    if metrics is None:
+        metrics = NULL_METRICS
+    Nx_hpx, Ny_hpx = HPX_grid_size(Nside)
+
+    if coverage is not None:
+        with metrics.stage('coverage'):
+            coverage.add_header(header, header['TAI'], hpx_bounds)
+
+    if cache is None:
+        with metrics.stage('project'):
+            x, y, HPX_vals = _project(header, data, Nside, hpx_bounds, plans,
+                                      wcs_tol)
+    else:
+        params = {} if wcs_tol is None else {'wcs_tol': wcs_tol}
+        key = cache.array_key(header, data, Nside=Nside,
+                              hpx_bounds=hpx_bounds, **params)
+        with metrics.stage('cache_lookup'):
+            records = cache.get(key)
+        if records is None:
+            with metrics.stage('project'):
+                x, y, HPX_vals = _project(header, data, Nside, hpx_bounds,
+                                          plans, wcs_tol)
+            with metrics.stage('cache_store'):
+                cache.put_sparse(key, sparse.coo_matrix(
+                    (HPX_vals, (x, y)), shape=(Nx_hpx, Ny_hpx)))
+        else:
+            metrics.count('cache_hits')
+            x, y, HPX_vals = records['i1'], records['i2'], records['data']
+    metrics.count('pixels', len(HPX_vals))
+
+    if return_sparse:
+        return sparse.coo_matrix((HPX_vals, (x, y)),
+                                 shape=(Nx_hpx, Ny_hpx))
+
+    with metrics.stage('records'):
+        records = _HPX_records(x, y, HPX_vals, header['TAI'], schema)
+        if tile_shape is not None:
+            records = partition_records(records, tile_shape)
+    return records
+
+
+def FITS_to_HPX_mosaic(chips, Nside, time=None, return_sparse=False,
+                       n_threads=1, tile_shape=None, schema=None,
+                       wcs_tol=None, coverage=None):
+    """Combine the chips of a single epoch into one sparse HPX grid
+
+    Parameters
+    ----------
+    chips : list of tuples
+        (header, data) or (header, data, weight) for each chip.  ``weight``
+        is an array of per-pixel weights (e.g. inverse variance) of the same
+        shape as ``data``; by default all pixels have equal weight.
+    Nside : int
+        HEALPix gridding parameter
+    time : float (optional)
+        MJD of the epoch.  By default the TAI of the first chip is used.
+    return_sparse : bool (optional)
+        if True, return a coo_matrix rather than a record array
+    n_threads : int (optional)
+        number of threads used to interpolate the chips (default = 1)
+    tile_shape : tuple (optional)
+        if specified, return the records partitioned by this grid of
+        (tile_x, tile_y) tiles, as in :func:`FITS_to_HPX`
+    schema : RecordSchema (optional)
+        layout of the output records, as in :func:`FITS_to_HPX`
+    wcs_tol : float (optional)
+        tolerance of the approximate WCS transform, as in
+        :func:`FITS_to_HPX`
+    coverage : CoverageMap (optional)
+        if specified, the footprint of each chip is added to this coarse
+        coverage map
 
     Returns
     -------
-    hpx_data : csr matrix
-        The HPX-projected data
+    hpx_data : coo matrix, record array or OrderedDict
+        The HPX-projected data, with one entry per HPX pixel.  Where chips
+        overlap, the value is the weighted mean of the interpolated chips.
+    """
+    if return_sparse and tile_shape is not None:
+        raise ValueError("tile_shape cannot be used with return_sparse")
+
+    chips = [tuple(chip) + (None,) * (3 - len(chip)) for chip in chips]
+    if len(chips) == 0:
+        raise ValueError("no chips to mosaic")
+
+    for header, data, weight in chips:
+        _check_header(header, data)
+        if weight is not None and np.shape(weight) != data.shape:
+            raise ValueError("weight shape must match data shape")
+
+    if time is None:
+        time = chips[0][0]['TAI']
+    if coverage is not None:
+        for header, data, weight in chips:
+            coverage.add_header(header, time)
+
+    # The union footprint of all chips defines the shared output buffer
+    projections = [_projections(header) for (header, data, weight) in chips]
+    boxes = [_HPX_index_boxes(header, Nside, *proj)
+             for ((header, data, weight), proj) in zip(chips, projections)]
+    all_boxes = np.array(sum(boxes, []))
+    i0, j0 = all_boxes[:, 0].min(), all_boxes[:, 2].min()
+    i_max = all_boxes[:, 1].max()
+    if i_max >= 4 * Nside:
+        # the column at x = 180 is emitted as x = -180 (see _HPX_grid)
+        i0, i_max = -4 * Nside, 4 * Nside - 1
+    Ni = i_max + 1 - i0
+    Nj = all_boxes[:, 3].max() + 1 - j0
+
+    def contribution(k):
+        header, data, weight = chips[k]
+        pixel_ind_hpx, pixel_locs_img = _HPX_grid(boxes[k], Nside,
+                                                  *projections[k],
+                                                  wcs_tol=wcs_tol)
+        vals = GridInterpolation(data, [0, 0], [1, 1])(pixel_locs_img)
+        if weight is None:
+            w = np.ones_like(vals)
+        else:
+            w = GridInterpolation(weight, [0, 0], [1, 1])(pixel_locs_img)
+
+        good = ~(np.isnan(vals) | np.isnan(w))
+        good[good] = (w[good] > 0)
+        i, j = pixel_ind_hpx[good].T
+        return (j - j0) * Ni + (i - i0), w[good] * vals[good], w[good]
+
+    # Each chip is interpolated independently; the reduction into the
+    # shared buffer is a single bincount, so no locking is needed.
+    if n_threads == 1:
+        parts = list(map(contribution, range(len(chips))))
+    else:
+        pool = ThreadPool(n_threads)
+        try:
+            parts = pool.map(contribution, range(len(chips)))
+        finally:
+            pool.close()
+            pool.join()
+
+    index = np.concatenate([part[0] for part in parts])
+
+    # If the chips are split across seams of the HPX plane, the union box
+    # is mostly empty: compact the index before reducing.
+    box_area = np.prod(all_boxes[:, 1::2] + 1 - all_boxes[:, ::2], 1).sum()
+    if Ni * Nj > 4 * box_area:
+        unique_index, index = np.unique(index, return_inverse=True)
+    else:
+        unique_index = None
+
+    size = Ni * Nj if unique_index is None else len(unique_index)
+    sum_wv = np.bincount(index, np.concatenate([part[1] for part in parts]),
+                         minlength=size)
+    sum_w = np.bincount(index, np.concatenate([part[2] for part in parts]),
+                        minlength=size)
+
+    covered = np.nonzero(sum_w > 0)[0]
+    HPX_vals = sum_wv[covered] / sum_w[covered]
+    if unique_index is not None:
+        covered = unique_index[covered]
+    j, i = np.divmod(covered, Ni)
+    x, y = i + i0 + 4 * Nside, j + j0
+
+    if return_sparse:
+        from scipy import sparse
+        return sparse.coo_matrix((HPX_vals, (x, y)),
+                                 shape=HPX_grid_size(Nside))
+    else:
+        records = _HPX_records(x, y, HPX_vals, time, schema)
+        if tile_shape is None:
+            return records
+        else:
+            return partition_records(records, tile_shape)
+
+
+def _HPX_records(x, y, HPX_vals, mjd, schema=None):
+    """Return the structured array of (time, x, y, val) records"""
+    if schema is None:
+        schema = DEFAULT_SCHEMA
+    return schema.records(x, y, HPX_vals, mjd)
+
+
+def _FITS_to_HPX_pixels(header, data, Nside, hpx_bounds=None,
+                        wcs_tol=None):
+    """Project FITS data to the HPX grid
+
+    Returns the arrays (x, y, val) of HPX grid indices (counting x from
+    HPX x = -180, as in FITS_to_HPX) and values.
     """
     # Here's what we do for this function: we're working in "IMG coords"
     # (i.e. the projection of the input data) and "HPX coords" (i.e. the
@@ -55,13 +286,86 @@ def FITS_to_HPX(header, data, Nside, return_sparse=False):
     #     the image.  Project this grid to IMG coords.
     #  3. In IMG coords, interpolate the image data to the healpix grid.
     #  4. Use this data to construct a sparse array in HPX coords.
+    _check_header(header, data)
+    proj_img, proj_hpx = _projections(header)
 
+    boxes = _HPX_index_boxes(header, Nside, proj_img, proj_hpx, hpx_bounds)
+    pixel_ind_hpx, pixel_locs_img = _HPX_grid(boxes, Nside,
+                                              proj_img, proj_hpx, wcs_tol)
+
+    # Interpolate from data to pixel locations
+    I = GridInterpolation(data, [0, 0], [1, 1])
+    HPX_vals = I(pixel_locs_img)#.reshape(len(y_hpx), len(x_hpx))
+
+    # # DEBUG: Plot regridded input data next to the interpolated HPX data
+    # import matplotlib.pyplot as plt
+    # plt.figure(figsize=(8, 8))
+    # plt.subplot(211, aspect='equal')
+    # plt.contourf(x_hpx, y_hpx, HPX_vals)
+    # plt.subplot(212, aspect='equal')
+    # plt.contourf(regrid(data, 5))
+    # plt.show()
+    # exit()
+    
+    good_vals = ~np.isnan(HPX_vals)
+    x, y = pixel_ind_hpx[good_vals].T
+    return x + 4 * Nside, y, HPX_vals[good_vals]
+
+
+def _project(header, data, Nside, hpx_bounds=None, plans=None,
+             wcs_tol=None):
+    """Project FITS data to the HPX grid, using a cached plan if possible"""
+    if plans is None:
+        return _FITS_to_HPX_pixels(header, data, Nside, hpx_bounds, wcs_tol)
+
+    def build_plan():
+        return _FITS_to_HPX_plan(header, data, Nside, hpx_bounds, wcs_tol)
+
+    params = {} if wcs_tol is None else {'wcs_tol': wcs_tol}
+    plan = plans.get(header, build_plan, Nside=Nside, hpx_bounds=hpx_bounds,
+                     **params)
+    return plan.apply(data)
+
+
+def _FITS_to_HPX_plan(header, data, Nside, hpx_bounds=None, wcs_tol=None):
+    """Construct the ResamplingPlan equivalent to _FITS_to_HPX_pixels"""
+    _check_header(header, data)
+    proj_img, proj_hpx = _projections(header)
+
+    boxes = _HPX_index_boxes(header, Nside, proj_img, proj_hpx, hpx_bounds)
+    pixel_ind_hpx, pixel_locs_img = _HPX_grid(boxes, Nside,
+                                              proj_img, proj_hpx, wcs_tol)
+    return ResamplingPlan.from_locations(data.shape,
+                                         pixel_ind_hpx + [4 * Nside, 0],
+                                         pixel_locs_img)
+
+
+def _check_header(header, data):
     if header['NAXIS'] != 2:
         raise ValueError("input data & header must be two dimensional")
 
     if data.shape != (header['NAXIS2'], header['NAXIS1']):
         raise ValueError("data shape must match header metadata")
 
+
+def _kapteyn_wcs():
+    """Import the kapteyn wcs module on first use
+
+    Kapteyn software contains tie-ins to WCS standard.  It is only needed
+    to project images, so that importing this module stays cheap.
+    """
+    try:
+        from kapteyn import wcs
+    except ImportError:
+        raise ImportError("kapteyn package required: download at\n"
+                          "http://www.astro.rug.nl/software/kapteyn/")
+    return wcs
+
+
+def _projections(header):
+    """Return the (image, HPX) wcs projections for a header"""
+    wcs = _kapteyn_wcs()
+
     # Create wcs projection instance from the header
     proj_img = wcs.Projection(header)
     
@@ -71,94 +375,152 @@ def FITS_to_HPX(header, data, Nside, return_sparse=False):
     proj_hpx = wcs.Projection({'NAXIS': 2,
                                'CTYPE1': 'RA---HPX',
                                'CTYPE2': 'DEC--HPX'})
+    return proj_img, proj_hpx
 
-    # Define the dimension of the HEALPIX SciDB grid
-    Nx_hpx, Ny_hpx = HPX_grid_size(Nside)
+
+def _HPX_index_boxes(header, Nside, proj_img, proj_hpx, hpx_bounds=None):
+    """Return a list of (i_min, i_max, j_min, j_max) HPX index boxes which
+    together cover an image
+    """
     dx_hpx = dy_hpx = HPX_grid_step(Nside)
-    
-    #x_hpx = np.linspace(0, 360, Nx_hpx, endpoint=False)
-    #y_hpx = np.linspace(-90, 90, Ny_hpx)
 
-    # Find the coordinates of the pixels at the edge of the image
-    # Projecting these onto the healpix grid will give the bounds we need.
-    img_bounds_x = np.arange(header['NAXIS2'])
-    zeros_x = np.zeros_like(img_bounds_x)
-    img_bounds_y = np.arange(header['NAXIS1'])
-    zeros_y = np.zeros_like(img_bounds_y)
+    # Project points on the edge of the image to the HPX plane.  A footprint
+    # which straddles the RA wrap or the seam between two polar facets is
+    # split into one tight box per contiguous piece, so that the size of
+    # the grid stays proportional to the area of the image.
+    img_bounds_pix = image_boundary(header['NAXIS1'], header['NAXIS2'],
+                                    n_per_side=64) + 1
+    x_bound_hpx, y_bound_hpx =\
+                    proj_hpx.topixel(proj_img.toworld(img_bounds_pix)).T
+    pad = sample_spacing(x_bound_hpx, y_bound_hpx) + max(dx_hpx, dy_hpx)
 
-    img_bounds_pix = np.concatenate(
-        [img_bounds_x, img_bounds_x, zeros_y, zeros_y + img_bounds_x[-1],
-         zeros_x, zeros_x + img_bounds_y[-1], img_bounds_y, img_bounds_y]
-    ).reshape((2, -1)).T
+    # If the image contains a pole, all four facet apexes are in the
+    # footprint.
+    for north in (True, False):
+        if _contains_pole(header, proj_img, north):
+            x_pole, y_pole = HPX_pole_points(north)
+            x_bound_hpx = np.concatenate([x_bound_hpx, x_pole])
+            y_bound_hpx = np.concatenate([y_bound_hpx, y_pole])
 
-    x_bound_hpx, y_bound_hpx =\
-                    proj_hpx.topixel(proj_img.toworld(img_bounds_pix)).T    
-
-    # here we take the pixels at the edge of the boundaries of the image,
-    # transform them to HPX coordinates, and find the required extent
-    # of the HPX pixel grid.
-    #    [TODO: check for crossing the pole]
-    # first we need to calculate pixel number
-    i_bound_hpx = x_bound_hpx / dx_hpx
-    j_bound_hpx = (y_bound_hpx + 90.) / dy_hpx
-    
-    i_hpx = np.arange(int(np.floor(i_bound_hpx.min())),
-                      int(np.ceil(i_bound_hpx.max()) + 1))
-    j_hpx = np.arange(int(np.floor(j_bound_hpx.min())),
-                      int(np.ceil(j_bound_hpx.max()) + 1))
+    boxes = []
+    for xmin, xmax, ymin, ymax in split_HPX_bounds(x_bound_hpx, y_bound_hpx,
+                                                   pad):
+        # restrict to the requested part of the image
+        if hpx_bounds is not None:
+            xmin, xmax = max(xmin, hpx_bounds[0]), min(xmax, hpx_bounds[1])
+            ymin, ymax = max(ymin, hpx_bounds[2]), min(ymax, hpx_bounds[3])
+            if xmin > xmax or ymin > ymax:
+                continue
+
+        boxes.append((int(np.floor(xmin / dx_hpx)),
+                      int(np.ceil(xmax / dx_hpx)),
+                      int(np.floor((ymin + 90.) / dy_hpx)),
+                      int(np.ceil((ymax + 90.) / dy_hpx))))
+    return boxes
+
+
+def _contains_pole(header, proj_img, north=True):
+    """Check whether the north (or south) pole falls within the image"""
+    try:
+        with np.errstate(invalid='ignore'):
+            x, y = np.ravel(proj_img.topixel([[0., 90. if north else -90.]]))
+    except Exception:
+        # the pole is not on the image plane
+        return False
+    return (np.isfinite(x) and np.isfinite(y) and
+            0.5 <= x <= header['NAXIS1'] + 0.5 and
+            0.5 <= y <= header['NAXIS2'] + 0.5)
+
+
+def _HPX_grid(boxes, Nside, proj_img, proj_hpx, wcs_tol=None):
+    """Return HPX indices and image locations of the grid covering boxes
+
+    The indices (i, j) are those of the HPX-plane position (i * step,
+    j * step - 90), with i in [-4 * Nside, 4 * Nside).  The image locations
+    are zero-based (row, column) positions, the order in which the data
+    array is indexed (and so interpolated by ``GridInterpolation(data,
+    [0, 0], [1, 1])``).  If wcs_tol is specified, they are approximated to
+    this tolerance (see _approx_HPX_to_img).
+    """
+    dx_hpx = dy_hpx = HPX_grid_step(Nside)
+    Nx_hpx, Ny_hpx = HPX_grid_size(Nside)
 
-    x_hpx = i_hpx * dx_hpx
-    y_hpx = j_hpx * dy_hpx - 90.
-    
     # Create the grid of HPX pixels
-    pixel_ind_hpx = np.vstack(map(np.ravel, np.meshgrid(i_hpx, j_hpx))).T
-    pixel_locs_hpx = np.vstack(map(np.ravel, np.meshgrid(x_hpx, y_hpx))).T
-    pixel_locs_img = proj_img.topixel(proj_hpx.toworld(pixel_locs_hpx))
+    pixel_ind_hpx = [np.zeros((0, 2), dtype=int)]
+    for i_min, i_max, j_min, j_max in boxes:
+        i_hpx = np.arange(i_min, i_max + 1)
+        j_hpx = np.arange(j_min, j_max + 1)
+        pixel_ind_hpx.append(np.vstack([np.ravel(a) for a in
+                                        np.meshgrid(i_hpx, j_hpx)]).T)
+    pixel_ind_hpx = np.vstack(pixel_ind_hpx)
 
-    ## DEBUG: Plot the borders & grid in the HPX projection
-    #import matplotlib.pyplot as plt
-    #plt.plot(i_bound_hpx, j_bound_hpx, '.k')
-    #plt.plot(pixel_ind_hpx[:, 0], pixel_ind_hpx[:, 1], '.r')
-    #plt.show()
-    #exit()
+    # x = 180 is the same meridian as x = -180: map the columns of boxes
+    # ending on the RA wrap to the start of the plane
+    pixel_ind_hpx[:, 0] = ((pixel_ind_hpx[:, 0] + 4 * Nside) % Nx_hpx
+                           - 4 * Nside)
+
+    # boxes may share their edges: drop repeated pixels
+    if len(boxes) > 1:
+        key = pixel_ind_hpx[:, 1] * 2 * Nx_hpx + pixel_ind_hpx[:, 0]
+        unique = np.sort(np.unique(key, return_index=True)[1])
+        pixel_ind_hpx = pixel_ind_hpx[unique]
+
+    # Project the grid of HPX pixels to the image, skipping those in the
+    # gaps between polar facets
+    pixel_locs_hpx = np.vstack([pixel_ind_hpx[:, 0] * dx_hpx,
+                                pixel_ind_hpx[:, 1] * dy_hpx - 90.]).T
+    valid = HPX_valid(*pixel_locs_hpx.T)
+    if not np.all(valid):
+        pixel_ind_hpx = pixel_ind_hpx[valid]
+        pixel_locs_hpx = pixel_locs_hpx[valid]
+    if wcs_tol is None:
+        pixel_locs_img = proj_img.topixel(proj_hpx.toworld(pixel_locs_hpx))
+    else:
+        pixel_locs_img = _approx_HPX_to_img(pixel_ind_hpx, Nside, proj_img,
+                                            proj_hpx, wcs_tol)
 
     ## DEBUG: Plot the HPX grid in the IMG projection
     #import matplotlib.pyplot as plt
-    #plt.plot(img_bounds_pix[:, 0], img_bounds_pix[:, 1], '.k')
     #plt.plot(pixel_locs_img[:, 0], pixel_locs_img[:, 1], '.r')
     #plt.show()
     #exit()
 
-    # Interpolate from data to pixel locations
-    I = GridInterpolation(data, [0, 0], [1, 1])
-    HPX_vals = I(pixel_locs_img)#.reshape(len(y_hpx), len(x_hpx))
+    # FITS pixel coordinates are one-based (column, row)
+    return pixel_ind_hpx, pixel_locs_img[:, ::-1] - 1
 
-    # # DEBUG: Plot regridded input data next to the interpolated HPX data
-    # import matplotlib.pyplot as plt
-    # plt.figure(figsize=(8, 8))
-    # plt.subplot(211, aspect='equal')
-    # plt.contourf(x_hpx, y_hpx, HPX_vals)
-    # plt.subplot(212, aspect='equal')
-    # plt.contourf(regrid(data, 5))
-    # plt.show()
-    # exit()
-    
-    good_vals = ~np.isnan(HPX_vals)
-    x, y = pixel_ind_hpx[good_vals].T
-    HPX_vals = HPX_vals[good_vals]
 
-    if return_sparse:
-        return sparse.coo_matrix((HPX_vals, (x, y)),
-                                 shape=(Nx_hpx, Ny_hpx))
-    else:
-        output = np.zeros(len(HPX_vals),
-                          dtype=[('time', np.int64),
-                                 ('x', np.int64),
-                                 ('y', np.int64),
-                                 ('val', np.float64)])
-        # use MJD in seconds
-        output['time'] = int(header['TAI'] * 24 * 60 * 60)
-        output['x'] = x
-        output['y'] = y
-        output['val'] = HPX_vals
-        return output
+def _approx_HPX_to_img(pixel_ind_hpx, Nside, proj_img, proj_hpx, wcs_tol):
+    """Approximate image locations of (unique, valid) HPX pixel indices
+
+    The HPX projection is only piecewise smooth: the pixels are grouped
+    by facet (split at |y| = 45 and at multiples of 90 in x), and each
+    group which fills its bounding box is transformed with a
+    CoarseGridTransform.  Other groups (e.g. those bordering the gaps
+    between polar facets) are transformed exactly.
+    """
+    step = HPX_grid_step(Nside)
+
+    def transform(ij):
+        locs_hpx = np.vstack([ij[:, 0] * step, ij[:, 1] * step - 90.]).T
+        return proj_img.topixel(proj_hpx.toworld(locs_hpx))
+
+    i, j = pixel_ind_hpx.T
+    facet_x = np.floor_divide(i, 2 * Nside)
+    facet_y = np.searchsorted([Nside, 3 * Nside], j)
+    facets, facet = np.unique(facet_y * (8 * Nside) + facet_x,
+                              return_inverse=True)
+    facet = np.ravel(facet)
+
+    pixel_locs_img = np.zeros(pixel_ind_hpx.shape)
+    for k in range(len(facets)):
+        members = np.nonzero(facet == k)[0]
+        ii, jj = i[members], j[members]
+        i0, j0 = ii.min(), jj.min()
+        Ni, Nj = ii.max() + 1 - i0, jj.max() + 1 - j0
+        if Ni * Nj == len(members):
+            T = CoarseGridTransform(transform, wcs_tol)
+            locs = T(np.arange(i0, i0 + Ni), np.arange(j0, j0 + Nj))
+            pixel_locs_img[members] = locs[jj - j0, ii - i0]
+        else:
+            pixel_locs_img[members] = transform(pixel_ind_hpx[members])
+    return pixel_locs_img
@@ -0,0 +1,252 @@
+"""
+Coarse sky-coverage and depth maps built from exposure footprints
+
+A CoverageMap divides the HPX plane into square cells of a coarse Nside
+and counts, for each cell, the exposures whose footprint covers it, along
+with the first and last MJD of those exposures.  Footprints are computed
+from the WCS headers and rasterized onto the cells, so that the map is
+built during ingest at a negligible cost and without reading any pixels.
+"""
+import numpy as np
+
+from .hpx_utils import RAdec_to_HPX, HPX_grid_to_RAdec
+from .footprint import (header_footprint, bounding_circle, angular_separation,
+                        points_in_polygon, split_HPX_bounds, HPX_valid,
+                        HPX_pole_points, _gnomonic)
+
+__all__ = ['CoverageMap', 'footprint_cells']
+
+
+def footprint_cells(RA, dec, Nside, hpx_bounds=None):
+    """Return the cells of the coarse HPX grid covered by a footprint
+
+    Parameters
+    ----------
+    RA, dec : array_like
+        boundary of the footprint in degrees, going around it
+    Nside : int
+        the cells are squares of 45 / Nside degrees in the HPX plane
+    hpx_bounds : tuple (optional)
+        (xmin, xmax, ymin, ymax) in HPX degrees; if specified, only cells
+        within these bounds are returned
+
+    Returns
+    -------
+    k, j : ndarrays
+        indices of the covered cells along x and y.  Cell (k, j) spans
+        ``-180 + k * step <= x < -180 + (k + 1) * step`` and likewise in y
+        from -90.  A cell is covered if its center lies inside the
+        footprint or if it contains a point of the boundary; cells whose
+        corner is only clipped by an edge between two samples are missed.
+    """
+    RA = np.asarray(RA, dtype=float) % 360
+    dec = np.asarray(dec, dtype=float)
+    step = 45. / Nside
+    Nx, Ny = 8 * Nside, 4 * Nside
+
+    x, y = RAdec_to_HPX(RA, dec)
+    RA_c, dec_c, radius = bounding_circle(RA, dec)
+    xi, eta = _gnomonic(RA, dec, RA_c, dec_c)
+
+    # a footprint containing a pole covers all four facet apexes
+    for north in (True, False):
+        pole = 90. if north else -90.
+        if angular_separation(RA_c, dec_c, 0., pole) <= radius:
+            if points_in_polygon(*(_gnomonic(0., pole, RA_c, dec_c)
+                                   + (xi, eta)))[0]:
+                x_pole, y_pole = HPX_pole_points(north)
+                x = np.concatenate([x, x_pole])
+                y = np.concatenate([y, y_pole])
+
+    # cells containing boundary points
+    cells = [np.clip(np.floor((x + 180.) / step), 0, Nx - 1).astype(int)
+             * Ny + np.clip(np.floor((y + 90.) / step),
+                            0, Ny - 1).astype(int)]
+
+    # cells whose center is inside the footprint
+    for xmin, xmax, ymin, ymax in split_HPX_bounds(x, y, step):
+        k = np.arange(max(0, int((xmin + 180.) // step)),
+                      min(Nx, int((xmax + 180.) // step) + 1))
+        j = np.arange(max(0, int((ymin + 90.) // step)),
+                      min(Ny, int((ymax + 90.) // step) + 1))
+        k, j = [a.ravel() for a in np.meshgrid(k, j)]
+        x_c, y_c = -180. + (k + 0.5) * step, -90. + (j + 0.5) * step
+        valid = HPX_valid(x_c, y_c)
+        k, j, x_c, y_c = k[valid], j[valid], x_c[valid], y_c[valid]
+
+        RA_cell, dec_cell = HPX_grid_to_RAdec(k, j, Nside, 0.5)
+        near = angular_separation(RA_c, dec_c, RA_cell, dec_cell) < radius
+        k, j = k[near], j[near]
+        if len(k):
+            inside = points_in_polygon(*(_gnomonic(RA_cell[near],
+                                                   dec_cell[near],
+                                                   RA_c, dec_c) + (xi, eta)))
+            cells.append(k[inside] * Ny + j[inside])
+
+    k, j = np.divmod(np.unique(np.concatenate(cells)), Ny)
+    if hpx_bounds is not None:
+        xmin, xmax, ymin, ymax = hpx_bounds
+        keep = ((-180. + (k + 1) * step > xmin) &
+                (-180. + k * step <= xmax) &
+                (-90. + (j + 1) * step > ymin) &
+                (-90. + j * step <= ymax))
+        k, j = k[keep], j[keep]
+    return k, j
+
+
+class CoverageMap(object):
+    """Exposure count and time coverage on a coarse HPX grid
+
+    Parameters
+    ----------
+    Nside : int
+        coarseness of the grid: cells are 45 / Nside degrees on a side in
+        the HPX plane (default = 64, i.e. ~0.7 degree cells)
+    n_per_side : int
+        minimum number of boundary samples along each side of a chip used
+        to rasterize its footprint (default = 8).  Large chips are sampled
+        at a quarter of the cell size.
+
+    Attributes
+    ----------
+    counts : ndarray, shape = (8 * Nside, 4 * Nside)
+        number of exposures covering each cell
+    t_min, t_max : ndarrays, shape = (8 * Nside, 4 * Nside)
+        first and last MJD of the exposures covering each cell (NaN where
+        there are none)
+    n_exposures : int
+        number of exposures added
+    """
+    def __init__(self, Nside=64, n_per_side=8):
+        self.Nside = Nside
+        self.n_per_side = n_per_side
+        shape = (8 * Nside, 4 * Nside)
+        self.counts = np.zeros(shape, dtype=np.int32)
+        self.t_min = np.empty(shape)
+        self.t_min.fill(np.nan)
+        self.t_max = self.t_min.copy()
+        self.n_exposures = 0
+
+    @property
+    def step(self):
+        """Size of the cells in HPX degrees"""
+        return 45. / self.Nside
+
+    def __repr__(self):
+        return 'CoverageMap(Nside={0}, covered={1})'.format(
+            self.Nside, int(np.sum(self.counts > 0)))
+
+    def add_footprint(self, RA, dec, mjd, hpx_bounds=None):
+        """Add an exposure given the (RA, dec) boundary of its footprint"""
+        k, j = footprint_cells(RA, dec, self.Nside, hpx_bounds)
+        self.counts[k, j] += 1
+        self.t_min[k, j] = np.fmin(self.t_min[k, j], mjd)
+        self.t_max[k, j] = np.fmax(self.t_max[k, j], mjd)
+        self.n_exposures += 1
+
+    def add_header(self, header, mjd=None, hpx_bounds=None):
+        """Add an exposure from its WCS header
+
+        The MJD is read from the header if not specified.
+        """
+        from .fits_headers import header_mjd
+
+        if mjd is None:
+            mjd = header_mjd(header)
+
+        # sample the sides finely enough for every cell crossed by an
+        # edge to hold a sample
+        RA, dec = header_footprint(header)
+        side = angular_separation(RA, dec, np.roll(RA, 1),
+                                  np.roll(dec, 1)).max()
+        n_per_side = max(self.n_per_side, int(np.ceil(4 * side / self.step)))
+        RA, dec = header_footprint(header, n_per_side)
+        self.add_footprint(RA, dec, mjd, hpx_bounds)
+
+    def add_file(self, fitsfile, hpx_bounds=None, hdunum=1):
+        """Add an exposure from the header of a FITS file"""
+        from .fits_headers import read_header, read_exposure_date
+
+        self.add_header(read_header(fitsfile, hdunum),
+                        read_exposure_date(fitsfile, hdunum), hpx_bounds)
+
+    def merge(self, other):
+        """Add the exposures of another map with the same Nside"""
+        if other.Nside != self.Nside:
+            raise ValueError("cannot merge maps of different Nside")
+        self.counts += other.counts
+        self.t_min = np.fmin(self.t_min, other.t_min)
+        self.t_max = np.fmax(self.t_max, other.t_max)
+        self.n_exposures += other.n_exposures
+
+    def save(self, path):
+        """Save the map to an ``.npz`` file"""
+        np.savez(path, Nside=self.Nside, counts=self.counts,
+                 t_min=self.t_min, t_max=self.t_max,
+                 n_exposures=self.n_exposures)
+
+    @classmethod
+    def load(cls, path):
+        """Load a map written by :meth:`save`"""
+        with np.load(path) as f:
+            coverage = cls(int(f['Nside']))
+            coverage.counts = f['counts']
+            coverage.t_min = f['t_min']
+            coverage.t_max = f['t_max']
+            coverage.n_exposures = int(f['n_exposures'])
+        return coverage
+
+    def cell_index(self, RA, dec):
+        """Return the (k, j) indices of the cells holding sky positions"""
+        x, y = RAdec_to_HPX(RA, dec)
+        k = np.clip(np.floor((x + 180.) / self.step), 0,
+                    self.counts.shape[0] - 1).astype(int)
+        j = np.clip(np.floor((y + 90.) / self.step), 0,
+                    self.counts.shape[1] - 1).astype(int)
+        return k, j
+
+    def lookup(self, RA, dec):
+        """Return the (count, t_min, t_max) of the cells at sky positions"""
+        k, j = self.cell_index(RA, dec)
+        return self.counts[k, j], self.t_min[k, j], self.t_max[k, j]
+
+    def depth(self, hpx_bounds=None):
+        """Exposure counts of the cells, optionally within HPX bounds
+
+        Returns the count map restricted to the cells overlapping
+        ``hpx_bounds`` = (xmin, xmax, ymin, ymax) in HPX degrees.
+        """
+        if hpx_bounds is None:
+            return self.counts
+        xmin, xmax, ymin, ymax = hpx_bounds
+        k0, j0 = [max(0, int((v + off) // self.step))
+                  for (v, off) in ((xmin, 180.), (ymin, 90.))]
+        k1, j1 = [int((v + off) // self.step) + 1
+                  for (v, off) in ((xmax, 180.), (ymax, 90.))]
+        return self.counts[k0:k1, j0:j1]
+
+    def coverage(self, min_count=1):
+        """Boolean map of the cells covered by at least min_count exposures"""
+        return self.counts >= min_count
+
+    def plot(self, ax=None, time_span=False, **kwargs):
+        """Plot the map in the HPX plane with matplotlib
+
+        Shows the exposure count of each cell, or the time span (t_max -
+        t_min, in days) if ``time_span`` is True.  Extra keyword arguments
+        are passed to ``imshow``.
+        """
+        import matplotlib.pyplot as plt
+
+        if ax is None:
+            ax = plt.gca()
+        if time_span:
+            values = self.t_max - self.t_min
+        else:
+            values = np.ma.masked_equal(self.counts, 0)
+        kwargs.setdefault('interpolation', 'nearest')
+        image = ax.imshow(values.T, origin='lower',
+                          extent=(-180, 180, -90, 90), **kwargs)
+        ax.set_xlabel('x (HPX deg)')
+        ax.set_ylabel('y (HPX deg)')
+        return image
@@ -0,0 +1,492 @@
+"""
+On-disk sparse (x, y, time) cube of HPX pixels
+
+SparseCube is the local counterpart of the 3D SciDB array of
+:class:`spheredb.scidb_tools.HPXPixels3D`.  The (x, y) plane is split into a
+regular grid of tiles.  Each tile is stored in compressed-row form: the
+sorted local index of the non-empty pixels, a pointer into the time and
+value columns for each of them, and the time-sorted (time, val) columns.
+Every column is a separate ``.npy`` file, memory-mapped on access, so that
+only the tiles touched by an operation are read.
+
+Appending rewrites the touched tiles into a new generation of files; the
+metadata file, which lists the current generation of each tile, is
+replaced atomically once the new files are written.  The per-tile
+statistics of the cube (see :mod:`spheredb.tile_stats`) are updated for
+the touched tiles at the same time.
+"""
+import os
+import json
+import tempfile
+
+import numpy as np
+
+from .util import iter_tiles, reduce_duplicates
+from .query import DIFFERENCE_DTYPE
+from .tile_stats import TileStats, cube_tile_summary
+
+__all__ = ['SparseCube']
+
+COLUMNS = ('pixel', 'indptr', 'time', 'val')
+REDUCTIONS = ('sum', 'mean', 'min', 'max', 'count')
+
+
+class SparseCube(object):
+    """Chunked sparse cube of (x, y, time) pixels stored in a directory
+
+    Parameters
+    ----------
+    path : str
+        directory of the cube.  If it holds a cube, the cube is opened;
+        otherwise a new empty cube is created there.
+    shape : tuple (optional)
+        (Nx, Ny, Nt) size of the cube; required to create a new cube
+    tile_shape : tuple (optional)
+        (tile_x, tile_y) size of the spatial tiles (default = (256, 256))
+    dtype : numpy dtype (optional)
+        type of the pixel values (default = float64)
+
+    Notes
+    -----
+    Times are the integer time indices of the records (see
+    :mod:`spheredb.records`).  A cube holds at most one value per
+    (x, y, time) cell: appending to an existing cell replaces its value.
+    Ranges passed to the methods below are half-open (start, stop) pairs,
+    with None meaning the whole axis; coordinates in the outputs are
+    absolute (not re-based).
+    """
+    dims = ('x', 'y', 'time')
+    metadata_file = 'cube.json'
+    stats_file = 'stats.npz'
+
+    def __init__(self, path, shape=None, tile_shape=None, dtype=None):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        metadata_path = os.path.join(self.path, self.metadata_file)
+
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+            for name, value in [('shape', shape), ('tile_shape', tile_shape)]:
+                if value is not None and tuple(value) != tuple(metadata[name]):
+                    raise ValueError("{0}={1} does not match the existing "
+                                     "cube".format(name, tuple(value)))
+        else:
+            if shape is None:
+                raise ValueError("shape must be specified to create a cube")
+            metadata = {'shape': [int(n) for n in shape],
+                        'tile_shape': [int(n) for n in
+                                       (tile_shape or (256, 256))],
+                        'dtype': np.dtype(dtype or np.float64).str,
+                        'tiles': []}
+
+        self.shape = tuple(metadata['shape'])
+        self.tile_shape = tuple(metadata['tile_shape'])
+        self.dtype = np.dtype(metadata['dtype'])
+        self._tiles = dict(((ti, tj), (generation, nnz))
+                           for (ti, tj, generation, nnz) in metadata['tiles'])
+        self._stats = None
+
+        if len(self.shape) != 3 or len(self.tile_shape) != 2:
+            raise ValueError("shape must be (Nx, Ny, Nt) and tile_shape "
+                             "(tile_x, tile_y)")
+        if min(self.shape + self.tile_shape) <= 0:
+            raise ValueError("shape and tile_shape must be positive")
+        # (pixel, time) keys of a tile must fit in an int64
+        if (np.prod(self.tile_shape, dtype=float) * self.shape[2]
+                >= 2. ** 63):
+            raise ValueError("tile_shape too large for the time dimension")
+
+        if not os.path.exists(metadata_path):
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            self._write_metadata()
+
+    @classmethod
+    def from_records(cls, path, records, shape, tile_shape=None, dtype=None):
+        """Create a cube at path holding (time, x, y, val) records"""
+        if dtype is None:
+            dtype = np.asarray(records)['val'].dtype
+        cube = cls(path, shape, tile_shape, dtype)
+        cube.append(records)
+        return cube
+
+    def __repr__(self):
+        return ("SparseCube('{0}', shape={1}, tile_shape={2}, "
+                "nnz={3})".format(self.path, self.shape, self.tile_shape,
+                                  self.nnz))
+
+    @property
+    def tiles(self):
+        """Sorted list of the (i_tile, j_tile) of all non-empty tiles"""
+        return sorted(self._tiles)
+
+    @property
+    def nnz(self):
+        """Number of stored cells"""
+        return sum(nnz for (generation, nnz) in self._tiles.values())
+
+    @property
+    def nbytes(self):
+        """Total size of the column files"""
+        return sum(os.path.getsize(self._column_path(tile, column))
+                   for tile in self._tiles for column in COLUMNS)
+
+    def _column_path(self, tile, column, generation=None):
+        if generation is None:
+            generation = self._tiles[tile][0]
+        return os.path.join(self.path, '{0}_{1}.{2}.{3}.npy'.format(
+            tile[0], tile[1], generation, column))
+
+    @property
+    def stats(self):
+        """The TileStats of the cube, computed on first use if needed"""
+        if self._stats is None:
+            path = os.path.join(self.path, self.stats_file)
+            if os.path.exists(path):
+                self._stats = TileStats.load(path)
+            else:
+                self._stats = TileStats.from_cube(self)
+        return self._stats
+
+    def index_bounds(self):
+        """[x_min, x_max, y_min, y_max, time_min, time_max] of the data"""
+        return self.stats.index_bounds()
+
+    def _write_stats(self):
+        fd, tmpfile = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                self._stats.save(f)
+            os.replace(tmpfile, os.path.join(self.path, self.stats_file))
+        except:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            raise
+
+    def _write_metadata(self):
+        metadata = {'shape': self.shape,
+                    'tile_shape': self.tile_shape,
+                    'dtype': self.dtype.str,
+                    'tiles': [[ti, tj, generation, nnz]
+                              for ((ti, tj), (generation, nnz))
+                              in sorted(self._tiles.items())]}
+        fd, tmpfile = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(metadata, f)
+            os.replace(tmpfile, os.path.join(self.path, self.metadata_file))
+        except:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            raise
+
+    def tile(self, tile):
+        """Return the memory-mapped columns of a tile
+
+        Returns
+        -------
+        pixel, indptr, time, val : ndarrays
+            ``pixel`` holds the sorted local index ``(x - x0) * tile_y +
+            (y - y0)`` of the non-empty pixels of the tile.  The times and
+            values of ``pixel[k]`` are ``time[indptr[k]:indptr[k + 1]]``
+            (sorted) and ``val[indptr[k]:indptr[k + 1]]``.  Empty columns
+            are returned for a tile with no data.
+        """
+        tile = tuple(tile)
+        if tile not in self._tiles:
+            return (np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64),
+                    np.zeros(0, dtype=np.int64), np.zeros(0, dtype=self.dtype))
+        return tuple(np.load(self._column_path(tile, column), mmap_mode='r')
+                     for column in COLUMNS)
+
+    def _tile_records(self, tile):
+        """Return the (time, x, y, val) records of a tile"""
+        pixel, indptr, time, val = self.tile(tile)
+        local = np.repeat(pixel, np.diff(indptr)).astype(np.int64)
+        records = np.empty(len(time), dtype=self.record_dtype)
+        records['time'] = time
+        tx, ty = self.tile_shape
+        records['x'] = int(tile[0]) * tx + local // ty
+        records['y'] = int(tile[1]) * ty + local % ty
+        records['val'] = val
+        return records
+
+    @property
+    def record_dtype(self):
+        return np.dtype([('time', np.int64), ('x', np.int64),
+                         ('y', np.int64), ('val', self.dtype)])
+
+    def append(self, records):
+        """Add (time, x, y, val) records to the cube
+
+        ``records`` may be a structured array, or a mapping of blocks of
+        records as returned by :func:`spheredb.util.partition_records`.
+        Values of existing cells are replaced.
+        """
+        if hasattr(records, 'values'):
+            records = list(records.values())
+            records = (np.concatenate(records) if records
+                       else np.zeros(0, dtype=self.record_dtype))
+        records = np.asarray(records)
+        for d, n in zip(self.dims, self.shape):
+            if len(records) and (records[d].min() < 0
+                                 or records[d].max() >= n):
+                raise ValueError("{0} values out of range for "
+                                 "the cube".format(d))
+
+        stats = self.stats
+        old_files = []
+        for tile, block in iter_tiles(records, self.tile_shape):
+            old_files.extend(self._merge_tile(tile, block))
+            stats.replace(cube_tile_summary((self, tile)))
+
+        self._write_stats()
+        self._write_metadata()
+        for path in old_files:
+            os.remove(path)
+
+    def append_sparse(self, M, time):
+        """Add the (Nx, Ny) sparse matrix M as time slice ``time``"""
+        M = M.tocoo()
+        if M.shape != self.shape[:2]:
+            raise ValueError("matrix shape must be (Nx, Ny) of the cube")
+        records = np.empty(M.nnz, dtype=self.record_dtype)
+        records['time'] = time
+        records['x'] = M.row
+        records['y'] = M.col
+        records['val'] = M.data
+        self.append(records)
+
+    def _merge_tile(self, tile, block):
+        """Write a new generation of a tile; return the superseded files"""
+        x0, y0 = (int(t) * n for (t, n) in zip(tile, self.tile_shape))
+        Nt = self.shape[2]
+
+        # compact records hold int32 indices: keys must be built in int64
+        bx, by, bt = (block[d].astype(np.int64) for d in ('x', 'y', 'time'))
+        pixel, indptr, time, val = self.tile(tile)
+        key = np.concatenate([np.repeat(pixel.astype(np.int64),
+                                        np.diff(indptr)) * Nt + time,
+                              ((bx - x0) * self.tile_shape[1]
+                               + by - y0) * Nt + bt])
+        values = np.concatenate([val, block['val'].astype(self.dtype)])
+
+        # new records come after old ones: 'last' replaces existing cells
+        key, values = reduce_duplicates(key, values, 'last')
+        local, time = np.divmod(key, Nt)
+        starts = np.concatenate([[True], local[1:] != local[:-1]])
+        pixel = local[starts]
+        indptr = np.concatenate([np.nonzero(starts)[0], [len(local)]])
+
+        if tile in self._tiles:
+            generation = self._tiles[tile][0] + 1
+            old_files = [self._column_path(tile, column)
+                         for column in COLUMNS]
+        else:
+            generation = 0
+            old_files = []
+
+        for column, data in zip(COLUMNS, (pixel, indptr, time, values)):
+            np.save(self._column_path(tile, column, generation), data)
+        self._tiles[tile] = (generation, len(values))
+        return old_files
+
+    def _tiles_in(self, x=None, y=None):
+        """Tiles overlapping the half-open ranges x and y"""
+        tiles = []
+        for tile in self.tiles:
+            for t, n, lim in zip(tile, self.tile_shape, (x, y)):
+                if lim is not None and ((lim[0] is not None
+                                         and (t + 1) * n <= lim[0]) or
+                                        (lim[1] is not None
+                                         and t * n >= lim[1])):
+                    break
+            else:
+                tiles.append(tile)
+        return tiles
+
+    def iter_records(self, x=None, y=None, time=None):
+        """Iterate over the records of each tile within the given ranges
+
+        Yields (tile, records) pairs, with records sorted by (x, y, time).
+        Tiles with no records in the ranges are skipped.
+        """
+        for tile in self._tiles_in(x, y):
+            records = self._tile_records(tile)
+            keep = np.ones(len(records), dtype=bool)
+            for d, lim in zip(self.dims, (x, y, time)):
+                if lim is None:
+                    continue
+                if lim[0] is not None:
+                    keep &= (records[d] >= lim[0])
+                if lim[1] is not None:
+                    keep &= (records[d] < lim[1])
+            if not np.all(keep):
+                records = records[keep]
+            if len(records):
+                yield tile, records
+
+    def subarray(self, x=None, y=None, time=None):
+        """Return the (time, x, y, val) records within the given ranges"""
+        blocks = [records for (tile, records)
+                  in self.iter_records(x, y, time)]
+        if not blocks:
+            return np.zeros(0, dtype=self.record_dtype)
+        return np.concatenate(blocks)
+
+    def to_records(self):
+        """Return all the records of the cube"""
+        return self.subarray()
+
+    def reduce(self, axes=None, func='sum', x=None, y=None, time=None):
+        """Reduce the cube over the given axes
+
+        Parameters
+        ----------
+        axes : str or tuple (optional)
+            names or numbers of the axes to reduce over (default all)
+        func : str
+            one of 'sum', 'mean', 'min', 'max' or 'count'.  Only stored
+            cells take part in the reduction.
+        x, y, time : tuple (optional)
+            half-open (start, stop) ranges restricting the input
+
+        Returns
+        -------
+        records : ndarray
+            structured array with one int64 field per remaining axis, in
+            the order (x, y, time), plus 'val', with one record per
+            non-empty output cell.
+        """
+        if func not in REDUCTIONS:
+            raise ValueError("reduction '{0}' not recognized".format(func))
+        if axes is None:
+            axes = self.dims
+        elif np.ndim(axes) == 0:
+            axes = (axes,)
+        axes = [a if a in self.dims else self.dims[a] for a in axes]
+        keep = [d for d in self.dims if d not in axes]
+        shape = [n for (d, n) in zip(self.dims, self.shape) if d in keep]
+
+        # partial reductions per tile, combined at the end
+        combine = {'mean': 'sum', 'count': 'sum'}.get(func, func)
+        index, values, counts = [], [], []
+        for tile, records in self.iter_records(x, y, time):
+            if keep:
+                i = np.ravel_multi_index([records[d] for d in keep], shape)
+            else:
+                i = np.zeros(len(records), dtype=np.int64)
+            ones = np.ones(len(records), dtype=np.int64)
+            if func == 'count':
+                i_tile, v = reduce_duplicates(i, ones)
+            else:
+                i_tile, v = reduce_duplicates(i, records['val'], combine)
+            if func == 'mean':
+                counts.append(reduce_duplicates(i, ones)[1])
+            index.append(i_tile)
+            values.append(v)
+
+        if index:
+            i_all = np.concatenate(index)
+            i, v = reduce_duplicates(i_all, np.concatenate(values), combine)
+            if func == 'mean':
+                v = v / reduce_duplicates(i_all, np.concatenate(counts))[1]
+        else:
+            i = np.zeros(0, dtype=np.int64)
+            v = np.zeros(0, dtype=np.int64 if func == 'count' else self.dtype)
+
+        out = np.empty(len(i), dtype=[(d, np.int64) for d in keep]
+                       + [('val', v.dtype)])
+        if keep:
+            for d, i_d in zip(keep, np.unravel_index(i, shape)):
+                out[d] = i_d
+        out['val'] = v
+        return out
+
+    def sum(self, axes=None, **ranges):
+        return self.reduce(axes, 'sum', **ranges)
+
+    def mean(self, axes=None, **ranges):
+        return self.reduce(axes, 'mean', **ranges)
+
+    def difference(self, time, reference=None, threshold=5.):
+        """Return the pixels of an epoch which differ from a reference
+
+        The reference of each pixel is the mean of its values at the times
+        within ``reference`` (a half-open (start, stop) range; default all
+        times), excluding ``time``.  The variance of the difference is
+        estimated from the scatter ``s**2`` of the ``n`` reference values
+        as ``s**2 * (1 + 1 / n)``, so only pixels with at least two
+        reference values can be detected.
+
+        The cube is processed one tile at a time: memory use is bounded by
+        the size of a tile plus the number of detections.
+
+        Returns
+        -------
+        records : ndarray
+            :data:`spheredb.query.DIFFERENCE_DTYPE` records (x, y, diff,
+            variance, snr) of the pixels with ``abs(snr) >= threshold``,
+            where ``diff`` is the epoch minus the reference and ``snr`` is
+            ``diff / sqrt(variance)``.
+        """
+        start, stop = (None, None) if reference is None else reference
+        dtype = DIFFERENCE_DTYPE
+        tx, ty = self.tile_shape
+        detections = [np.zeros(0, dtype=dtype)]
+
+        for tile in self.tiles:
+            pixel, indptr, times, val = self.tile(tile)
+            owner = np.repeat(np.arange(len(pixel)), np.diff(indptr))
+
+            epoch = np.empty(len(pixel))
+            epoch.fill(np.nan)
+            in_epoch = (times == time)
+            epoch[owner[in_epoch]] = val[in_epoch]
+
+            in_ref = ~in_epoch
+            if start is not None:
+                in_ref &= (times >= start)
+            if stop is not None:
+                in_ref &= (times < stop)
+            n = np.bincount(owner[in_ref], minlength=len(pixel))
+            total = np.bincount(owner[in_ref], val[in_ref],
+                                minlength=len(pixel))
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ref = total / n
+                resid = val[in_ref] - ref[owner[in_ref]]
+                scatter = np.bincount(owner[in_ref], resid ** 2,
+                                      minlength=len(pixel)) / (n - 1)
+                diff = epoch - ref
+                variance = scatter * (1. + 1. / n)
+                snr = diff / np.sqrt(variance)
+                detected = (n >= 2) & (abs(snr) >= threshold)
+
+            found = np.empty(detected.sum(), dtype=dtype)
+            local = pixel[detected]
+            found['x'] = tile[0] * tx + local // ty
+            found['y'] = tile[1] * ty + local % ty
+            found['diff'] = diff[detected]
+            found['variance'] = variance[detected]
+            found['snr'] = snr[detected]
+            detections.append(found)
+
+        return np.concatenate(detections)
+
+    def to_coo(self, time=None, func='sum'):
+        """Return an (Nx, Ny) coo_matrix of the cube
+
+        If ``time`` is an integer, return that time slice; otherwise
+        reduce over the (start, stop) range of times (default all) with
+        ``func``.
+        """
+        from scipy import sparse
+
+        if np.ndim(time) == 0 and time is not None:
+            records = self.subarray(time=(time, time + 1))
+        else:
+            records = self.reduce('time', func, time=time)
+        return sparse.coo_matrix((records['val'],
+                                  (records['x'], records['y'])),
+                                 shape=self.shape[:2])
@@ -0,0 +1,69 @@
+"""
+Header-only access to FITS metadata
+
+These functions parse FITS headers without reading any pixel data, which
+makes them suitable for scanning many files for metadata alone (e.g. to
+build a time index over a directory of exposures).
+"""
+import numpy as np
+
+__all__ = ['read_header', 'header_mjd', 'read_exposure_date',
+           'exposure_dates', 'mjd_to_seconds']
+
+MJD_KEYS = ('MJD-OBS', 'TAI')
+
+
+def read_header(fitsfile, hdunum=1):
+    """Read a single FITS header without reading the data
+
+    Parameters
+    ----------
+    fitsfile : str
+        path to the FITS file
+    hdunum : int
+        The number of the HDU to use (default = 1)
+
+    Returns
+    -------
+    header : astropy.io.fits.Header
+    """
+    from astropy.io import fits
+
+    return fits.getheader(fitsfile, hdunum)
+
+
+def header_mjd(header, keys=MJD_KEYS):
+    """Return the exposure MJD stored in a header
+
+    The first of ``keys`` present in the header is used.
+    """
+    for key in keys:
+        if key in header:
+            return float(header[key])
+    raise KeyError("none of {0} found in header".format(keys))
+
+
+def read_exposure_date(fitsfile, hdunum=1, keys=MJD_KEYS):
+    """Return the exposure MJD of a FITS file from its header alone
+
+    If the keyword is not found in HDU ``hdunum``, or if the file has no
+    such HDU (e.g. a single-HDU file), the primary header is checked as
+    well.
+    """
+    try:
+        return header_mjd(read_header(fitsfile, hdunum), keys)
+    except (KeyError, IndexError):
+        if hdunum == 0:
+            raise
+        return header_mjd(read_header(fitsfile, 0), keys)
+
+
+def exposure_dates(fitsfiles, hdunum=1, keys=MJD_KEYS):
+    """Return an array of exposure MJDs for a sequence of FITS files"""
+    return np.array([read_exposure_date(f, hdunum, keys)
+                     for f in fitsfiles], dtype=float)
+
+
+def mjd_to_seconds(mjd):
+    """Convert an MJD to the integer seconds used for the time dimension"""
+    return int(mjd * 24 * 60 * 60)
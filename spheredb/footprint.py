@@ -0,0 +1,460 @@
+"""
+Sky footprints of images
+
+The footprint of an image is computed from the WCS in its header alone,
+so that it can be found without reading any pixel data.
+"""
+import os
+
+import numpy as np
+
+from .hpx_utils import RAdec_to_HPX
+
+__all__ = ['image_boundary', 'image_samples', 'header_footprint',
+           'angular_separation', 'bounding_circle', 'HPX_bounds',
+           'HPX_wrap_bounds', 'split_HPX_bounds', 'HPXBox', 'Cone', 'Polygon',
+           'select_exposures']
+
+
+def image_boundary(Nx, Ny, n_per_side=1):
+    """Return pixel coordinates along the boundary of an image
+
+    Parameters
+    ----------
+    Nx, Ny : int
+        size of the image along the x (NAXIS1) and y (NAXIS2) axes
+    n_per_side : int
+        number of samples along each side, starting at a corner.
+        With n_per_side=1 only the four corners are returned.
+
+    Returns
+    -------
+    pix : ndarray, shape = (4 * n_per_side, 2)
+        zero-based (x, y) pixel coordinates, going around the image
+    """
+    t = np.arange(n_per_side, dtype=float) / n_per_side
+    xmax, ymax = Nx - 1., Ny - 1.
+    x = np.concatenate([t * xmax, xmax + 0 * t, (1 - t) * xmax, 0 * t])
+    y = np.concatenate([0 * t, t * ymax, ymax + 0 * t, (1 - t) * ymax])
+    return np.vstack([x, y]).T
+
+
+def image_samples(Nx, Ny, n_per_side=32, n_interior=8):
+    """Return pixel coordinates sampling the boundary and interior of an image
+
+    Parameters
+    ----------
+    Nx, Ny : int
+        size of the image along the x (NAXIS1) and y (NAXIS2) axes
+    n_per_side : int
+        number of samples along each side (see :func:`image_boundary`)
+    n_interior : int
+        the interior is sampled on a regular n_interior x n_interior grid
+
+    Returns
+    -------
+    pix : ndarray, shape = (n_samples, 2)
+        zero-based (x, y) pixel coordinates
+    """
+    t = (np.arange(n_interior) + 0.5) / n_interior
+    x, y = np.meshgrid(t * (Nx - 1), t * (Ny - 1))
+    return np.vstack([image_boundary(Nx, Ny, n_per_side),
+                      np.vstack([x.ravel(), y.ravel()]).T])
+
+
+def header_footprint(header, n_per_side=1):
+    """Return the RA/dec of points on the boundary of an image
+
+    Parameters
+    ----------
+    header : dict or FITS header
+        header containing the WCS and the image size (NAXIS1, NAXIS2)
+    n_per_side : int
+        number of samples along each side (see :func:`image_boundary`)
+
+    Returns
+    -------
+    RA, dec : ndarrays
+        boundary coordinates in degrees, with RA in the range [0, 360)
+    """
+    from astropy.wcs import WCS
+    wcs = WCS(header, fix=False)
+    pix = image_boundary(header['NAXIS1'], header['NAXIS2'], n_per_side)
+    RA, dec = wcs.wcs_pix2world(pix, 0).T
+    return RA % 360, dec
+
+
+def angular_separation(RA1, dec1, RA2, dec2):
+    """Angular separation in degrees between two points on the sky"""
+    RA1, dec1, RA2, dec2 = map(np.radians, (RA1, dec1, RA2, dec2))
+    sin_ddec = np.sin(0.5 * (dec2 - dec1))
+    sin_dRA = np.sin(0.5 * (RA2 - RA1))
+    a = sin_ddec ** 2 + np.cos(dec1) * np.cos(dec2) * sin_dRA ** 2
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(a, 0, 1))))
+
+
+def bounding_circle(RA, dec):
+    """Return a circle (RA, dec, radius) enclosing the given points
+
+    The center is the normalized mean of the points' unit vectors; this is
+    not the minimal circle, but it is close for compact footprints.
+    """
+    RA, dec = np.radians(RA), np.radians(dec)
+    xyz = np.array([np.cos(dec) * np.cos(RA),
+                    np.cos(dec) * np.sin(RA),
+                    np.sin(dec)]).mean(1)
+    RA_c = np.degrees(np.arctan2(xyz[1], xyz[0])) % 360
+    dec_c = np.degrees(np.arctan2(xyz[2], np.sqrt(xyz[0] ** 2 + xyz[1] ** 2)))
+    radius = angular_separation(RA_c, dec_c,
+                                np.degrees(RA), np.degrees(dec)).max()
+    return RA_c, dec_c, radius
+
+
+def HPX_bounds(RA, dec):
+    """Return (xmin, xmax, ymin, ymax) of points in HPX coordinates (deg)"""
+    x, y = RAdec_to_HPX(RA, dec)
+    return x.min(), x.max(), y.min(), y.max()
+
+
+def HPX_wrap_bounds(RA, dec):
+    """Return the HPX bounding boxes of points, split at the RA wrap
+
+    The single box of :func:`HPX_bounds` of a footprint straddling RA = 180
+    spans the whole plane.  Here, as in :func:`split_HPX_bounds`, the points
+    on either side of the wrap are bounded separately.
+
+    Returns
+    -------
+    boxes : list of one or two (xmin, xmax, ymin, ymax) tuples, in degrees
+    """
+    x, y = RAdec_to_HPX(RA, dec)
+    x, y = x.ravel(), y.ravel()
+    return [(x[group].min(), x[group].max(), y[group].min(), y[group].max())
+            for group in _wrap_groups(x)]
+
+
+def _wrap_groups(x):
+    """Masks of the points on each side of the wrap, if they straddle it"""
+    if x.max() - x.min() > 180.:
+        return [x < 0, x >= 0]
+    return [np.ones(len(x), dtype=bool)]
+
+
+# In the HPX plane (H=4, K=3) the equatorial band |y| <= 45 is contiguous
+# apart from the wrap at x = +/-180.  Above and below it, the plane is split
+# into four polar facets, each 90 degrees wide in x, whose apexes are the
+# images of the poles.
+HPX_POLAR_Y = 45.
+HPX_FACET_WIDTH = 90.
+
+
+def HPX_regions(x, y):
+    """Label HPX-plane points by the contiguous region they fall in
+
+    Returns 0 for the equatorial band, 1 + column (1-4) for the north polar
+    facets and 5 + column (5-8) for the south polar facets.
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    column = np.clip(np.floor((x + 180.) / HPX_FACET_WIDTH), 0, 3)
+    return np.where(y > HPX_POLAR_Y, 1 + column,
+                    np.where(y < -HPX_POLAR_Y, 5 + column, 0)).astype(int)
+
+
+def HPX_valid(x, y):
+    """Test whether HPX-plane points lie on the projected sphere
+
+    Points in the triangular gaps between the polar facets do not correspond
+    to any position on the sky.
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    x_c = -180. + HPX_FACET_WIDTH * (np.clip(np.floor((x + 180.) /
+                                                      HPX_FACET_WIDTH),
+                                             0, 3) + 0.5)
+    return (abs(y) <= 90.) & ((abs(y) <= HPX_POLAR_Y) |
+                              (abs(x - x_c) <= 90. - abs(y)))
+
+
+def HPX_pole_points(north=True):
+    """Return the (x, y) HPX-plane images of a pole (the facet apexes)"""
+    x = -180. + HPX_FACET_WIDTH * (np.arange(4) + 0.5)
+    return x, np.zeros(4) + (90. if north else -90.)
+
+
+def split_HPX_bounds(x, y, pad=0.):
+    """Split the HPX-plane extent of a set of points into tight boxes
+
+    A single bounding box of a footprint which straddles the RA wrap or a
+    polar facet seam spans most of the plane.  Here the points are grouped
+    by the contiguous region of the HPX plane they fall in (splitting the
+    equatorial band at the wrap when needed), and a box is returned for each
+    group.
+
+    Parameters
+    ----------
+    x, y : array_like
+        HPX-plane coordinates (degrees) of points sampling the footprint,
+        including its boundary
+    pad : float
+        padding (degrees) added to each box to account for the spacing of
+        the samples.  Boxes are clipped to the region they belong to.
+
+    Returns
+    -------
+    boxes : list of (xmin, xmax, ymin, ymax) tuples, in degrees
+    """
+    x = np.asarray(x, dtype=float).ravel()
+    y = np.asarray(y, dtype=float).ravel()
+    good = np.isfinite(x) & np.isfinite(y)
+    x, y = x[good], y[good]
+    labels = HPX_regions(x, y)
+
+    boxes = []
+    for label in np.unique(labels):
+        xl, yl = x[labels == label], y[labels == label]
+        if label == 0:
+            xlim = (-180., 180.)
+            groups = _wrap_groups(xl)
+        else:
+            column = (label - 1) % 4
+            xlim = (-180. + HPX_FACET_WIDTH * column,
+                    -180. + HPX_FACET_WIDTH * (column + 1))
+            groups = [np.ones(len(xl), dtype=bool)]
+
+        for group in groups:
+            boxes.append((max(xlim[0], xl[group].min() - pad),
+                          min(xlim[1], xl[group].max() + pad),
+                          max(-90., yl[group].min() - pad),
+                          min(90., yl[group].max() + pad)))
+    return boxes
+
+
+def sample_spacing(x, y, max_step=10.):
+    """Largest step between consecutive HPX-plane samples, ignoring jumps
+    across seams (steps larger than max_step degrees)"""
+    step = np.maximum(abs(np.diff(x)), abs(np.diff(y)))
+    step = step[np.isfinite(step) & (step < max_step)]
+    return step.max() if len(step) else 0.
+
+
+def _gnomonic(RA, dec, RA0, dec0):
+    """Project points onto the plane tangent to the sphere at (RA0, dec0)"""
+    RA, dec, RA0, dec0 = map(np.radians, (RA, dec, RA0, dec0))
+    cos_c = (np.sin(dec0) * np.sin(dec) +
+             np.cos(dec0) * np.cos(dec) * np.cos(RA - RA0))
+    xi = np.cos(dec) * np.sin(RA - RA0) / cos_c
+    eta = (np.cos(dec0) * np.sin(dec) -
+           np.sin(dec0) * np.cos(dec) * np.cos(RA - RA0)) / cos_c
+    return xi, eta
+
+
+def points_in_polygon(x, y, px, py):
+    """Test whether points (x, y) lie inside the planar polygon (px, py)"""
+    x, y = np.broadcast_arrays(*map(np.atleast_1d, (x, y)))
+    px, py = np.asarray(px, dtype=float), np.asarray(py, dtype=float)
+    x1, y1 = px[:, None], py[:, None]
+    x2, y2 = np.roll(px, -1)[:, None], np.roll(py, -1)[:, None]
+
+    # ray casting in the +x direction
+    crosses = ((y1 > y) != (y2 > y))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+    return np.sum(crosses & (x < x_cross), 0) % 2 == 1
+
+
+def polygons_intersect(ax, ay, bx, by):
+    """Test whether two simple planar polygons overlap"""
+    if (np.any(points_in_polygon(ax, ay, bx, by)) or
+            np.any(points_in_polygon(bx, by, ax, ay))):
+        return True
+
+    # otherwise they overlap only if two edges cross
+    ax1, ay1 = np.asarray(ax, dtype=float)[:, None], np.asarray(ay)[:, None]
+    ax2, ay2 = np.roll(ax1, -1, 0), np.roll(ay1, -1, 0)
+    bx1, by1 = np.asarray(bx, dtype=float), np.asarray(by, dtype=float)
+    bx2, by2 = np.roll(bx1, -1), np.roll(by1, -1)
+
+    def orient(px, py, qx, qy, rx, ry):
+        return np.sign((qx - px) * (ry - py) - (qy - py) * (rx - px))
+
+    return bool(np.any((orient(ax1, ay1, ax2, ay2, bx1, by1) !=
+                        orient(ax1, ay1, ax2, ay2, bx2, by2)) &
+                       (orient(bx1, by1, bx2, by2, ax1, ay1) !=
+                        orient(bx1, by1, bx2, by2, ax2, ay2))))
+
+
+class HPXBox(object):
+    """A rectangular region in HPX coordinates (degrees)"""
+    def __init__(self, xmin, xmax, ymin, ymax):
+        self.bounds = (xmin, xmax, ymin, ymax)
+
+    def HPX_bounds(self):
+        return self.bounds
+
+    def intersects(self, RA, dec):
+        """Test whether the footprint with boundary (RA, dec) overlaps"""
+        return any(_bounds_overlap(self.bounds, box)
+                   for box in HPX_wrap_bounds(RA, dec))
+
+
+class Cone(object):
+    """A circular region of the sky (all quantities in degrees)"""
+    def __init__(self, RA, dec, radius):
+        self.RA = RA
+        self.dec = dec
+        self.radius = radius
+
+    def boundary(self, n_points=64):
+        """RA/dec of points on the boundary of the cone"""
+        theta = np.linspace(0, 2 * np.pi, n_points, endpoint=False)
+        r = np.radians(self.radius)
+        RA0, dec0 = np.radians(self.RA), np.radians(self.dec)
+        dec = np.arcsin(np.sin(dec0) * np.cos(r) +
+                        np.cos(dec0) * np.sin(r) * np.cos(theta))
+        RA = RA0 + np.arctan2(np.sin(theta) * np.sin(r) * np.cos(dec0),
+                              np.cos(r) - np.sin(dec0) * np.sin(dec))
+        return np.degrees(RA) % 360, np.degrees(dec)
+
+    def HPX_bounds(self):
+        RA, dec = self.boundary()
+        xmin, xmax, ymin, ymax = HPX_bounds(np.append(RA, self.RA),
+                                            np.append(dec, self.dec))
+        if self.dec + self.radius >= 90:
+            xmin, xmax, ymax = -180., 180., 90.
+        if self.dec - self.radius <= -90:
+            xmin, xmax, ymin = -180., 180., -90.
+        return xmin, xmax, ymin, ymax
+
+    def intersects(self, RA, dec):
+        """Test whether the footprint with boundary (RA, dec) overlaps"""
+        RA, dec = np.asarray(RA, dtype=float), np.asarray(dec, dtype=float)
+        RA_c, dec_c, radius = bounding_circle(RA, dec)
+        if angular_separation(self.RA, self.dec, RA_c, dec_c) > \
+                self.radius + radius:
+            return False
+
+        # the center of the cone inside the footprint
+        xi, eta = _gnomonic(RA, dec, RA_c, dec_c)
+        xi0, eta0 = _gnomonic(self.RA, self.dec, RA_c, dec_c)
+        if points_in_polygon(xi0, eta0, xi, eta)[0]:
+            return True
+
+        # the footprint boundary within the cone, to within the spacing of
+        # the boundary samples
+        spacing = angular_separation(RA, dec, np.roll(RA, 1), np.roll(dec, 1))
+        sep = angular_separation(self.RA, self.dec, RA, dec)
+        return bool(np.any(sep <= self.radius + 0.5 * spacing.max()))
+
+
+class Polygon(object):
+    """A polygonal region of the sky, defined by its vertices (degrees)
+
+    The polygon should be small enough (less than a hemisphere) for its
+    edges to be well approximated in a tangent-plane projection.
+    """
+    def __init__(self, RA, dec):
+        self.RA = np.asarray(RA, dtype=float) % 360
+        self.dec = np.asarray(dec, dtype=float)
+        self.RA_c, self.dec_c, self.radius = bounding_circle(self.RA,
+                                                             self.dec)
+
+    def HPX_bounds(self):
+        return HPX_bounds(self.RA, self.dec)
+
+    def intersects(self, RA, dec):
+        """Test whether the footprint with boundary (RA, dec) overlaps"""
+        RA_c, dec_c, radius = bounding_circle(RA, dec)
+        if angular_separation(self.RA_c, self.dec_c, RA_c, dec_c) > \
+                self.radius + radius:
+            return False
+        return polygons_intersect(*(_gnomonic(self.RA, self.dec,
+                                              self.RA_c, self.dec_c) +
+                                    _gnomonic(RA, dec,
+                                              self.RA_c, self.dec_c)))
+
+
+def _bounds_overlap(b1, b2):
+    return (b1[0] <= b2[1] and b2[0] <= b1[1] and
+            b1[2] <= b2[3] and b2[2] <= b1[3])
+
+
+def _bounds_intersection(b1, b2):
+    return (max(b1[0], b2[0]), min(b1[1], b2[1]),
+            max(b1[2], b2[2]), min(b1[3], b2[3]))
+
+
+def select_exposures(files, region=None, time_window=None, catalog=None,
+                     hdunum=1, n_per_side=8):
+    """Select the exposures which overlap a region and a time window
+
+    Parameters
+    ----------
+    files : list of str
+        paths of the exposures
+    region : HPXBox, Cone or Polygon (optional)
+        the region of interest.  If not specified, exposures are selected
+        by time alone.
+    time_window : tuple (optional)
+        (tmin, tmax) bounds on the exposure MJD.  Either may be None.
+    catalog : ExposureCatalog (optional)
+        if specified, footprints and times of the files are taken from the
+        catalog (using the footprint corners) rather than from the headers.
+    hdunum : int
+        HDU of the header holding the WCS (default = 1)
+    n_per_side : int
+        number of boundary samples along each side of the chips when
+        footprints are computed from the headers (default = 8)
+
+    Returns
+    -------
+    selected : list of (path, bounds) tuples
+        ``bounds`` is the (xmin, xmax, ymin, ymax) box in HPX degrees of the
+        part of the chip overlapping the region, or None if no region was
+        given.  Only the overlapping part of a chip needs to be warped.  A
+        chip straddling the RA wrap (see :func:`HPX_wrap_bounds`) has one
+        entry for each side of the wrap overlapping the region.
+    """
+    from .fits_headers import read_header, header_mjd
+
+    entries = {}
+    if catalog is not None:
+        for row in catalog.query():
+            entries[row['path']] = row
+
+    tmin, tmax = (None, None) if time_window is None else time_window
+    region_bounds = None if region is None else region.HPX_bounds()
+
+    selected = []
+    for path in files:
+        row = entries.get(os.path.abspath(path))
+        if row is not None:
+            mjd = row['mjd']
+        else:
+            header = read_header(path, hdunum)
+            mjd = header_mjd(header)
+
+        if (tmin is not None and mjd < tmin) or \
+                (tmax is not None and mjd > tmax):
+            continue
+
+        if region is None:
+            selected.append((path, None))
+            continue
+
+        if row is not None:
+            RA = np.array([row['ra{0}'.format(i)] for i in range(4)])
+            dec = np.array([row['dec{0}'.format(i)] for i in range(4)])
+            boxes = [tuple(row['hpx_{0}{1}'.format(c, suffix)]
+                           for c in ('xmin', 'xmax', 'ymin', 'ymax'))
+                     for suffix in ('', '2')]
+            boxes = [box for box in boxes if not np.isnan(box[0])]
+        else:
+            RA, dec = header_footprint(header, n_per_side)
+            boxes = HPX_wrap_bounds(RA, dec)
+
+        if region.intersects(RA, dec):
+            for box in boxes:
+                if _bounds_overlap(region_bounds, box):
+                    selected.append((path, _bounds_intersection(
+                        region_bounds, box)))
+
+    return selected
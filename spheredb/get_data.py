@@ -2,12 +2,11 @@
 
 import os
 import re
-import urllib2
+import shutil
+import tempfile
 from bz2 import BZ2File
-from StringIO import StringIO
-
-import pyfits
-from astroML.datasets.tools import download_with_progress_bar
+from multiprocessing import Pool
+from urllib.request import urlopen
 
 
 URL = "http://data.sdss3.org/dr10/env/BOSS_PHOTOOBJ/frames/{rerun}/{run}/{camcol}/frame-{filter}-{run:06d}-{camcol}-{framenum:04d}.fits.bz2"
@@ -23,43 +22,178 @@ def get_stripe82_url(rerun, run, camcol=1, filter='u', framenum=1):
 
 def get_stripe82_file(rerun, run, camcol=1, filter='u', framenum=1):
     """Get a Stripe 82 FITS file"""
+    from astropy.io import fits
+
     data_url = get_stripe82_url(rerun, run, camcol, filter, framenum)
     local_file = os.path.split(data_url)[-1]
 
     if os.path.exists(local_file):
-        print "using local image:", local_file
+        print("using local image:", local_file)
     else:
-        buf = download_with_progress_bar(data_url, return_buffer=True)
-        open(local_file, 'wb').write(buf.read())
-
-    bz2f = BZ2File(local_file)
-    hdulist = pyfits.open(StringIO(bz2f.read()))
-
-    return hdulist
+        print("downloading", data_url)
+        download(data_url, local_file)
+
+    return fits.open(decompress_bz2(local_file), memmap=True)
+
+
+def download(url, local_file, chunk_size=2 ** 20):
+    """Download a file, streaming it to disk in chunks
+
+    The data is written to a temporary file which is renamed once the
+    download is complete, so that an interrupted download does not leave
+    a truncated file behind.
+    """
+    local_dir = os.path.dirname(os.path.abspath(local_file))
+    fd, tmpfile = tempfile.mkstemp(dir=local_dir)
+    try:
+        with os.fdopen(fd, 'wb') as dst:
+            src = urlopen(url)
+            try:
+                shutil.copyfileobj(src, dst, chunk_size)
+            finally:
+                src.close()
+        os.rename(tmpfile, local_file)
+    except:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+    return local_file
+
+
+def decompress_bz2(bz2file, fitsfile=None, chunk_size=2 ** 20):
+    """Decompress a bz2 file to disk, streaming in chunks
+
+    Parameters
+    ----------
+    bz2file : str
+        path of the compressed file
+    fitsfile : str (optional)
+        path of the decompressed file.  By default the name of bz2file
+        with the '.bz2' extension removed.
+    chunk_size : int
+        number of bytes decompressed at once (default = 1MB)
+
+    Returns
+    -------
+    fitsfile : str
+        path of the decompressed file.  If it already exists and is newer
+        than bz2file, it is not decompressed again.
+    """
+    if fitsfile is None:
+        if bz2file.endswith('.bz2'):
+            fitsfile = bz2file[:-4]
+        else:
+            fitsfile = bz2file + '.out'
+
+    if (os.path.exists(fitsfile) and
+            os.path.getmtime(fitsfile) >= os.path.getmtime(bz2file)):
+        return fitsfile
+
+    # decompress to a temporary file so that an interrupted run does not
+    # leave a truncated file in the cache
+    fitsdir = os.path.dirname(os.path.abspath(fitsfile))
+    fd, tmpfile = tempfile.mkstemp(dir=fitsdir)
+    try:
+        with os.fdopen(fd, 'wb') as dst:
+            src = BZ2File(bz2file)
+            try:
+                shutil.copyfileobj(src, dst, chunk_size)
+            finally:
+                src.close()
+        os.rename(tmpfile, fitsfile)
+    except:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+    return fitsfile
+
+
+def _process_frame(args):
+    from astropy.io import fits
+
+    bz2file, func = args
+    fitsfile = decompress_bz2(bz2file)
+    if func is None:
+        return fitsfile
+
+    hdulist = fits.open(fitsfile, memmap=True)
+    try:
+        return func(hdulist)
+    finally:
+        hdulist.close()
+
+
+def process_stripe82_frames(bz2files, func=None, processes=None):
+    """Decompress and process local Stripe 82 frames in a worker pool
+
+    Parameters
+    ----------
+    bz2files : list of str
+        paths of local ``.fits.bz2`` frames.  Nothing is downloaded.
+    func : function (optional)
+        function applied in the worker to each (memory-mapped) hdulist.
+        It must be picklable, i.e. defined at module level.
+    processes : int (optional)
+        the number of worker processes.  By default the number of cpus.
+
+    Returns
+    -------
+    results : list
+        the result of func for each frame, or the paths of the decompressed
+        files if func is None.
+    """
+    args = [(f, func) for f in bz2files]
+    if processes == 1:
+        return list(map(_process_frame, args))
+
+    pool = Pool(processes)
+    try:
+        return pool.map(_process_frame, args)
+    finally:
+        pool.close()
+        pool.join()
 
 
 def all_lsst_files(lsst_dir=LSST_DIR):
-    R = re.compile("^S[0-2][0-2]\.fits$")
-    exposures = []
+    R = re.compile(r"^S[0-2][0-2]\.fits$")
     for dirpath, dirnames, filenames in os.walk(lsst_dir):
         for f in filter(R.match, filenames):
             yield os.path.join(dirpath, f)
 
 
 def all_lsst_exposures(lsst_dir=LSST_DIR):
+    from astropy.io import fits
+
     for f in all_lsst_files(lsst_dir):
-        yield pyfits.open(f)
+        yield fits.open(f)
+
+
+def lsst_exposure_catalog(lsst_dir=LSST_DIR, db_path=None, **kwargs):
+    """Return an up-to-date ExposureCatalog of all LSST chips in lsst_dir
+
+    The catalog is stored in ``db_path`` (default: ``catalog.db`` within
+    lsst_dir).  Only new or modified chips have their headers scanned.
+    Additional keyword arguments are passed to ExposureCatalog.update.
+    """
+    from .catalog import ExposureCatalog
+
+    if db_path is None:
+        db_path = os.path.join(lsst_dir, 'catalog.db')
+    catalog = ExposureCatalog(db_path)
+    catalog.update(all_lsst_files(lsst_dir), prune=True, **kwargs)
+    return catalog
 
 
 
 def get_LSST_file(lsst_dir=LSST_DIR,
                   loc='v865833781-fr/R21/S12.fits'):
-    R = re.compile("^S[0-2][0-2]\.fits$")
+    from astropy.io import fits
 
     path = os.path.join(os.path.abspath(lsst_dir), loc)
     if not os.path.exists(path):
         raise ValueError("Cannot find file {0}".format(path))
-    hdulist = pyfits.open(path)
+    hdulist = fits.open(path)
     return hdulist
 
 
@@ -70,7 +204,7 @@ def _plot_test():
     framenum=18
 
     for rerun in [2700, 2703]:
-        hdulist = get_file(301, rerun, 1, 'g', framenum)
+        hdulist = get_stripe82_file(rerun, 301, 1, 'g', framenum)
         im = hdulist[0].data
         plt.figure()
         plt.imshow(np.log10(im), cmap=plt.cm.binary)
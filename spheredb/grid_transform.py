@@ -0,0 +1,110 @@
+"""
+Approximate coordinate transforms on regular grids
+
+Projecting the HPX grid back to image coordinates evaluates the full WCS
+chain at every grid point, although the result varies smoothly across an
+image.  A CoarseGridTransform evaluates the transform on a coarse sub-grid
+only and interpolates the rest, refining the sub-grid until a given error
+tolerance is met (see the ``wcs_tol`` option of
+:func:`spheredb.conversions.FITS_to_HPX`).
+"""
+import numpy as np
+
+__all__ = ['CoarseGridTransform']
+
+
+class CoarseGridTransform(object):
+    """Approximate a smooth 2D transform on a regular grid
+
+    The exact transform is evaluated on a coarse sub-grid, and the rest of
+    the grid is filled in by bicubic spline interpolation.  The error of
+    the interpolation is measured at the centers of the coarse cells (where
+    it is largest for a smooth transform); if it exceeds ``tol``, the
+    coarse grid is refined, down to ``min_spacing``, after which the
+    transform is evaluated exactly.
+
+    Parameters
+    ----------
+    func : function
+        the exact transform, mapping an array of shape (n_samples, 2) to an
+        array of shape (n_samples, 2)
+    tol : float
+        maximum absolute error allowed on each output coordinate
+    spacing : int
+        initial spacing of the coarse grid, in grid steps (default = 16)
+    min_spacing : int
+        smallest spacing tried before falling back to the exact transform
+        (default = 4)
+
+    Calling
+    -------
+    Call with the 1D coordinates x (length nx) and y (length ny) of the
+    grid.  The result has shape (ny, nx, 2), with the transform of the
+    point (x[i], y[j]) at [j, i].  The number of exact evaluations is
+    accumulated in ``n_evaluations``, and the measured error of the last
+    approximation in ``max_error`` (zero if evaluated exactly).
+    """
+    def __init__(self, func, tol, spacing=16, min_spacing=4):
+        if min_spacing < 2 or spacing < min_spacing:
+            raise ValueError("spacing must satisfy "
+                             "2 <= min_spacing <= spacing")
+        self.func = func
+        self.tol = tol
+        self.spacing = int(spacing)
+        self.min_spacing = int(min_spacing)
+        self.n_evaluations = 0
+        self.max_error = 0
+
+    def _evaluate(self, x, y):
+        X = np.vstack([np.ravel(a) for a in np.meshgrid(x, y)]).T
+        self.n_evaluations += len(X)
+        return np.asarray(self.func(X), dtype=float).reshape(len(y), len(x),
+                                                             2)
+
+    def __call__(self, x, y):
+        from scipy.interpolate import RectBivariateSpline
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+
+        spacing = self.spacing
+        while spacing >= self.min_spacing:
+            ix = _nodes(len(x), spacing)
+            iy = _nodes(len(y), spacing)
+            spacing //= 2
+
+            # a cubic spline needs four nodes on each axis
+            if len(ix) < 4 or len(iy) < 4:
+                continue
+
+            # the coarse nodes and check points must be much fewer than
+            # the points of the grid, or there is nothing to gain
+            if 8 * len(ix) * len(iy) > len(x) * len(y):
+                break
+
+            coarse = self._evaluate(x[ix], y[iy])
+            if not np.all(np.isfinite(coarse)):
+                break
+
+            splines = [RectBivariateSpline(y[iy], x[ix], coarse[:, :, k],
+                                           kx=3, ky=3, s=0)
+                       for k in range(2)]
+
+            xc = 0.5 * (x[ix[1:]] + x[ix[:-1]])
+            yc = 0.5 * (y[iy[1:]] + y[iy[:-1]])
+            check = self._evaluate(xc, yc)
+            error = max(np.max(abs(spline(yc, xc) - check[:, :, k]))
+                        for (k, spline) in enumerate(splines))
+            if not error <= self.tol:
+                continue
+
+            self.max_error = error
+            return np.dstack([spline(y, x) for spline in splines])
+
+        self.max_error = 0
+        return self._evaluate(x, y)
+
+
+def _nodes(n, spacing):
+    """Indices of the coarse nodes of an axis of length n"""
+    return np.unique(np.concatenate([np.arange(0, n, spacing), [n - 1]]))
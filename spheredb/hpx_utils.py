@@ -108,3 +108,101 @@ def HPX_to_RAdec(x, y):
     dec[extreme] = y[extreme]
 
     return RA, dec
+
+
+class HPXGridTable(object):
+    """Lookup tables for the sky positions of an HPX grid of fixed Nside
+
+    The grid point (i, j) lies at x = (i + offset) * step - 180 and
+    y = (j + offset) * step - 90 in the HPX plane, with step = 45 / Nside
+    and i in [0, 8 * Nside): columns are counted from the RA = 180 wrap, as
+    in the records of :func:`spheredb.conversions.FITS_to_HPX` and the
+    default origin of :func:`spheredb.photometry.source_grid_coords`.
+    Its declination depends only on the
+    row j, and its RA is ``x_c + (x - x_c) * scale``, where the facet center
+    x_c depends only on the column i and the scale only on the row j.  The
+    tables hold these per-row and per-column terms, so that the conversion
+    of grid indices is a gather plus one multiply-add.
+
+    Use :func:`HPX_grid_table` to get a shared, memoized instance.
+
+    Parameters
+    ----------
+    Nside : int
+        HEALPix gridding parameter
+    offset : float
+        offset of the points within the grid cells (default = 0, the
+        grid nodes used by :mod:`spheredb.conversions`; use 0.5 for cell
+        centers)
+    """
+    def __init__(self, Nside, offset=0.):
+        self.Nside = Nside
+        self.offset = offset
+        self.step = 45. / Nside
+
+        # all columns and rows on or within the HPX plane
+        n_rows = 4 * Nside + (1 if offset == 0 else 0)
+        x = (np.arange(8 * Nside) + offset) * self.step - 180.
+        y = (np.arange(n_rows) + offset) * self.step - 90.
+
+        # per-row terms: evaluate the exact transform at the facet centers
+        # (where RA = x) and one step away from them
+        x_c = -180. + (2 * np.floor((x + 180.) / 90.) + 1) * 45.
+        self.dec = HPX_to_RAdec(45. + np.zeros_like(y), y)[1]
+        self.scale = HPX_to_RAdec(45. + 1. + np.zeros_like(y), y)[0] - 45.
+
+        # per-column terms
+        self.x_c = x_c
+        self.dx = x - x_c
+
+    def __repr__(self):
+        return 'HPXGridTable(Nside={0}, offset={1})'.format(self.Nside,
+                                                           self.offset)
+
+    @property
+    def shape(self):
+        """Number of (columns, rows) of the grid"""
+        return len(self.x_c), len(self.dec)
+
+    def RAdec(self, i, j):
+        """Return the (RA, dec) in degrees of grid indices (i, j)
+
+        i and j are broadcast against each other.  RA is in the range
+        [-180, 180), as returned by :func:`HPX_to_RAdec`.
+        """
+        i = np.asarray(i)
+        j = np.asarray(j)
+        if (np.any(i < 0) or np.any(i >= len(self.x_c)) or
+                np.any(j < 0) or np.any(j >= len(self.dec))):
+            raise ValueError("grid indices out of range")
+        return self.x_c[i] + self.dx[i] * self.scale[j], self.dec[j] + 0 * i
+
+    def RAdec_grid(self, i, j):
+        """Return the (RA, dec) of all points of the grid i x j
+
+        i and j are 1D arrays of indices; the outputs have shape
+        (len(j), len(i)).
+        """
+        i = np.asarray(i)[None, :]
+        j = np.asarray(j)[:, None]
+        return self.RAdec(i, j)
+
+
+_GRID_TABLES = {}
+
+
+def HPX_grid_table(Nside, offset=0.):
+    """Return the memoized HPXGridTable of an Nside"""
+    key = (Nside, offset)
+    if key not in _GRID_TABLES:
+        _GRID_TABLES[key] = HPXGridTable(Nside, offset)
+    return _GRID_TABLES[key]
+
+
+def HPX_grid_to_RAdec(i, j, Nside, offset=0.):
+    """Convert HPX grid indices to RA/dec using memoized lookup tables
+
+    See :class:`HPXGridTable`: the point (i, j) is at
+    x = (i + offset) * 45 / Nside - 180 and y = (j + offset) * 45 / Nside - 90.
+    """
+    return HPX_grid_table(Nside, offset).RAdec(i, j)
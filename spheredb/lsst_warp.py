@@ -9,22 +9,54 @@ After install, run the following (adapting for your install path):
 [~]$ source ~/LSST_STACK/loadLSST.sh
 [~]$ setup python
 [~]$ setup afw
+
+The stack is imported by the methods which use it, so that this module
+(and spheredb.scidb_tools) can be imported where it is not set up.
 """
-import lsst.afw.image as afwImage
-import lsst.afw.math as afwMath
-import lsst.daf.base as dafBase
+from timeit import default_timer
 
 import numpy as np
 
+from .fits_headers import read_exposure_date
+from .records import DEFAULT_SCHEMA
+from .metrics import NULL_METRICS
+
 
 class LSSTWarper(object):
-    """Tools to warp input fits data to a HEALPix grid."""
+    """Tools to warp input fits data to a HEALPix grid.
+
+    The destination WCS and the warper are built once per
+    ``(cdelt, cunit, kernel)`` and reused for every file warped by this
+    instance.  The number of setups and the total time spent on them are
+    kept in ``n_setups`` and ``setup_time``; pass ``cache_setup=False`` to
+    rebuild them per file for comparison.
+
+    If ``cache`` (a :class:`spheredb.warp_cache.WarpCache`) is given, the
+    sparse warped output of each file is stored there and reused whenever
+    the same file is warped again with the same parameters.
+
+    ``schema`` (a :class:`spheredb.records.RecordSchema`) sets the layout
+    of the pixel records uploaded to SciDB, and the size of the time
+    dimension.
+
+    If ``metrics`` (a :class:`spheredb.metrics.Metrics`) is given, the
+    time spent reading, warping, sparsifying, uploading and redimensioning
+    is recorded there, along with pixel and byte counts.
+    """
     def __init__(self, cunit='arcsec', cdelt=1, kernel='lanczos2',
-                 interface=None):
+                 interface=None, cache_setup=True, cache=None, schema=None,
+                 metrics=None):
         self.kernel = kernel
         self.cdelt = cdelt
         self.cunit = cunit.lower().strip()
         self.interface = interface
+        self.cache_setup = cache_setup
+        self.cache = cache
+        self.schema = DEFAULT_SCHEMA if schema is None else schema
+        self.metrics = NULL_METRICS if metrics is None else metrics
+        self.n_setups = 0
+        self.setup_time = 0.
+        self._setup_cache = {}
         if self.cunit not in ['deg', 'arcmin', 'arcsec']:
             raise ValueError("cunit='{0}' not recognized".format(self.cunit))
 
@@ -62,10 +94,13 @@ class LSSTWarper(object):
 
     @property
     def Nt(self):
-        return int(100000 * 24 * 60 * 60)
+        return self.schema.Nt
 
     def make_wcs(self):
         """Construct a HEALPix WCS header"""
+        import lsst.afw.image as afwImage
+        import lsst.daf.base as dafBase
+
         ps = dafBase.PropertySet()
         ps.add('NAXIS', 2)
         ps.add('CTYPE1', 'RA---HPX')
@@ -80,29 +115,131 @@ class LSSTWarper(object):
         ps.add('CRPIX2', 0)
         return afwImage.makeWcs(ps)
 
+    def make_warper(self):
+        """Construct a warper for the current kernel"""
+        import lsst.afw.math as afwMath
+        return afwMath.Warper(self.kernel)
+
+    def warp_setup(self):
+        """Return the (destination WCS, warper) pair for the current settings
+
+        The pair is cached per ``(cdelt, cunit, kernel)`` unless
+        ``cache_setup`` is False.
+        """
+        if not self.cache_setup:
+            return self.make_wcs(), self.make_warper()
+
+        key = (self.cdelt, self.cunit, self.kernel)
+        try:
+            return self._setup_cache[key]
+        except KeyError:
+            setup = (self.make_wcs(), self.make_warper())
+            self._setup_cache[key] = setup
+            return setup
+
+    def clear_setup_cache(self):
+        """Drop cached destination WCS and warper objects"""
+        self._setup_cache.clear()
+
+    def exposure_from_fits(self, fitsfile):
+        """Read an LSST exposure (metadata and pixels) from a fits file"""
+        import lsst.afw.image as afwImage
+        with self.metrics.stage('read'):
+            return afwImage.ExposureF(fitsfile)
+
+    @staticmethod
+    def exposure_date(exposure):
+        """Return the MJD of an exposure which has already been read"""
+        return exposure.getMetadata().get('MJD-OBS')
+
     def get_exposure_date(self, fitsfile):
-        metadata = afwImage.ExposureF(fitsfile).getMetadata()
-        return metadata.get('MJD-OBS')
-
-    def warped_from_fits(self, fitsfile):
-        """Return a warped exposure computed from an LSST exposure"""
-        exp = afwImage.ExposureF(fitsfile)
-        wcs_in = exp.getWcs()
-        wcs_out = self.make_wcs()
-        warper = afwMath.Warper(self.kernel)
-        warpedExposure = warper.warpExposure(destWcs=wcs_out,
-                                             srcExposure=exp)
+        """Return the MJD of a fits file, parsing only its header"""
+        return read_exposure_date(fitsfile)
+
+    def dest_bbox(self, hpx_bounds):
+        """Return the destination pixel box covering the given HPX bounds
+
+        hpx_bounds is (xmin, xmax, ymin, ymax) in HPX degrees.  The box is
+        padded by one pixel on each side.
+        """
+        import lsst.afw.geom as afwGeom
+
+        xmin, xmax, ymin, ymax = np.asarray(hpx_bounds) / self.cdelt_deg
+        return afwGeom.Box2I(afwGeom.Point2I(int(np.floor(xmin)) - 1,
+                                             int(np.floor(ymin)) - 1),
+                             afwGeom.Point2I(int(np.ceil(xmax)) + 1,
+                                             int(np.ceil(ymax)) + 1))
+
+    def warped_from_exposure(self, exp, hpx_bounds=None):
+        """Return a warped exposure computed from an LSST exposure
+
+        If hpx_bounds (xmin, xmax, ymin, ymax in HPX degrees) is specified,
+        only the part of the exposure within these bounds is warped.
+        """
+        t0 = default_timer()
+        wcs_out, warper = self.warp_setup()
+        self.n_setups += 1
+        self.setup_time += default_timer() - t0
+
+        with self.metrics.stage('warp'):
+            if hpx_bounds is None:
+                warpedExposure = warper.warpExposure(destWcs=wcs_out,
+                                                     srcExposure=exp)
+            else:
+                warpedExposure = warper.warpExposure(
+                    destWcs=wcs_out, srcExposure=exp,
+                    destBBox=self.dest_bbox(hpx_bounds))
         return warpedExposure
 
+    def warped_from_fits(self, fitsfile, hpx_bounds=None):
+        """Return a warped exposure computed from an LSST fits file"""
+        return self.warped_from_exposure(self.exposure_from_fits(fitsfile),
+                                         hpx_bounds)
+
     def warp_and_save(self, infile, outfile):
         warpedExposure = self.warped_from_fits(infile)
         warpedExposure.writeFits(outfile)
 
-    def sparse_from_fits(self, fitsfile):
+    def sparse_from_fits(self, fitsfile, hpx_bounds=None):
+        """Return a sparse HPX array from an LSST fits file"""
+        return self.date_and_sparse_from_fits(fitsfile, hpx_bounds)[1]
+
+    def date_and_sparse_from_fits(self, fitsfile, hpx_bounds=None):
+        """Return the MJD and the sparse HPX array of an LSST fits file
+
+        On a warp cache hit only the fits header is read; otherwise the
+        exposure is read once and the result is added to the cache.
+        """
+        key = None
+        if self.cache is not None:
+            key = self.cache.file_key(fitsfile, cdelt=self.cdelt,
+                                      cunit=self.cunit, kernel=self.kernel,
+                                      hpx_bounds=hpx_bounds)
+            with self.metrics.stage('cache_lookup'):
+                sp = self.cache.get_sparse(key, shape=(self.Ny, self.Nx))
+            if sp is not None:
+                self.metrics.count('cache_hits')
+                return self.get_exposure_date(fitsfile), sp
+
+        exp = self.exposure_from_fits(fitsfile)
+        sp = self.sparse_from_exposure(exp, hpx_bounds)
+        if key is not None:
+            with self.metrics.stage('cache_store'):
+                self.cache.put_sparse(key, sp)
+        return self.exposure_date(exp), sp
+
+    def sparse_from_exposure(self, exp, hpx_bounds=None):
         """Return a sparse HPX array from an LSST exposure"""
-        from scipy import sparse
+        warped = self.warped_from_exposure(exp, hpx_bounds)
+
+        with self.metrics.stage('sparsify'):
+            sp = self._sparsify(warped)
+        self.metrics.count('pixels', sp.nnz)
+        return sp
 
-        warped = self.warped_from_fits(fitsfile)
+    def _sparsify(self, warped):
+        """Return the non-NaN pixels of a warped exposure as a coo_matrix"""
+        from scipy import sparse
 
         img = warped.getMaskedImage()
         x0, y0 = img.getXY0()
@@ -134,30 +271,37 @@ class LSSTWarper(object):
         sp = self.sparse_from_fits(filename)
         return self.interface.from_sparse(sp)
 
-    def scidb3d_from_fits(self, fitsfile):
+    def records_from_fits(self, fitsfile, hpx_bounds=None):
+        """Return the (time, x, y, val) records of a warped fits file"""
+        time, warped = self.date_and_sparse_from_fits(fitsfile, hpx_bounds)
+        with self.metrics.stage('records'):
+            return self.schema.records(warped.row, warped.col, warped.data,
+                                       time)
+
+    def scidb3d_from_fits(self, fitsfile, hpx_bounds=None, stats=None):
+        """Warp a fits file into a new (x, y, time) SciDB array
+
+        If ``stats`` (a :class:`spheredb.tile_stats.TileStats`) is given,
+        it is updated with the warped records.
+        """
         if self.interface is None:
             raise ValueError("scidb interface must be defined")
-            
-        time = self.get_exposure_date(fitsfile)
-        warped = self.sparse_from_fits(fitsfile)
-            
-        warped_data = np.zeros(warped.nnz, dtype=[('time', np.int64),
-                                                  ('x', np.int64),
-                                                  ('y', np.int64),
-                                                  ('val', np.float64)])
-
-        warped_data['time'] = int(time * 24 * 60 * 60)
-        warped_data['x'] = warped.row
-        warped_data['y'] = warped.col
-        warped_data['val'] = warped.data
-
-        warped_arr = self.interface.from_array(warped_data)
-        redimensioned = self.interface.new_array(shape=(self.Nx, self.Ny,
-                                                        self.Nt),
-                                                 dtype='<val:double>',
-                                                 dim_names=('x', 'y', 'time'))
-        self.interface.query('redimension_store({0}, {1})',
-                             self.interface.from_array(warped_data),
-                             redimensioned)
+
+        warped_data = self.records_from_fits(fitsfile, hpx_bounds)
+        if stats is not None:
+            with self.metrics.stage('stats'):
+                stats.update(warped_data)
+
+        with self.metrics.stage('upload'):
+            warped_arr = self.interface.from_array(warped_data)
+        self.metrics.count('bytes_uploaded', warped_data.nbytes)
+
+        with self.metrics.stage('redimension'):
+            redimensioned = self.interface.new_array(
+                shape=(self.Nx, self.Ny, self.Nt),
+                dtype=self.schema.scidb_attribute,
+                dim_names=('x', 'y', 'time'))
+            self.interface.query('redimension_store({0}, {1})',
+                                 warped_arr, redimensioned)
         return redimensioned
         
@@ -0,0 +1,157 @@
+"""
+Lightweight instrumentation of the ingest path
+
+A Metrics object accumulates per-stage wall-clock timers, named counters
+(bytes, pixels, files...) and, optionally, per-stage peaks of traced
+memory.  Instrumented functions take a ``metrics`` argument; by default it
+is NULL_METRICS, whose methods do nothing, so that the instrumentation
+costs next to nothing when disabled.
+
+>>> metrics = Metrics()
+>>> with metrics.stage('read'):
+...     pass
+>>> metrics.count('pixels', 100)
+>>> print(metrics.to_prometheus())          # doctest: +SKIP
+"""
+import json
+import threading
+import tracemalloc
+from timeit import default_timer
+
+__all__ = ['Metrics', 'NullMetrics', 'NULL_METRICS']
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class NullMetrics(object):
+    """Metrics object which records nothing"""
+    enabled = False
+    _stage = _NullStage()
+
+    def stage(self, name):
+        return self._stage
+
+    def count(self, name, value=1):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+class _Stage(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        if self.metrics.trace_memory:
+            self.mem0 = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self.t0 = default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = default_timer() - self.t0
+        peak = None
+        if self.metrics.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1] - self.mem0
+        self.metrics._record(self.name, elapsed, peak)
+        return False
+
+
+class Metrics(object):
+    """Per-stage timers, counters and memory peaks
+
+    Parameters
+    ----------
+    trace_memory : bool
+        if True, record the peak traced memory (above the level at entry)
+        of each stage with tracemalloc, starting tracing if needed.  This
+        slows down allocation-heavy code noticeably.  Peaks of nested
+        stages are measured independently, so the peak of an enclosing
+        stage only covers its own allocations after the last inner stage.
+    callback : function (optional)
+        called as ``callback(name, seconds, peak_bytes)`` when each stage
+        completes (``peak_bytes`` is None unless tracing memory)
+
+    Stages and counters are safe to update from several threads.
+    """
+    enabled = True
+
+    def __init__(self, trace_memory=False, callback=None):
+        self.trace_memory = trace_memory
+        self.callback = callback
+        self._lock = threading.Lock()
+        self.reset()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def reset(self):
+        """Clear all timers and counters"""
+        self.stages = {}
+        self.counters = {}
+
+    def stage(self, name):
+        """Context manager timing one execution of a stage"""
+        return _Stage(self, name)
+
+    def _record(self, name, elapsed, peak):
+        with self._lock:
+            stats = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.,
+                                                  'max_seconds': 0.})
+            stats['calls'] += 1
+            stats['seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+            if peak is not None:
+                stats['peak_bytes'] = max(stats.get('peak_bytes', 0), peak)
+        if self.callback is not None:
+            self.callback(name, elapsed, peak)
+
+    def count(self, name, value=1):
+        """Add value to the counter ``name``"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        with self._lock:
+            return {'stages': dict((name, dict(stats)) for (name, stats)
+                                   in self.stages.items()),
+                    'counters': dict(self.counters)}
+
+    def to_json(self, **kwargs):
+        """Return the metrics as a JSON string"""
+        return json.dumps(self.as_dict(), sort_keys=True, **kwargs)
+
+    def to_prometheus(self, prefix='spheredb'):
+        """Return the metrics in the Prometheus text exposition format"""
+        metrics = self.as_dict()
+        lines = []
+
+        def family(name, kind, samples):
+            if not samples:
+                return
+            lines.append('# TYPE {0}_{1} {2}'.format(prefix, name, kind))
+            for labels, value in samples:
+                lines.append('{0}_{1}{2} {3!r}'.format(prefix, name,
+                                                       labels, value))
+
+        stages = sorted(metrics['stages'].items())
+        label = lambda name: '{{stage="{0}"}}'.format(name)
+        family('stage_seconds_total', 'counter',
+               [(label(n), s['seconds']) for (n, s) in stages])
+        family('stage_calls_total', 'counter',
+               [(label(n), s['calls']) for (n, s) in stages])
+        family('stage_max_seconds', 'gauge',
+               [(label(n), s['max_seconds']) for (n, s) in stages])
+        family('stage_peak_bytes', 'gauge',
+               [(label(n), s['peak_bytes']) for (n, s) in stages
+                if 'peak_bytes' in s])
+        for name, value in sorted(metrics['counters'].items()):
+            family(name + '_total', 'counter', [('', value)])
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,201 @@
+"""
+Batched forced photometry on a pixel store
+
+Sources given by RA/dec are converted to continuous HPX grid coordinates
+in one vectorized step, and sorted by the storage tile they fall in.  Each
+source contributes a stencil of weighted pixels (the pixels within an
+aperture, or the four corners of a bilinear interpolation); the stencils
+are grouped by tile, so that each tile of a batch is read once, and the
+partial sums from neighbouring tiles are combined at the end.
+"""
+import numpy as np
+
+from .hpx_utils import RAdec_to_HPX
+
+__all__ = ['forced_photometry', 'PHOTOMETRY_DTYPE']
+
+PHOTOMETRY_DTYPE = np.dtype([('source', np.int32), ('time', np.int64),
+                             ('flux', np.float64), ('weight', np.float64)])
+
+
+def source_grid_coords(RA, dec, Nside, origin=(-180., -90.)):
+    """Continuous grid coordinates of sky positions
+
+    Grid index (i, j) is at HPX-plane position ``origin + (i, j) * step``
+    with step = 45 / Nside.  The default origin matches the records of
+    :func:`spheredb.conversions.FITS_to_HPX`, for which every position has
+    0 <= i < 8 * Nside.
+    """
+    x, y = RAdec_to_HPX(np.ravel(RA), np.ravel(dec))
+    step = 45. / Nside
+    return (x - origin[0]) / step, (y - origin[1]) / step
+
+
+def _stencils(gx, gy, method, radius):
+    """Return (source, px, py, weight) of the stencil points of sources"""
+    n = len(gx)
+    if method == 'interpolate':
+        ix, iy = np.floor(gx).astype(np.int64), np.floor(gy).astype(np.int64)
+        fx, fy = gx - ix, gy - iy
+        dx = np.array([0, 1, 0, 1])
+        dy = np.array([0, 0, 1, 1])
+        weight = np.vstack([(1 - fx) * (1 - fy), fx * (1 - fy),
+                            (1 - fx) * fy, fx * fy]).T
+    elif method == 'aperture':
+        if radius is None or radius <= 0:
+            raise ValueError("aperture photometry requires a radius > 0")
+        R = int(np.ceil(radius))
+        ix = np.floor(gx).astype(np.int64) - R
+        iy = np.floor(gy).astype(np.int64) - R
+        dx, dy = [a.ravel() for a in np.mgrid[:2 * R + 2, :2 * R + 2]]
+        weight = (((ix[:, None] + dx - gx[:, None]) ** 2
+                   + (iy[:, None] + dy - gy[:, None]) ** 2)
+                  <= radius ** 2).astype(float)
+    else:
+        raise ValueError("method '{0}' not recognized".format(method))
+
+    source = np.repeat(np.arange(n), len(dx))
+    px = (ix[:, None] + dx).ravel()
+    py = (iy[:, None] + dy).ravel()
+    weight = weight.ravel()
+    keep = weight > 0
+    return source[keep], px[keep], py[keep], weight[keep]
+
+
+def _sum_by_source_time(source, time, wv, w):
+    """Sum wv and w over the rows sharing (source, time)"""
+    order = np.lexsort((time, source))
+    source, time = source[order], time[order]
+    if len(order) == 0:
+        return source, time, wv, w
+    start = np.concatenate([[True], (source[1:] != source[:-1])
+                            | (time[1:] != time[:-1])])
+    starts = np.nonzero(start)[0]
+    return (source[starts], time[starts],
+            np.add.reduceat(wv[order], starts),
+            np.add.reduceat(w[order], starts))
+
+
+def _tile_photometry(cube, tile, source, px, py, weight, time_range):
+    """Partial sums of the stencil points falling in one tile"""
+    pixel, indptr, times, val = cube.tile(tile)
+    tx, ty = cube.tile_shape
+    local = (px - tile[0] * tx) * ty + (py - tile[1] * ty)
+
+    k = np.searchsorted(pixel, local)
+    found = k < len(pixel)
+    found[found] = (pixel[k[found]] == local[found])
+    k, source, weight = k[found], source[found], weight[found]
+
+    # gather the (time, val) runs of the found pixels
+    starts = np.asarray(indptr[k])
+    counts = np.asarray(indptr[k + 1]) - starts
+    row = np.repeat(np.arange(len(k)), counts)
+    index = starts[row] + np.arange(len(row)) - np.repeat(
+        np.cumsum(counts) - counts, counts)
+    t = np.asarray(times[index])
+    v = np.asarray(val[index], dtype=np.float64)
+    s, w = source[row], weight[row]
+
+    if time_range is not None:
+        keep = np.ones(len(t), dtype=bool)
+        if time_range[0] is not None:
+            keep &= (t >= time_range[0])
+        if time_range[1] is not None:
+            keep &= (t < time_range[1])
+        s, t, v, w = s[keep], t[keep], v[keep], w[keep]
+
+    return _sum_by_source_time(s, t, w * v, w)
+
+
+def forced_photometry(cube, RA, dec, Nside, method='aperture', radius=None,
+                      time=None, origin=(-180., -90.), batch_size=2 ** 16):
+    """Measure the pixel store at catalog positions, for every epoch
+
+    Parameters
+    ----------
+    cube : SparseCube
+        the (x, y, time) pixel store
+    RA, dec : array_like
+        positions of the sources, in degrees
+    Nside : int
+        HEALPix gridding parameter of the store
+    method : 'aperture' or 'interpolate'
+        with 'aperture' (default), sum the pixels whose centers lie within
+        ``radius`` pixels of the source.  With 'interpolate', interpolate
+        bilinearly between the four surrounding pixels, as
+        :class:`spheredb.grid_interpolation.GridInterpolation` does.
+    radius : float
+        aperture radius in pixels
+    time : tuple (optional)
+        half-open (start, stop) range of times to measure (default all)
+    origin : tuple
+        HPX-plane position in degrees of the grid index (0, 0)
+        (default = (-180, -90), as in
+        :func:`spheredb.conversions.FITS_to_HPX`).  Grid columns wrap
+        around every 8 * Nside pixels, so that apertures on the RA = 180
+        seam reach the pixels on both ends of the grid.
+    batch_size : int
+        number of sources processed together (default = 65536).  Sources
+        are processed in tile order, so that each batch touches a compact
+        set of tiles, each read once.
+
+    Returns
+    -------
+    table : ndarray
+        record array with dtype :data:`PHOTOMETRY_DTYPE`, sorted by
+        (source, time), with one row for each source and epoch with data.
+        ``source`` is the index of the source in RA/dec.  For apertures,
+        ``flux`` is the sum of the pixels found and ``weight`` their
+        number.  For interpolation, ``flux`` is the interpolated value and
+        ``weight`` the sum of the weights of the pixels found (1 if all
+        four were present; the value is renormalized otherwise).
+    """
+    gx, gy = source_grid_coords(RA, dec, Nside, origin)
+    if len(gx) > np.iinfo(np.int32).max:
+        raise ValueError("too many sources")
+    tx, ty = cube.tile_shape
+    Nx = 8 * Nside
+
+    # sort the sources by the tile of their center
+    order = np.lexsort((gy // ty, gx // tx))
+    stored = set(cube.tiles)
+
+    parts = []
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        source, px, py, weight = _stencils(gx[batch], gy[batch], method,
+                                           radius)
+        if len(source) == 0:
+            continue
+        source = batch[source]
+        px %= Nx
+
+        tile_x, tile_y = px // tx, py // ty
+        by_tile = np.lexsort((tile_y, tile_x))
+        tile_x, tile_y = tile_x[by_tile], tile_y[by_tile]
+        new_tile = np.concatenate([[True], (tile_x[1:] != tile_x[:-1])
+                                   | (tile_y[1:] != tile_y[:-1])])
+        bounds = np.append(np.nonzero(new_tile)[0], len(by_tile))
+
+        for i0, i1 in zip(bounds[:-1], bounds[1:]):
+            tile = (int(tile_x[i0]), int(tile_y[i0]))
+            if tile not in stored:
+                continue
+            rows = by_tile[i0:i1]
+            parts.append(_tile_photometry(cube, tile, source[rows], px[rows],
+                                          py[rows], weight[rows], time))
+
+    if parts:
+        s, t, wv, w = _sum_by_source_time(*[np.concatenate(p) for p
+                                            in zip(*parts)])
+    else:
+        s = t = np.zeros(0, dtype=np.int64)
+        wv = w = np.zeros(0)
+
+    table = np.empty(len(s), dtype=PHOTOMETRY_DTYPE)
+    table['source'] = s
+    table['time'] = t
+    table['flux'] = wv / w if method == 'interpolate' else wv
+    table['weight'] = w
+    return table
@@ -0,0 +1,519 @@
+"""
+Lazy query expressions over HPX pixel arrays
+
+Operations on a LazyArray (slicing in time, subarrays, aggregation and
+regridding) only build an expression tree.  When the result is requested
+with :meth:`LazyArray.compute` or :meth:`LazyArray.toarray`, the tree is
+optimized (subarrays are pushed down to the source, below any slice,
+aggregate or regrid) and evaluated in one step: a single AFL query for
+arrays stored in SciDB, or a single pass over the records for local
+(time, x, y, val) record arrays.
+
+Conventions follow AFL: subarray bounds are inclusive and the result of a
+subarray is re-based to start at zero; regrid cells start at zero.
+"""
+import numpy as np
+
+from .util import reduce_duplicates
+
+__all__ = ['LazyArray', 'optimize']
+
+# records of the significant differences of an epoch from a reference
+DIFFERENCE_DTYPE = np.dtype([('x', np.int64), ('y', np.int64),
+                             ('diff', np.float64), ('variance', np.float64),
+                             ('snr', np.float64)])
+
+# aggregate names: local reduction -> AFL aggregate
+AGGREGATES = {'sum': 'sum', 'min': 'min', 'max': 'max', 'mean': 'avg'}
+
+# AFL aggregate names accepted in place of the local ones
+AGGREGATE_ALIASES = {'avg': 'mean'}
+
+
+class Expression(object):
+    """Base class of expression nodes
+
+    Every node has a tuple of dimension names ``dims`` and a ``shape``.
+    """
+    children = ()
+
+    def sources(self):
+        """Return the list of source arrays, in placeholder order"""
+        return sum((child.sources() for child in self.children), [])
+
+
+class Array(Expression):
+    """A source array: a SciDB array, or a local record array"""
+    def __init__(self, source, dims, shape):
+        self.source = source
+        self.dims = tuple(dims)
+        self.shape = tuple(int(n) for n in shape)
+
+    def sources(self):
+        return [self]
+
+    def __repr__(self):
+        return 'Array(dims={0}, shape={1})'.format(self.dims, self.shape)
+
+
+class Subarray(Expression):
+    """Select an inclusive range of each dimension (None = unbounded)"""
+    def __init__(self, child, lower, upper):
+        self.children = (child,)
+        self.dims = child.dims
+        self.lower = tuple(lower)
+        self.upper = tuple(upper)
+        self.shape = tuple(min(n - 1, n - 1 if u is None else u) + 1
+                           - (0 if l is None else l)
+                           for (n, l, u) in zip(child.shape, self.lower,
+                                                self.upper))
+
+    def __repr__(self):
+        return 'Subarray({0}, {1}, {2})'.format(self.children[0],
+                                                self.lower, self.upper)
+
+
+class Slice(Expression):
+    """Fix one dimension at a value, removing it"""
+    def __init__(self, child, dim, value):
+        self.children = (child,)
+        self.dim = dim
+        self.value = value
+        i = child.dims.index(dim)
+        self.dims = child.dims[:i] + child.dims[i + 1:]
+        self.shape = child.shape[:i] + child.shape[i + 1:]
+
+    def __repr__(self):
+        return 'Slice({0}, {1}={2})'.format(self.children[0], self.dim,
+                                            self.value)
+
+
+class Aggregate(Expression):
+    """Reduce over some dimensions"""
+    def __init__(self, child, reduced, func='sum'):
+        self.children = (child,)
+        self.reduced = tuple(reduced)
+        self.func = AGGREGATE_ALIASES.get(func, func)
+        keep = [i for (i, d) in enumerate(child.dims)
+                if d not in self.reduced]
+        self.dims = tuple(child.dims[i] for i in keep)
+        self.shape = tuple(child.shape[i] for i in keep)
+
+    def __repr__(self):
+        return 'Aggregate({0}, {1}, {2})'.format(self.children[0],
+                                                 self.reduced, self.func)
+
+
+class Regrid(Expression):
+    """Aggregate over blocks of ``factors`` cells along each dimension"""
+    def __init__(self, child, factors, func='sum'):
+        self.children = (child,)
+        self.factors = tuple(int(f) for f in factors)
+        self.func = AGGREGATE_ALIASES.get(func, func)
+        self.dims = child.dims
+        self.shape = tuple(-(-n // f) for (n, f) in zip(child.shape,
+                                                       self.factors))
+
+    def __repr__(self):
+        return 'Regrid({0}, {1}, {2})'.format(self.children[0],
+                                              self.factors, self.func)
+
+
+def optimize(expr):
+    """Push subarrays down towards the sources of an expression
+
+    Nested subarrays are merged, and a subarray of a slice, an aggregate or
+    a regrid is rewritten as the same operation on a subarray of its input,
+    so that only the selected cells are ever read.
+    """
+    if isinstance(expr, Array):
+        return expr
+
+    child = optimize(expr.children[0])
+
+    if not isinstance(expr, Subarray):
+        return _rebuild(expr, child)
+
+    lower, upper = expr.lower, expr.upper
+
+    if isinstance(child, Subarray):
+        # the outer bounds are relative to the start of the inner subarray
+        base = [l or 0 for l in child.lower]
+        lower = [None if (cl is None and l is None) else b + (l or 0)
+                 for (b, cl, l) in zip(base, child.lower, lower)]
+        upper = [_min(cu, None if u is None else b + u)
+                 for (b, cu, u) in zip(base, child.upper, upper)]
+        return optimize(Subarray(child.children[0], lower, upper))
+
+    elif isinstance(child, Slice):
+        grandchild = child.children[0]
+        i = grandchild.dims.index(child.dim)
+        lower = list(lower[:i]) + [None] + list(lower[i:])
+        upper = list(upper[:i]) + [None] + list(upper[i:])
+        return Slice(optimize(Subarray(grandchild, lower, upper)),
+                     child.dim, child.value)
+
+    elif isinstance(child, Aggregate):
+        grandchild = child.children[0]
+        bounds = dict(zip(child.dims, zip(lower, upper)))
+        lower = [bounds.get(d, (None, None))[0] for d in grandchild.dims]
+        upper = [bounds.get(d, (None, None))[1] for d in grandchild.dims]
+        return Aggregate(optimize(Subarray(grandchild, lower, upper)),
+                         child.reduced, child.func)
+
+    elif isinstance(child, Regrid):
+        f = child.factors
+        lower = [None if l is None else l * fi
+                 for (l, fi) in zip(lower, f)]
+        upper = [None if u is None else (u + 1) * fi - 1
+                 for (u, fi) in zip(upper, f)]
+        return Regrid(optimize(Subarray(child.children[0], lower, upper)),
+                      f, child.func)
+
+    return Subarray(child, lower, upper)
+
+
+def _min(a, b):
+    if a is None:
+        return b
+    elif b is None:
+        return a
+    else:
+        return min(a, b)
+
+
+def _rebuild(expr, child):
+    """Copy of a non-source node with a new child"""
+    if isinstance(expr, Slice):
+        return Slice(child, expr.dim, expr.value)
+    elif isinstance(expr, Aggregate):
+        return Aggregate(child, expr.reduced, expr.func)
+    elif isinstance(expr, Regrid):
+        return Regrid(child, expr.factors, expr.func)
+    else:
+        return Subarray(child, expr.lower, expr.upper)
+
+
+def to_afl(expr, attr='val'):
+    """Return the AFL query of an expression
+
+    Sources appear as the placeholders ``{0}``, ``{1}``... in the order
+    given by ``expr.sources()``.
+    """
+    sources = expr.sources()
+
+    def afl(e):
+        if isinstance(e, Array):
+            return '{{{0}}}'.format(sources.index(e))
+
+        child = afl(e.children[0])
+        if isinstance(e, Subarray):
+            bounds = [('null' if b is None else str(int(b)))
+                      for b in e.lower + e.upper]
+            return 'subarray({0}, {1})'.format(child, ', '.join(bounds))
+        elif isinstance(e, Slice):
+            return 'slice({0}, {1}, {2})'.format(child, e.dim, e.value)
+        elif isinstance(e, Aggregate):
+            return 'aggregate({0})'.format(
+                ', '.join([child, _afl_aggregate(e.func, attr)]
+                          + list(e.dims)))
+        elif isinstance(e, Regrid):
+            return 'regrid({0}, {1}, {2})'.format(
+                child, ', '.join(str(f) for f in e.factors),
+                _afl_aggregate(e.func, attr))
+        raise TypeError("unrecognized expression: {0}".format(e))
+
+    return afl(expr)
+
+
+def index_bounds_afl(ndim, dims=None):
+    """AFL query of the min and max index of non-empty cells along dims
+
+    Parameters
+    ----------
+    ndim : int
+        number of dimensions of the array, which appears as ``{A}``
+    dims : int, tuple, or None
+        the dimensions to consider (default: all)
+
+    Returns
+    -------
+    afl : str
+        the query; its output attributes are ``<name>_min, <name>_max``
+        for each name in dim_names
+    dim_names : list of str
+        the temporary names of the dimensions
+    """
+    if dims is None:
+        dims = range(ndim)
+    else:
+        try:
+            dims = tuple(dims)
+        except TypeError:
+            dims = (dims,)
+
+    if(min(dims) < 0 or max(dims) >= ndim):
+        raise ValueError("dims out of range")
+
+    # todo: we need some unique dimension names here
+    #       there should be a scidbpy utility for this
+    dim_names = ["_tmp{0:01d}".format(d) for d in dims]
+    afl = "aggregate(apply({A},"
+    afl += ', '.join("{0}, {{A.d{1}}}".format(d, i)
+                     for (d, i) in zip(dim_names, dims))
+    afl += "),"
+    afl += ", ".join("min({0}), max({0})".format(d) for d in dim_names)
+    afl += ")"
+    return afl, dim_names
+
+
+def difference_afl(time, reference=None, threshold=5., attr='val'):
+    """AFL query of the significant changes of one epoch from a reference
+
+    Parameters
+    ----------
+    time : int
+        the time index of the epoch; the (x, y, time) array appears as
+        ``{A}``
+    reference : tuple (optional)
+        half-open (start, stop) range of times coadded into the reference
+        (default: all times).  The epoch itself is always excluded.
+    threshold : float
+        minimum absolute signal to noise of the differences returned
+
+    Returns
+    -------
+    afl : str
+        the query; its output is an (x, y) array with attributes ``diff``
+        (epoch minus the mean of the reference), ``variance`` and ``snr``,
+        downloaded as records of :data:`DIFFERENCE_DTYPE`
+
+    Notes
+    -----
+    The variance of the difference is estimated from the scatter ``s**2``
+    of the ``n`` reference values of each pixel, as ``s**2 * (1 + 1 / n)``:
+    only pixels with at least two reference values can be detected.
+    """
+    start, stop = (None, None) if reference is None else reference
+    bounds = ['null' if start is None else str(int(start)),
+              'null' if stop is None else str(int(stop) - 1)]
+    ref = ('aggregate(filter(between({{A}}, null, null, {0}, null, null, '
+           '{1}), time <> {2}), avg({3}) as _ref, var({3}) as _ref_var, '
+           'count({3}) as _n, x, y)'.format(bounds[0], bounds[1], int(time),
+                                            attr))
+    diff = ('apply(join(slice({{A}}, time, {0}), {1}), diff, {2} - _ref, '
+            'variance, _ref_var * (1.0 + 1.0 / _n))'.format(int(time), ref,
+                                                            attr))
+    return ('project(filter(apply({0}, snr, diff / sqrt(variance)), '
+            'abs(snr) >= {1!r}), diff, variance, snr)'.format(
+                diff, float(threshold)))
+
+
+def _afl_aggregate(func, attr):
+    try:
+        return '{0}({1}) as {1}'.format(AGGREGATES[func], attr)
+    except KeyError:
+        raise ValueError("aggregate '{0}' not recognized".format(func))
+
+
+def evaluate_local(expr, attr='val'):
+    """Evaluate an expression whose sources are local record arrays
+
+    Returns a record array with one integer field per dimension of the
+    result, plus ``attr``.
+    """
+    if isinstance(expr, Array):
+        return np.asarray(expr.source)
+
+    records = evaluate_local(expr.children[0], attr)
+    child = expr.children[0]
+
+    if isinstance(expr, Subarray):
+        keep = np.ones(len(records), dtype=bool)
+        for d, l, u in zip(expr.dims, expr.lower, expr.upper):
+            if l is not None:
+                keep &= (records[d] >= l)
+            if u is not None:
+                keep &= (records[d] <= u)
+        records = records[keep]
+        for d, l in zip(expr.dims, expr.lower):
+            if l:
+                records[d] -= l
+        return records
+
+    elif isinstance(expr, Slice):
+        records = records[records[expr.dim] == expr.value]
+        return _select_fields(records, expr.dims, attr)
+
+    elif isinstance(expr, Aggregate):
+        return _group(records, expr.dims, expr.shape,
+                      [records[d] for d in expr.dims], expr.func, attr)
+
+    elif isinstance(expr, Regrid):
+        return _group(records, expr.dims, expr.shape,
+                      [records[d] // f for (d, f)
+                       in zip(expr.dims, expr.factors)], expr.func, attr)
+
+    raise TypeError("unrecognized expression: {0}".format(expr))
+
+
+def _select_fields(records, dims, attr):
+    out = np.empty(len(records), dtype=[(d, records.dtype[d]) for d in dims]
+                   + [(attr, records.dtype[attr])])
+    for name in out.dtype.names:
+        out[name] = records[name]
+    return out
+
+
+def _group(records, dims, shape, indices, func, attr):
+    """Reduce records sharing the same (re-computed) indices"""
+    if func not in AGGREGATES:
+        raise ValueError("aggregate '{0}' not recognized".format(func))
+
+    if len(dims):
+        index = np.ravel_multi_index(indices, shape)
+    else:
+        index = np.zeros(len(records), dtype=int)
+    index, values = reduce_duplicates(index, records[attr], func)
+
+    out = np.empty(len(index), dtype=[(d, np.int64) for d in dims]
+                   + [(attr, values.dtype)])
+    if len(dims):
+        for d, i in zip(dims, np.unravel_index(index, shape)):
+            out[d] = i
+    out[attr] = values
+    return out
+
+
+class LazyArray(object):
+    """A lazily-evaluated HPX pixel array
+
+    Parameters
+    ----------
+    expr : Expression
+        the expression tree (normally built through the methods below)
+    interface : SciDBInterface (optional)
+        the interface used to evaluate the query, if the sources are stored
+        in SciDB.  If None, the sources are local record arrays.
+    attr : str
+        the name of the value attribute (default = 'val')
+    """
+    def __init__(self, expr, interface=None, attr='val'):
+        self.expr = expr
+        self.interface = interface
+        self.attr = attr
+
+    @classmethod
+    def from_scidb(cls, arr, interface, dims=('x', 'y', 'time'),
+                   attr='val'):
+        """Wrap an array stored in SciDB"""
+        return cls(Array(arr, dims, arr.shape), interface, attr)
+
+    @classmethod
+    def from_records(cls, records, shape, dims=('x', 'y', 'time'),
+                     attr='val'):
+        """Wrap a local record array with one field per dimension"""
+        return cls(Array(records, dims, shape), None, attr)
+
+    def _wrap(self, expr):
+        return self.__class__(expr, self.interface, self.attr)
+
+    def __repr__(self):
+        return 'LazyArray({0})'.format(self.expr)
+
+    @property
+    def dims(self):
+        return self.expr.dims
+
+    @property
+    def shape(self):
+        return self.expr.shape
+
+    def _axes(self, axes):
+        if axes is None:
+            return self.dims
+        if np.ndim(axes) == 0:
+            axes = (axes,)
+        return tuple(a if a in self.dims else self.dims[a] for a in axes)
+
+    def slice(self, dim, value):
+        """Fix dimension ``dim`` (a name or an axis number) at value"""
+        return self._wrap(Slice(self.expr, self._axes(dim)[0], value))
+
+    def subarray(self, *limits):
+        """Select the half-open range [start, stop) along each dimension
+
+        Each limit is a (start, stop) pair, or None to keep the whole
+        dimension.  As in AFL, the result is re-based to start at zero.
+        """
+        limits = list(limits) + [None] * (len(self.dims) - len(limits))
+        lower = [None if lim is None else lim[0] for lim in limits]
+        upper = [None if (lim is None or lim[1] is None) else lim[1] - 1
+                 for lim in limits]
+        return self._wrap(Subarray(self.expr, lower, upper))
+
+    def aggregate(self, axes=None, func='sum'):
+        """Reduce over the given axes (names or numbers; default all)
+
+        ``func`` is one of 'sum', 'min', 'max' or 'mean'; the AFL name
+        'avg' is accepted for 'mean'.
+        """
+        return self._wrap(Aggregate(self.expr, self._axes(axes), func))
+
+    def sum(self, axes=None):
+        return self.aggregate(axes, 'sum')
+
+    def max(self, axes=None):
+        return self.aggregate(axes, 'max')
+
+    def regrid(self, size, aggregate='sum'):
+        """Aggregate blocks of ``size`` cells (an int or one per axis)
+
+        ``aggregate`` is a function name, as in :meth:`aggregate`.
+        """
+        factors = np.zeros(len(self.dims), dtype=int) + size
+        return self._wrap(Regrid(self.expr, factors, aggregate))
+
+    def optimized(self):
+        """Return the optimized expression tree"""
+        return optimize(self.expr)
+
+    def afl(self):
+        """Return the single AFL query evaluating this array"""
+        return to_afl(self.optimized(), self.attr)
+
+    def compute(self):
+        """Evaluate the expression
+
+        Returns a new SciDB array holding the result if the sources are
+        stored in SciDB, or a record array otherwise.
+        """
+        expr = self.optimized()
+        if self.interface is None:
+            return evaluate_local(expr, self.attr)
+
+        sources = [a.source for a in expr.sources()]
+        output = self.interface.new_array()
+        self.interface.query('store({0}, {{{1}}})'.format(to_afl(expr,
+                                                                 self.attr),
+                                                          len(sources)),
+                             *(sources + [output]))
+        return output
+
+    def toarray(self):
+        """Evaluate the expression as a dense numpy array
+
+        Empty cells are zero.  Any temporary SciDB array is removed once
+        its contents have been downloaded.
+        """
+        if self.interface is None:
+            records = self.compute()
+            out = np.zeros(self.shape, dtype=records.dtype[self.attr])
+            out[tuple(records[d] for d in self.dims)] = records[self.attr]
+            return out
+
+        result = self.compute()
+        try:
+            return result.toarray()
+        finally:
+            self.interface.query('remove({0})', result)
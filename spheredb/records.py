@@ -0,0 +1,162 @@
+"""
+Record schemas for HPX pixels
+
+Projected pixels are stored as (time, x, y, val) records.  The default
+schema uses int64 indices, float64 values and time in integer seconds since
+MJD 0, which costs 32 bytes per pixel and reserves ~8.6e9 time slots.  A
+compact schema uses int32 indices and float32 values, with time stored as an
+int32 offset from an epoch, in seconds or as an exposure index: 16 bytes
+per pixel.
+"""
+import numpy as np
+
+__all__ = ['RecordSchema', 'DEFAULT_SCHEMA', 'COO_DTYPE', 'COMPACT_COO_DTYPE']
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# (data, row, column) records of a sparse matrix
+COO_DTYPE = [('data', np.float64), ('i1', np.int64), ('i2', np.int64)]
+COMPACT_COO_DTYPE = [('data', np.float32), ('i1', np.int32), ('i2', np.int32)]
+
+
+class RecordSchema(object):
+    """Layout of (time, x, y, val) pixel records
+
+    Parameters
+    ----------
+    compact : bool
+        if True, use int32 time and indices and float32 values.  Otherwise
+        (default) use int64 and float64.
+    epoch : float
+        MJD from which times are counted.  The default schema counts from
+        MJD 0; a compact schema with ``resolution='second'`` requires an
+        epoch, since int32 seconds only span +/- 68 years around it.
+    resolution : 'second' or 'exposure'
+        with 'second' (default), time is the number of whole seconds since
+        ``epoch``.  With 'exposure', time is the index of the exposure
+        within ``epochs``.
+    epochs : array_like (optional)
+        the MJDs of all exposures, required if resolution is 'exposure'
+    """
+    def __init__(self, compact=False, epoch=None, resolution='second',
+                 epochs=None):
+        if resolution not in ('second', 'exposure'):
+            raise ValueError("resolution='{0}' not "
+                             "recognized".format(resolution))
+        if epoch is None:
+            if compact and resolution == 'second':
+                raise ValueError("epoch must be specified for a compact "
+                                 "schema with resolution='second'")
+            epoch = 0
+        if resolution == 'exposure':
+            if epochs is None:
+                raise ValueError("epochs must be specified for "
+                                 "resolution='exposure'")
+            epochs = np.unique(np.asarray(epochs, dtype=float))
+
+        self.compact = compact
+        self.epoch = epoch
+        self.resolution = resolution
+        self.epochs = epochs
+
+    @classmethod
+    def compact_schema(cls, epoch=None, resolution='second', epochs=None):
+        """Shortcut for ``RecordSchema(compact=True, ...)``"""
+        return cls(True, epoch, resolution, epochs)
+
+    def __repr__(self):
+        return ("RecordSchema(compact={0}, epoch={1}, "
+                "resolution='{2}')".format(self.compact, self.epoch,
+                                           self.resolution))
+
+    @property
+    def index_dtype(self):
+        return np.int32 if self.compact else np.int64
+
+    @property
+    def value_dtype(self):
+        return np.float32 if self.compact else np.float64
+
+    @property
+    def dtype(self):
+        """numpy dtype of the (time, x, y, val) records"""
+        return np.dtype([('time', self.index_dtype),
+                         ('x', self.index_dtype),
+                         ('y', self.index_dtype),
+                         ('val', self.value_dtype)])
+
+    @property
+    def coo_dtype(self):
+        """numpy dtype of (data, i1, i2) sparse matrix records"""
+        return np.dtype(COMPACT_COO_DTYPE if self.compact else COO_DTYPE)
+
+    @property
+    def scidb_attribute(self):
+        """SciDB attribute schema of the pixel values"""
+        return '<val:float>' if self.compact else '<val:double>'
+
+    @property
+    def Nt(self):
+        """Number of slots in the time dimension"""
+        if self.resolution == 'exposure':
+            return len(self.epochs)
+        elif self.compact:
+            return 2 ** 31 - 1
+        else:
+            return int(100000 * SECONDS_PER_DAY)
+
+    def time_index(self, mjd):
+        """Convert MJDs to the integer time of the records"""
+        mjd = np.asarray(mjd, dtype=float)
+        if self.resolution == 'exposure':
+            index = np.minimum(np.searchsorted(self.epochs, mjd),
+                               len(self.epochs) - 1)
+            if not np.allclose(self.epochs[index], mjd, rtol=0, atol=1E-8):
+                raise ValueError("MJD not found in the schema epochs")
+        else:
+            index = ((mjd - self.epoch) * SECONDS_PER_DAY).astype(np.int64)
+
+        self._check_range(index, 'time')
+        return index[()]
+
+    def time_to_mjd(self, time):
+        """Convert record times back to MJDs"""
+        time = np.asarray(time)
+        if self.resolution == 'exposure':
+            return self.epochs[time]
+        else:
+            return self.epoch + time / float(SECONDS_PER_DAY)
+
+    def _check_range(self, values, name):
+        if not self.compact or np.size(values) == 0:
+            return
+        info = np.iinfo(np.int32)
+        if np.min(values) < info.min or np.max(values) > info.max:
+            raise ValueError("{0} values out of range for the compact "
+                             "schema".format(name))
+
+    def records(self, x, y, val, mjd):
+        """Return the structured array of (time, x, y, val) records
+
+        Parameters
+        ----------
+        x, y : array_like
+            HPX pixel indices
+        val : array_like
+            pixel values
+        mjd : float
+            MJD of the exposure
+        """
+        x, y = np.asarray(x), np.asarray(y)
+        self._check_range(x, 'x')
+        self._check_range(y, 'y')
+
+        output = np.zeros(len(val), dtype=self.dtype)
+        output['time'] = self.time_index(mjd)
+        output['x'] = x
+        output['y'] = y
+        output['val'] = val
+        return output
+
+
+DEFAULT_SCHEMA = RecordSchema()
@@ -0,0 +1,191 @@
+"""
+Reusable resampling plans
+
+Projecting an image to the HPX grid requires the same WCS computations for
+every exposure taken with the same pointing and detector: the projection of
+the image edges, the construction of the HPX grid, and the projection of
+the grid back to image coordinates.  A ResamplingPlan stores the result of
+these computations (the target HPX indices along with the source pixel
+indices and bilinear weights), so that resampling a new image with the same
+WCS is a single gather-multiply-add.
+"""
+import hashlib
+import re
+from collections import OrderedDict
+
+import numpy as np
+
+__all__ = ['ResamplingPlan', 'ResamplingPlanCache', 'wcs_key']
+
+# header keywords which determine the WCS of an image
+WCS_KEYWORDS = re.compile(r"^(NAXIS\d*|CTYPE\d|CUNIT\d|CRVAL\d|CRPIX\d|"
+                          r"CDELT\d|CROTA\d|CD\d_\d|PC\d_\d|PV\d_\d+|"
+                          r"A_\w+|B_\w+|AP_\w+|BP_\w+|"
+                          r"LONPOLE|LATPOLE|EQUINOX|RADESYS)$")
+
+
+def wcs_key(header, **params):
+    """Return a hash of the WCS keywords of a header, plus extra parameters
+
+    Headers of exposures sharing the same geometry (but e.g. different
+    observation times) have the same key.
+    """
+    cards = sorted((str(key), repr(header[key])) for key in header.keys()
+                   if WCS_KEYWORDS.match(str(key)))
+    return hashlib.sha1(repr((cards, sorted(params.items())))
+                        .encode('utf-8')).hexdigest()
+
+
+class ResamplingPlan(object):
+    """Precomputed bilinear resampling from an image to HPX pixels
+
+    Parameters
+    ----------
+    shape : tuple
+        shape of the input images
+    x, y : array_like
+        HPX indices of the output pixels
+    src : array_like, shape = (n_pixels, 4)
+        flat indices into the input image of the four neighbors of each
+        output pixel
+    weights : array_like, shape = (n_pixels, 4)
+        bilinear weights of the four neighbors.  They are held as float64,
+        ready for :meth:`apply`, and saved with their input dtype.
+
+    Use :meth:`from_locations` to construct a plan.
+    """
+    def __init__(self, shape, x, y, src, weights):
+        self.shape = tuple(shape)
+        self.x = np.asarray(x)
+        self.y = np.asarray(y)
+        self.src = np.asarray(src)
+        weights = np.asarray(weights)
+        self.weight_dtype = weights.dtype
+        self.weights = weights.astype(float)
+
+    @classmethod
+    def from_locations(cls, shape, pixel_ind_hpx, pixel_locs_img,
+                       weight_dtype=np.float32):
+        """Construct a plan from HPX indices and their image locations
+
+        Parameters
+        ----------
+        shape : tuple
+            shape of the input images
+        pixel_ind_hpx : array_like, shape = (n_pixels, 2)
+            (x, y) HPX indices of the output pixels
+        pixel_locs_img : array_like, shape = (n_pixels, 2)
+            zero-based (row, column) locations of the output pixels within
+            the input image, in the convention of
+            ``GridInterpolation(data, [0, 0], [1, 1])``
+        weight_dtype : dtype
+            precision to which the weights are rounded, and in which they
+            are saved (default = float32)
+
+        Output pixels falling outside the image are dropped from the plan.
+        """
+        pixel_ind_hpx = np.asarray(pixel_ind_hpx)
+        X = np.asarray(pixel_locs_img, dtype=float)
+
+        ind_floor = np.floor(X).astype(int)
+        ind_ceil = np.ceil(X).astype(int)
+        in_bounds = np.logical_and.reduce((ind_floor >= 0)
+                                          & (ind_ceil < shape), -1)
+
+        ind_floor = ind_floor[in_bounds]
+        ind_ceil = ind_ceil[in_bounds]
+        X1 = (X[in_bounds] % 1).T
+        X0 = 1 - X1
+
+        flat = lambda i, j: i * shape[1] + j
+        src = np.vstack([flat(ind_floor[:, 0], ind_floor[:, 1]),
+                         flat(ind_floor[:, 0], ind_ceil[:, 1]),
+                         flat(ind_ceil[:, 0], ind_floor[:, 1]),
+                         flat(ind_ceil[:, 0], ind_ceil[:, 1])]).T
+        weights = np.vstack([X0[0] * X0[1], X0[0] * X1[1],
+                             X1[0] * X0[1], X1[0] * X1[1]]).T
+
+        index_dtype = np.int32 if np.prod(shape) < 2 ** 31 else np.int64
+        x, y = pixel_ind_hpx[in_bounds].T
+        return cls(shape, x, y, src.astype(index_dtype),
+                   weights.astype(weight_dtype))
+
+    def __len__(self):
+        return len(self.x)
+
+    @property
+    def nbytes(self):
+        """Size of the plan in memory"""
+        return sum(a.nbytes for a in (self.x, self.y, self.src, self.weights))
+
+    def apply(self, data):
+        """Resample an image with this plan
+
+        Returns
+        -------
+        x, y, val : ndarrays
+            HPX indices and values of the output pixels.  Pixels with NaN
+            neighbors in the input are dropped.
+        """
+        data = np.asarray(data)
+        if data.shape != self.shape:
+            raise ValueError("data shape {0} does not match plan shape "
+                             "{1}".format(data.shape, self.shape))
+
+        vals = np.einsum('ij,ij->i', data.ravel()[self.src], self.weights)
+        good = ~np.isnan(vals)
+        return self.x[good], self.y[good], vals[good]
+
+    def save(self, filename):
+        """Save the plan to a .npz file"""
+        np.savez(filename, shape=self.shape, x=self.x, y=self.y,
+                 src=self.src, weights=self.weights.astype(self.weight_dtype))
+
+    @classmethod
+    def load(cls, filename):
+        """Load a plan saved with :meth:`save`"""
+        f = np.load(filename)
+        return cls(f['shape'], f['x'], f['y'], f['src'], f['weights'])
+
+
+class ResamplingPlanCache(object):
+    """In-memory LRU cache of resampling plans keyed by WCS
+
+    Parameters
+    ----------
+    max_plans : int
+        maximum number of plans to keep (default = 64)
+    """
+    def __init__(self, max_plans=64):
+        self.max_plans = max_plans
+        self.plans = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.plans)
+
+    def get(self, header, build_plan, **params):
+        """Return the plan for a header, building it if needed
+
+        Parameters
+        ----------
+        header : dict or FITS header
+            header of the image; only its WCS keywords are used
+        build_plan : function
+            called with no arguments to construct the plan on a miss
+        **params :
+            additional parameters of the plan (e.g. Nside) used in the key
+        """
+        key = wcs_key(header, **params)
+        try:
+            plan = self.plans.pop(key)
+            self.hits += 1
+        except KeyError:
+            plan = build_plan()
+            self.misses += 1
+
+        self.plans[key] = plan
+        while len(self.plans) > self.max_plans:
+            self.plans.popitem(last=False)
+        return plan
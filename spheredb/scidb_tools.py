@@ -1,7 +1,16 @@
+import asyncio
+
 import numpy as np
 
 from .lsst_warp import LSSTWarper
-from scidbpy import interface
+from .warp_cache import WarpCache
+from .footprint import select_exposures
+from .query import (LazyArray, index_bounds_afl, difference_afl,
+                    DIFFERENCE_DTYPE)
+from .metrics import NULL_METRICS
+from .tile_stats import TileStats
+from .coverage import CoverageMap
+from .async_shim import load_files_async, find_index_bounds_async
 
 SHIM_DEFAULT = 'http://localhost:8080'
 
@@ -17,34 +26,16 @@ def find_index_bounds(arr, sdb, dims=None):
         interface to scidb server
     dims : int, tuple, or None
     """
-    shape = arr.shape
-    if dims is None:
-        dims = range(len(shape))
-    else:
-        try:
-            dims = tuple(dims)
-        except TypeError:
-            dims = (dims,)
-
-    if(min(dims) < 0 or max(dims) >= len(shape)):
-        raise ValueError("dims out of range")
-
-    # todo: we need some unique dimension names here
-    #       there should be a scidbpy utility for this
-    dim_names = ["_tmp{0:01d}".format(d) for d in dims]
-    query_string = "store(aggregate(apply({A},"
-    query_string += ', '.join("{0}, {{A.d{1}}}".format(d, i)
-                             for (d, i) in zip(dim_names, dims))
-    query_string += "),"
-    query_string += ", ".join("min({0}), max({0})".format(d)
-                              for d in dim_names)
-    query_string += "), {output})"
+    query_string, dim_names = index_bounds_afl(len(arr.shape), dims)
+    query_string = "store(" + query_string + ", {output})"
 
     output = sdb.new_array()
     sdb.query(query_string, A=arr, output=output)
-
-    output = output.toarray()
-    return np.asarray([output[name][0] for name in output.dtype.names])
+    try:
+        bounds = output.toarray()
+    finally:
+        sdb.query("remove({0})", output)
+    return np.asarray([bounds[name][0] for name in bounds.dtype.names])
 
 
 class HPXPixels3D(object):
@@ -52,27 +43,76 @@ class HPXPixels3D(object):
     Class to store and interact with 3D Healpix-projected data
 
     The three dimensions include two angular dimensions and one time dimension.
+
+    If ``cache_dir`` is given, warped files are cached on disk there (see
+    :class:`WarpCache`), so that reloading the same files does not warp
+    them again.  ``cache_size`` bounds the size of the cache in bytes.
+
+    If a ``region`` (:class:`HPXBox`, :class:`Cone` or :class:`Polygon`)
+    and/or a ``time_window`` (tmin, tmax) in MJD are given, only the input
+    files overlapping them are loaded, and only over the overlapping area.
+    Footprints are computed from the file headers, or taken from
+    ``catalog`` (an :class:`ExposureCatalog`) if specified.
+
+    ``schema`` (a :class:`RecordSchema`) selects the layout of the stored
+    pixels; a compact schema also compacts the warp cache.
+
+    If ``metrics`` (a :class:`Metrics`) is given, the time spent in each
+    stage of ingest (read, warp, sparsify, upload, redimension, insert) is
+    recorded there along with file, pixel and byte counts.
+
+    Per-tile statistics over a grid of ``tile_shape`` (see
+    :class:`TileStats`) are maintained as files are loaded, and computed
+    with a single query for an existing array; index bounds are derived
+    from them.
+
+    A coarse :class:`CoverageMap` of the loaded exposures, with cells of
+    45 / ``coverage_nside`` HPX degrees, is built from the file headers as
+    they are loaded (set ``coverage_nside`` to None to disable it).
     """
     def __init__(self, name=None, input_files=None,
                  cdelt=3, cunit='arcsec', kernel='lanczos2',
-                 force_reload=False, interface=None):
+                 force_reload=False, interface=None,
+                 cache_dir=None, cache_size=10 * 2 ** 30,
+                 region=None, time_window=None, catalog=None,
+                 schema=None, metrics=None, tile_shape=(1000, 1000),
+                 coverage_nside=64):
         self.name = name
         self.force_reload = force_reload
         self.interface = interface
+        self.region = region
+        self.time_window = time_window
+        self.catalog = catalog
+        self.metrics = NULL_METRICS if metrics is None else metrics
+        self.tile_shape = tuple(tile_shape)
+        self.stats = TileStats(self.tile_shape)
+        if coverage_nside is None:
+            self.coverage = None
+        else:
+            self.coverage = CoverageMap(coverage_nside)
 
         if self.interface is None:
             self.interface = self.open_scidb_connection()
 
+        if cache_dir is None:
+            cache = None
+        else:
+            cache = WarpCache(cache_dir, max_bytes=cache_size,
+                              compact=schema is not None and schema.compact)
+
         self.warper = LSSTWarper(cdelt=cdelt,
                                  cunit=cunit,
                                  kernel=kernel,
-                                 interface=self.interface)
+                                 interface=self.interface,
+                                 cache=cache,
+                                 schema=schema,
+                                 metrics=self.metrics)
 
         if (name is not None):
             arr_exists = (name in self.interface.list_arrays())
                 
             if force_reload or not arr_exists:
-                print "loading into array: {0}".format(self.name)
+                print("loading into array: {0}".format(self.name))
 
                 # clear the array if needed
                 if arr_exists:
@@ -81,69 +121,262 @@ class HPXPixels3D(object):
                 self.arr = None
                 self._load_files(input_files)
             else:
-                print "using existing array: {0}".format(self.name)
+                print("using existing array: {0}".format(self.name))
                 self.arr = self.interface.wrap_array(self.name)
+                self.stats = None
+                self.coverage = None
         else:
             self.arr = None
             self._load_files(input_files)
 
     @staticmethod
     def open_scidb_connection(address=SHIM_DEFAULT):
+        from scidbpy import interface
         return interface.SciDBShimInterface(address)
 
+    def _select_files(self, files):
+        """Return (fitsfile, hpx_bounds) pairs of the files to load"""
+        if self.region is None and self.time_window is None:
+            return [(fitsfile, None) for fitsfile in files]
+
+        selected = select_exposures(files, self.region, self.time_window,
+                                    self.catalog)
+        print("{0} of {1} files overlap the query".format(len(selected),
+                                                          len(files)))
+        return selected
+
+    def _add_coverage(self, fitsfile, hpx_bounds):
+        if self.coverage is not None:
+            with self.metrics.stage('coverage'):
+                self.coverage.add_file(fitsfile, hpx_bounds)
+
     def _load_files(self, files):
-        for i, fitsfile in enumerate(files):
-            print "- ({0}/{1}) loading {2}".format(i + 1,
-                                                   len(files),
-                                                   fitsfile)
-                                                   
-            if self.arr is None:
-                self.arr = self.warper.scidb3d_from_fits(fitsfile)
-                if self.name is not None:
-                    self.arr.rename(self.name, persistent=True)
-            else:
-                self.interface.query("insert({0}, {1})",
-                                     self.warper.scidb3d_from_fits(fitsfile),
-                                     self.arr)
+        files = self._select_files(files)
+        for i, (fitsfile, hpx_bounds) in enumerate(files):
+            print("- ({0}/{1}) loading {2}".format(i + 1,
+                                                    len(files),
+                                                    fitsfile))
+            self._add_coverage(fitsfile, hpx_bounds)
+
+            warped = self.warper.scidb3d_from_fits(fitsfile, hpx_bounds,
+                                                   self.stats)
+            with self.metrics.stage('insert'):
+                if self.arr is None:
+                    self.arr = warped
+                    if self.name is not None:
+                        self.arr.rename(self.name, persistent=True)
+                else:
+                    self.interface.query("insert({0}, {1})",
+                                         warped, self.arr)
+            self.metrics.count('files')
+
+    async def _load_files_async(self, files, client):
+        """Asynchronous version of _load_files, using an AsyncShimClient
+
+        Files are warped in a thread pool while earlier files are uploaded
+        over the client's pooled sessions.
+        """
+        files = self._select_files(files)
+        name = self.name if self.arr is None else self.arr.name
+        if name is None:
+            name = client.new_name()
+
+        for fitsfile, hpx_bounds in files:
+            self._add_coverage(fitsfile, hpx_bounds)
+        await load_files_async(client, self.warper, files, name,
+                               create=self.arr is None, stats=self.stats)
+        if self.arr is None:
+            self.arr = await self._wrap_array_async(name)
+
+    def lazy(self):
+        """Return a lazy view of the (x, y, time) array
+
+        See :mod:`spheredb.query`: operations on the view are combined into
+        a single query when the result is computed.
+        """
+        return LazyArray.from_scidb(self.arr, self.interface)
 
     def time_slice(self, time1, time2=None):
         if time2 is None:
-            return HPXPixels2D(self, self.arr[:, :, time1])
+            return HPXPixels2D(self, self.lazy().slice('time', time1))
         else:
             raise NotImplementedError()
 
     def coadd(self):
-        return HPXPixels2D(self, self.arr.sum(2))
+        return HPXPixels2D(self, self.lazy().sum('time'))
+
+    def difference(self, time, reference=None, threshold=5.):
+        """Return the pixels of an epoch which differ from a reference
+
+        The difference of the epoch ``time`` from the mean of the times in
+        ``reference`` (a half-open (start, stop) range; default all times)
+        is computed in a single query on the server, and only the pixels
+        with ``abs(snr) >= threshold`` are downloaded.  See
+        :func:`spheredb.query.difference_afl`.
+
+        Returns a record array of :data:`spheredb.query.DIFFERENCE_DTYPE`,
+        with the fields (x, y, diff, variance, snr), as
+        :meth:`spheredb.cube.SparseCube.difference` does.
+        """
+        output = self.interface.new_array()
+        self.interface.query("store(" + difference_afl(time, reference,
+                                                       threshold)
+                             + ", {output})", A=self.arr, output=output)
+        try:
+            # scidbpy names the fields after the dimensions and attributes
+            records = output.tosparse()
+        finally:
+            self.interface.query("remove({0})", output)
+
+        out = np.empty(len(records), dtype=DIFFERENCE_DTYPE)
+        for name in DIFFERENCE_DTYPE.names:
+            out[name] = records[name]
+        return out
+
+    async def difference_async(self, time, client, reference=None,
+                               threshold=5.):
+        """Compute :meth:`difference` concurrently with other client queries
+
+        The detections are downloaded directly, without a stored temporary.
+        """
+        afl = ('project(apply({0}, _x, x, _y, y), _x, _y, diff, variance, '
+               'snr)'.format(difference_afl(time, reference, threshold)))
+        dtype = [('_x', np.int64), ('_y', np.int64)] + [
+            (name, np.float64) for name in DIFFERENCE_DTYPE.names[2:]]
+        records = await client.query_records(
+            afl, A=self.arr, dtype=dtype,
+            nullable=DIFFERENCE_DTYPE.names[2:])
+
+        out = np.empty(len(records), dtype=DIFFERENCE_DTYPE)
+        out['x'], out['y'] = records['_x'], records['_y']
+        for name in DIFFERENCE_DTYPE.names[2:]:
+            out[name] = records[name]
+        return out
+
+    async def time_slice_async(self, time, client):
+        """Compute a time slice concurrently with other client queries"""
+        return await self._wrap_2d(await client.compute(
+            self.lazy().slice('time', time)))
+
+    async def coadd_async(self, client):
+        """Compute the coadd concurrently with other client queries"""
+        return await self._wrap_2d(await client.compute(
+            self.lazy().sum('time')))
+
+    async def _wrap_array_async(self, name):
+        """Wrap an array, running the blocking interface in the executor"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.interface.wrap_array,
+                                          name)
+
+    async def _wrap_2d(self, name):
+        arr = await self._wrap_array_async(name)
+        return HPXPixels2D(self, LazyArray.from_scidb(arr, self.interface,
+                                                      dims=('x', 'y')),
+                           temporaries=[arr])
 
     def unique_times(self):
         return self.arr.max((0, 1)).tosparse()['time']
 
+    def tile_stats(self, refresh=False):
+        """Return the per-tile statistics of the array
+
+        They are computed on the server if they were not maintained
+        during ingest, or if ``refresh`` is True.
+        """
+        if self.stats is None or refresh:
+            self.stats = TileStats.from_scidb(self.arr, self.interface,
+                                              self.tile_shape)
+        return self.stats
+
     def index_bounds(self):
-        bounds = find_index_bounds(self.arr, self.interface)
+        bounds = self.tile_stats().index_bounds()
         return bounds[:2], bounds[2:4], bounds[4:6]
 
+    async def index_bounds_async(self, client):
+        if self.stats is not None:
+            return self.index_bounds()
+        bounds = await find_index_bounds_async(client, self.arr)
+        return bounds[:2], bounds[2:4], bounds[4:6]
+
+
 class HPXPixels2D(object):
-    """Container for 2D LSST Pixels stored in SciDB"""
-    def __init__(self, pix3d, arr):
+    """Container for 2D LSST Pixels stored in SciDB
+
+    ``lazy`` is a :class:`LazyArray`: ``regrid`` and ``subarray`` only add
+    to its expression, which is evaluated in a single query by
+    :meth:`compute` or :meth:`toarray` (or on first access of ``arr``).
+
+    The SciDB arrays stored by :meth:`compute` (and ``temporaries``, arrays
+    owned by this object) are removed by :meth:`close`, which is called on
+    leaving a ``with`` block.  Objects returned by ``regrid`` and
+    ``subarray`` read from the same arrays, so they should not be used
+    after this object is closed.
+    """
+    def __init__(self, pix3d, lazy, temporaries=()):
         self.pix3d = pix3d
-        self.arr = arr
+        self.lazy = lazy
+        self._arr = None
+        self._temporaries = list(temporaries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     @property
     def interface(self):
         return self.pix3d.interface
 
-    def regrid(self, *args):
-        """Parameters
-        
-        N: number of pixels to add in each dimesion
-        aggregrate: scidb aggregate to use
+    @property
+    def arr(self):
+        """The SciDB array of the result, computed on first access"""
+        if self._arr is None:
+            self._arr = self.compute()
+        return self._arr
+
+    def compute(self):
+        """Evaluate the expression into a new SciDB array
+
+        The array is removed by :meth:`close`.
         """
-        return HPXPixels2D(self.pix3d, self.arr.regrid(*args))
+        arr = self.lazy.compute()
+        self._temporaries.append(arr)
+        return arr
+
+    def close(self):
+        """Remove the SciDB arrays stored by this object"""
+        self._arr = None
+        while self._temporaries:
+            self.interface.query("remove({0})", self._temporaries.pop())
+
+    def toarray(self):
+        """Evaluate the expression as a dense numpy array"""
+        if self._arr is not None:
+            return self._arr.toarray()
+        return self.lazy.toarray()
+
+    def regrid(self, size, aggregate='avg'):
+        """Aggregate blocks of pixels into a coarser grid
+
+        Parameters
+        ----------
+        size : int or tuple
+            number of pixels combined along each dimension
+        aggregate : str
+            SciDB aggregate to use: 'avg' (default), 'sum', 'min' or 'max'
+            ('mean' is accepted for 'avg')
+        """
+        return HPXPixels2D(self.pix3d, self.lazy.regrid(size, aggregate))
 
     def subarray(self, xlim, ylim):
-        return HPXPixels2D(self.pix3d, self.arr[xlim[0]:xlim[1],
-                                                ylim[0]:ylim[1]])
+        return HPXPixels2D(self.pix3d, self.lazy.subarray(xlim, ylim))
 
     def index_bounds(self):
         bounds = find_index_bounds(self.arr, self.interface)
         return bounds[:2], bounds[2:4]
+
+    async def index_bounds_async(self, client):
+        bounds = await find_index_bounds_async(client, self.arr)
+        return bounds[:2], bounds[2:4]
@@ -1,29 +1,37 @@
+import os
+import re
+import threading
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
-from scipy.sparse import coo_matrix
 
-from astropy.io import fits
-from astropy.wcs import WCS
-from astropy.units import Unit
+from .records import COO_DTYPE, COMPACT_COO_DTYPE
+from .util import recarray_to_coo, reduce_duplicates
 
 
-def sdb_from_warped(fitsfile, hdunum=1):
-    """Construct a sparse matrix representation of the FITS data
+def warped_geometry(header):
+    """Find the location of a warped HPX image within the full HPX grid
 
     Parameters
     ----------
-    fitsfile : str
-        A FITS file, which must be in HPX format.
-    hdunum : int
-        The number of the HDU to use (default = 1)
+    header : FITS header
+        The header of an image in HPX format.
 
-    Retrurns
-    --------
-    arr : scipy.sparse.coo_matrix
-        The sparse representation of the data in HPX format
+    Returns
+    -------
+    x0, y0 : ints
+        The index of the first image pixel within the full grid.
+        x counts starting at RA=0, y counts starting at DEC=-90
+    Nx, Ny : ints
+        The size of the image
+    Nx_tot, Ny_tot : ints
+        The size of the full HPX grid
     """
-    hdulist = fits.open(fitsfile)
-    wcs = WCS(hdulist[hdunum].header)
-    img = hdulist[hdunum].data
+    from astropy.wcs import WCS
+    from astropy.units import Unit
+
+    wcs = WCS(header)
 
     # Check that unit is what we expect
     if wcs.wcs.ctype[0] != 'RA---HPX' or wcs.wcs.ctype[1] != 'DEC--HPX':
@@ -37,11 +45,11 @@ def sdb_from_warped(fitsfile, hdunum=1):
     # Find cdelt along both axes
     try:
         cd = wcs.wcs.cd
-    except:
+    except AttributeError:
         cd = None
 
     if cd is None:
-        cdelt = w.cdelt
+        cdelt = wcs.wcs.cdelt
     elif cd.shape != (2, 2):
         raise ValueError('cd not understood')
     elif cd[0, 1] != 0 or cd[1, 0] != 0:
@@ -49,22 +57,228 @@ def sdb_from_warped(fitsfile, hdunum=1):
     else:
         cdelt = cd.diagonal()
 
-    # Construct the matrix
-    Nx = wcs.naxis1
-    Ny = wcs.naxis2
+    Nx = header['NAXIS1']
+    Ny = header['NAXIS2']
     Nx_tot = int(np.round(360. / cdelt[0]))
     Ny_tot = int(np.round(180. / cdelt[1]))
 
-    # sanity check for img shape
-    assert img.shape == (Ny, Nx)
-
-    # x counts starting at RA=0, y counts starting at DEC=-90
     x0, y0 = np.round(-wcs.wcs.crpix).astype(int)
-    y0 += Ny_tot / 2
-
-    ix, iy = np.meshgrid(np.arange(x0, x0 + Nx, dtype=np.int64),
-                         np.arange(y0, y0 + Ny, dtype=np.int64))
-    good_pix = ~np.isnan(img)
-    
-    return coo_matrix((img[good_pix], (iy[good_pix], ix[good_pix])),
-                      shape=(Ny_tot, Nx_tot))
+    y0 += Ny_tot // 2
+
+    return x0, y0, Nx, Ny, Nx_tot, Ny_tot
+
+
+def _strip_records(strip, x0, y0, dtype=COO_DTYPE):
+    """Sparse records for the non-NaN pixels of an image strip"""
+    good_pix = ~np.isnan(strip)
+    iy, ix = np.nonzero(good_pix)
+
+    records = np.empty(len(ix), dtype=dtype)
+    records['data'] = strip[good_pix]
+    records['i1'] = iy + y0
+    records['i2'] = ix + x0
+    return records
+
+
+def iter_warped_strips(fitsfile, hdunum=1, strip_rows=1024, n_threads=1,
+                       compact=False):
+    """Iterate over sparse records of a warped FITS file, strip by strip
+
+    The HDU is memory-mapped and read in strips of ``strip_rows`` rows, so
+    that memory use is bounded by the strip size rather than the image
+    size.  The file is closed once iteration is complete.
+
+    Parameters
+    ----------
+    fitsfile : str
+        A FITS file, which must be in HPX format.
+    hdunum : int
+        The number of the HDU to use (default = 1)
+    strip_rows : int
+        The number of image rows to process at once (default = 1024)
+    n_threads : int
+        The number of threads used to process strips (default = 1).
+        Reads from the file are serialized; the sparsification of
+        each strip runs in parallel.
+    compact : bool
+        If True, yield int32 indices and float32 values (default = False)
+
+    Yields
+    ------
+    records : ndarray
+        record array with fields ``data``, ``i1`` (row, i.e. y index)
+        and ``i2`` (column, i.e. x index) in the full HPX grid.
+    """
+    from astropy.io import fits
+
+    with fits.open(fitsfile, memmap=True) as hdulist:
+        hdu = hdulist[hdunum]
+        geometry = warped_geometry(hdu.header)
+        for records in _iter_hdu_strips(hdu, geometry, strip_rows,
+                                        n_threads, compact):
+            yield records
+
+
+def _iter_hdu_strips(hdu, geometry, strip_rows, n_threads, compact):
+    """Iterate over sparse records of an open HDU (see iter_warped_strips)"""
+    x0, y0, Nx, Ny, Nx_tot, Ny_tot = geometry
+    dtype = COMPACT_COO_DTYPE if compact else COO_DTYPE
+
+    section = hdu.section
+    starts = range(0, Ny, strip_rows)
+
+    if n_threads <= 1:
+        for start in starts:
+            strip = np.asarray(section[start:start + strip_rows, :])
+            yield _strip_records(strip, x0, y0 + start, dtype)
+    else:
+        lock = threading.Lock()
+
+        def process(start):
+            with lock:
+                strip = np.asarray(section[start:start + strip_rows, :])
+            return _strip_records(strip, x0, y0 + start, dtype)
+
+        pool = ThreadPool(n_threads)
+        try:
+            for records in pool.imap(process, starts):
+                yield records
+        finally:
+            pool.terminate()
+
+
+def all_warped_files(warped_dir, pattern=r".*\.fits$"):
+    """Iterate over all files in a directory tree matching a pattern"""
+    R = re.compile(pattern)
+    for dirpath, dirnames, filenames in os.walk(warped_dir):
+        for f in filter(R.match, filenames):
+            yield os.path.join(dirpath, f)
+
+
+def _warped_file_records(args):
+    """Sparse records and grid shape of one file (for use in a Pool)"""
+    from astropy.io import fits
+
+    fitsfile, hdunum, strip_rows, n_threads, compact = args
+
+    # the file is opened once, for both the geometry and the pixels
+    with fits.open(fitsfile, memmap=True) as hdulist:
+        hdu = hdulist[hdunum]
+        geometry = warped_geometry(hdu.header)
+        x0, y0, Nx, Ny, Nx_tot, Ny_tot = geometry
+        if strip_rows is None:
+            strip_rows = max(1, Ny)
+        strips = list(_iter_hdu_strips(hdu, geometry, strip_rows, n_threads,
+                                       compact))
+
+    dtype = COMPACT_COO_DTYPE if compact else COO_DTYPE
+    records = np.concatenate([np.empty(0, dtype=dtype)] + strips)
+    return records, (Ny_tot, Nx_tot)
+
+
+def sdb_from_warped(fitsfile, hdunum=1, strip_rows=None, n_threads=1,
+                    compact=False):
+    """Construct a sparse matrix representation of the FITS data
+
+    Parameters
+    ----------
+    fitsfile : str
+        A FITS file, which must be in HPX format.
+    hdunum : int
+        The number of the HDU to use (default = 1)
+    strip_rows : int (optional)
+        If specified, the memory-mapped image is scanned in strips of this
+        many rows (see :func:`iter_warped_strips`), so that only the sparse
+        result needs to fit in memory.  By default the full image is read.
+    n_threads : int
+        The number of threads used to process strips (default = 1)
+    compact : bool
+        If True, use int32 indices and float32 values (default = False)
+
+    Retrurns
+    --------
+    arr : scipy.sparse.coo_matrix
+        The sparse representation of the data in HPX format
+    """
+    records, shape = _warped_file_records((fitsfile, hdunum, strip_rows,
+                                           n_threads, compact))
+    return recarray_to_coo(records, shape=shape)
+
+
+def sdb_from_warped_files(fitsfiles, hdunum=1, reduction='sum',
+                          processes=None, strip_rows=None,
+                          return_sparse=False, compact=False):
+    """Construct one sparse representation of many warped FITS files
+
+    Parameters
+    ----------
+    fitsfiles : list of str
+        FITS files, which must be in HPX format on the same grid.
+    hdunum : int
+        The number of the HDU to use (default = 1)
+    reduction : string or ufunc
+        How to combine overlapping pixels: see
+        :func:`spheredb.util.reduce_duplicates` (default = 'sum')
+    processes : int (optional)
+        Number of worker processes used to sparsify the files.  By default
+        the number of cpus is used.
+    strip_rows : int (optional)
+        If specified, each file is scanned in strips of this many rows.
+    return_sparse : bool (optional)
+        If True, return a coo_matrix rather than a record array.
+    compact : bool (optional)
+        If True, use int32 indices and float32 values, halving the memory
+        used by the records.
+
+    Returns
+    -------
+    records : ndarray or scipy.sparse.coo_matrix
+        Record array with fields ``data``, ``i1`` (row) and ``i2``
+        (column), sorted by (i1, i2) and with no duplicate pixels.
+    """
+    fitsfiles = list(fitsfiles)
+    args = [(f, hdunum, strip_rows, 1, compact) for f in fitsfiles]
+
+    if processes == 1 or len(fitsfiles) <= 1:
+        results = list(map(_warped_file_records, args))
+    else:
+        pool = Pool(processes)
+        try:
+            results = pool.map(_warped_file_records, args)
+        finally:
+            pool.close()
+            pool.join()
+
+    shapes = set(shape for (records, shape) in results)
+    if len(shapes) > 1:
+        raise ValueError("input files do not share the same HPX grid: "
+                         "{0}".format(sorted(shapes)))
+    elif len(shapes) == 0:
+        raise ValueError("no input files")
+    shape = shapes.pop()
+
+    records = np.concatenate([records for (records, shape) in results])
+    index = records['i1'].astype(np.int64) * shape[1] + records['i2']
+    index, data = reduce_duplicates(index, records['data'], reduction)
+
+    records = np.empty(len(index),
+                       dtype=COMPACT_COO_DTYPE if compact else COO_DTYPE)
+    records['data'] = data
+    records['i1'], records['i2'] = np.divmod(index, shape[1])
+
+    if return_sparse:
+        return recarray_to_coo(records, shape)
+    else:
+        return records
+
+
+def sdb_from_warped_dir(warped_dir, pattern=r".*\.fits$", **kwargs):
+    """Construct one sparse representation of a tree of warped FITS files
+
+    All files under ``warped_dir`` whose names match ``pattern`` are
+    sparsified in parallel and merged.  Additional keyword arguments are
+    passed to :func:`sdb_from_warped_files`.
+    """
+    return sdb_from_warped_files(sorted(all_warped_files(warped_dir,
+                                                         pattern)),
+                                 **kwargs)
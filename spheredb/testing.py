@@ -0,0 +1,23 @@
+"""
+Synthetic inputs shared by the tests and the benchmarks
+"""
+import numpy as np
+
+__all__ = ['chip_header']
+
+
+def chip_header(RA, dec, Nx, Ny, scale=1. / 3600, rotation=0., mjd=50000.):
+    """Return a TAN header for an Nx x Ny chip with square pixels
+
+    scale is in degrees per pixel, rotation in degrees.  The header is a
+    dict holding the exposure time as ``TAI``.
+    """
+    c, s = np.cos(np.radians(rotation)), np.sin(np.radians(rotation))
+    return {'NAXIS': 2, 'NAXIS1': Nx, 'NAXIS2': Ny,
+            'CTYPE1': 'RA---TAN', 'CTYPE2': 'DEC--TAN',
+            'CUNIT1': 'deg', 'CUNIT2': 'deg',
+            'CRVAL1': RA, 'CRVAL2': dec,
+            'CRPIX1': 0.5 * (Nx + 1), 'CRPIX2': 0.5 * (Ny + 1),
+            'CD1_1': -scale * c, 'CD1_2': scale * s,
+            'CD2_1': scale * s, 'CD2_2': scale * c,
+            'TAI': mjd}
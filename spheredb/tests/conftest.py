@@ -0,0 +1,70 @@
+"""
+Shared fixtures of the spheredb tests.
+
+kapteyn is usually not available where the tests run, so the projections
+used by spheredb.conversions are replaced, when it is missing, by a
+stand-in built on astropy.wcs and the HPX formulas of hpx_utils.
+"""
+import types
+
+import numpy as np
+import pytest
+
+from spheredb.testing import chip_header
+
+
+class ShimProjection(object):
+    """The subset of ``kapteyn.wcs.Projection`` used by conversions"""
+    def __init__(self, header):
+        from astropy.wcs import WCS
+
+        self.hpx = (header['CTYPE1'] == 'RA---HPX')
+        if not self.hpx:
+            self.wcs = WCS(dict((k, v) for (k, v) in header.items()
+                                if k != 'TAI'))
+
+    def toworld(self, pix):
+        from spheredb.hpx_utils import HPX_to_RAdec
+
+        pix = np.asarray(pix, dtype=float)
+        if self.hpx:
+            return np.array(HPX_to_RAdec(pix[:, 0], pix[:, 1])).T
+        return self.wcs.wcs_pix2world(pix, 1)
+
+    def topixel(self, world):
+        from spheredb.hpx_utils import RAdec_to_HPX
+
+        world = np.asarray(world, dtype=float)
+        if self.hpx:
+            return np.array(RAdec_to_HPX(world[:, 0], world[:, 1])).T
+        return self.wcs.wcs_world2pix(world, 1)
+
+
+@pytest.fixture
+def kapteyn_wcs(monkeypatch):
+    """The kapteyn wcs module, or a stand-in installed for the test"""
+    try:
+        from kapteyn import wcs
+        return wcs
+    except ImportError:
+        pass
+
+    from spheredb import conversions
+
+    shim = types.ModuleType('kapteyn_wcs_shim')
+    shim.Projection = ShimProjection
+    monkeypatch.setattr(conversions, '_kapteyn_wcs', lambda: shim)
+    return shim
+
+
+@pytest.fixture
+def make_chip():
+    """Factory of (header, data) synthetic chips with smooth data"""
+    def make_chip(RA, dec, Nx=40, Ny=30, scale=0.01, rotation=0.,
+                  mjd=50000., rseed=0):
+        rng = np.random.RandomState(rseed)
+        y, x = np.mgrid[:Ny, :Nx]
+        data = (100 + 10 * np.sin(0.3 * x) * np.cos(0.2 * y)
+                + rng.rand(Ny, Nx))
+        return chip_header(RA, dec, Nx, Ny, scale, rotation, mjd), data
+    return make_chip
@@ -0,0 +1,515 @@
+import asyncio
+import threading
+import time
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose, assert_raises
+
+from spheredb.async_shim import (AsyncShimClient, ShimError, binary_format,
+                                 find_index_bounds_async)
+from spheredb.query import LazyArray
+from spheredb.records import RecordSchema
+
+
+class FakeShim(object):
+    """In-process HTTP server imitating the SciDB shim
+
+    Queries are recorded rather than executed; ``results`` maps a substring
+    of a query to the bytes returned by read_bytes.
+    """
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.queries = []
+        self.uploads = {}
+        self.results = {}
+        self.sessions = {}
+        self.released = []
+        self.running = 0
+        self.max_running = 0
+        self.n_connections = 0
+        self.n_sessions = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        port = self.server.sockets[0].getsockname()[1]
+        return 'http://127.0.0.1:{0}'.format(port)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.n_connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target = request_line.split()[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    key, value = line.decode().split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(
+                    int(headers.get('content-length', 0)))
+
+                url = urlsplit(target.decode())
+                params = dict((k, v[0]) for (k, v)
+                              in parse_qs(url.query).items())
+                status, data = await self.respond(url.path, params, body)
+                writer.write('HTTP/1.1 {0} OK\r\nContent-Length: {1}\r\n'
+                             '\r\n'.format(status, len(data)).encode() + data)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def respond(self, path, params, body):
+        if path == '/new_session':
+            self.n_sessions += 1
+            sid = str(self.n_sessions)
+            self.sessions[sid] = None
+            return 200, sid.encode()
+        elif path == '/release_session':
+            self.released.append(params['id'])
+            return 200, b''
+        elif path == '/upload_file':
+            path = '/tmp/upload_{0}'.format(len(self.uploads))
+            data = body.split(b'\r\n\r\n', 1)[1].rsplit(b'\r\n--', 1)[0]
+            self.uploads[path] = data
+            return 200, path.encode()
+        elif path == '/execute_query':
+            query = params['query']
+            if 'fail' in query:
+                return 500, b'query failed'
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            await asyncio.sleep(self.delay)
+            self.running -= 1
+            self.queries.append(query)
+            self.sessions[params['id']] = query
+            return 200, b'0'
+        elif path == '/read_bytes':
+            query = self.sessions[params['id']]
+            for key, result in self.results.items():
+                if key in query:
+                    return 200, result
+            return 200, b''
+        return 404, b''
+
+
+def _run(coroutine_function, delay=0.05):
+    async def main():
+        shim = FakeShim(delay)
+        address = await shim.start()
+        try:
+            return await coroutine_function(shim, address)
+        finally:
+            await shim.stop()
+    return asyncio.run(main())
+
+
+def test_binary_format():
+    fmt, packed = binary_format([('x', np.int64), ('val', np.float32)],
+                                nullable=['val'])
+    assert_equal(fmt, '(int64,float null)')
+    assert_equal(packed.itemsize, 13)
+    assert_raises(ValueError, binary_format, [('x', np.int8)])
+
+
+def test_concurrent_queries_are_bounded():
+    async def check(shim, address):
+        async with AsyncShimClient(address, max_sessions=3) as client:
+            t0 = asyncio.get_running_loop().time()
+            await asyncio.gather(*[client.query('list({0})', "'arrays'")
+                                   for i in range(9)])
+            elapsed = asyncio.get_running_loop().time() - t0
+        return shim, elapsed
+
+    shim, elapsed = _run(check)
+    assert_equal(len(shim.queries), 9)
+    assert_equal(shim.queries[0], "list('arrays')")
+    assert_equal(shim.max_running, 3)
+    assert_equal(shim.n_sessions, 3)
+    assert shim.n_connections <= 3
+    assert elapsed < 9 * 0.05
+    # sessions are released on exit
+    assert_equal(sorted(shim.released), ['1', '2', '3'])
+
+
+def test_failed_query():
+    async def check(shim, address):
+        async with AsyncShimClient(address, max_sessions=2) as client:
+            try:
+                await client.query('fail()')
+            except ShimError:
+                pass
+            else:
+                raise AssertionError("no ShimError raised")
+            # the failed session was dropped; others still work
+            await client.query('list()')
+        return shim
+
+    shim = _run(check, delay=0)
+    assert_equal(shim.queries, ['list()'])
+    assert_equal(shim.n_sessions, 2)
+
+
+def test_upload_and_fetch():
+    records = np.zeros(3, dtype=[('x', np.int64), ('y', np.int64),
+                                 ('val', np.float64)])
+    records['x'] = [0, 1, 2]
+    records['y'] = [2, 0, 1]
+    records['val'] = [1.5, 2.5, 3.5]
+
+    class Named(object):
+        name = 'pix'
+        shape = (3, 4)
+        dim_names = ('x', 'y')
+
+    async def check(shim, address):
+        fmt, packed = binary_format(records.dtype, ['val'])
+        result = np.zeros(3, dtype=packed)
+        for name in records.dtype.names:
+            result[name] = records[name]
+        result['_null_val'] = [255, 255, 0]
+        shim.results['project'] = result.tobytes()
+
+        bounds = np.zeros(1, dtype=binary_format(
+            [('a', np.int64), ('b', np.int64)], ['a', 'b'])[1])
+        bounds['_null_a'] = bounds['_null_b'] = 255
+        bounds['a'], bounds['b'] = 1, 2
+        shim.results['aggregate'] = bounds.tobytes()
+
+        async with AsyncShimClient(address) as client:
+            name = await client.from_records(records, name='up')
+            lazy = LazyArray.from_scidb(Named(), None, dims=('x', 'y'))
+            dense, index_bounds = await asyncio.gather(
+                client.fetch(lazy.subarray((0, 3), (0, 4))),
+                find_index_bounds_async(client, Named(), 1))
+        return shim, name, dense, index_bounds
+
+    shim, name, dense, index_bounds = _run(check, delay=0)
+    assert_equal(name, 'up')
+    upload, = shim.uploads.values()
+    assert_equal(np.frombuffer(upload, dtype=records.dtype), records)
+    assert_equal(shim.queries[0],
+                 "store(input(<x:int64,y:int64,val:double>[i=0:*,1000000,0], "
+                 "'/tmp/upload_0', -2, '(int64,int64,double)'), up)")
+
+    # the null value is dropped
+    expected = np.zeros((3, 4))
+    expected[0, 2], expected[1, 0] = 1.5, 2.5
+    assert_allclose(dense, expected)
+    assert_equal(index_bounds, [1, 2])
+    assert "apply(pix,_tmp1, y)" in " ".join(shim.queries)
+
+
+class FakeWarper(object):
+    Nx, Ny = 100, 50
+    schema = RecordSchema.compact_schema(epoch=50000)
+    Nt = schema.Nt
+
+    def records_from_fits(self, fitsfile, hpx_bounds=None):
+        return self.schema.records([1, 2], [3, 4], [1., 2.],
+                                   50000 + int(fitsfile[-1]))
+
+
+def test_load_files_async():
+    from spheredb.async_shim import load_files_async
+
+    async def check(shim, address):
+        async with AsyncShimClient(address, max_sessions=2) as client:
+            await load_files_async(client, FakeWarper(),
+                                   [('f{0}'.format(i), None)
+                                    for i in range(4)], 'pix')
+        return shim
+
+    shim = _run(check, delay=0.01)
+    assert_equal(shim.queries[0],
+                 'create array pix <val:float>[x=0:99,1000,0,y=0:49,1000,0,'
+                 'time=0:2147483646,1,0]')
+    inserts = [q for q in shim.queries if q.startswith('insert')]
+    assert_equal(len(inserts), 4)
+    assert ('insert(redimension(apply(py_async_' in inserts[0] and
+            'time, int64(_time), x, int64(_x), y, int64(_y)), pix), pix)'
+            in inserts[0])
+    assert_equal(len([q for q in shim.queries if q.startswith('remove')]), 4)
+    assert_equal(len(shim.uploads), 4)
+
+
+class FakeArray(object):
+    """Formats as its name in queries, with dimension names ``{A.d0}``..."""
+    dim_names = ('x', 'y', 'time')
+    d0, d1, d2 = dim_names
+
+    def __init__(self, name, shape=(100, 50, 10)):
+        self.name = name
+        self.shape = shape
+
+    def __format__(self, spec):
+        return self.name
+
+
+class FakeInterface(object):
+    """Blocking scidbpy interface, recording the threads it is called in
+
+    Stored arrays download ``sparse`` from ``tosparse`` and ``dense`` from
+    ``toarray``.
+    """
+    def __init__(self):
+        self.wrapped = []
+        self.queries = []
+        self.sparse = None
+        self.dense = None
+
+    def wrap_array(self, name):
+        self.wrapped.append((name, threading.get_ident()))
+        return FakeArray(name, (100, 50))
+
+    def new_array(self):
+        arr = FakeArray('tmp{0}'.format(len(self.queries)))
+        arr.tosparse = lambda: self.sparse
+        arr.toarray = lambda: self.dense
+        return arr
+
+    def query(self, query, *args, **kwargs):
+        self.queries.append(query.format(*args, **kwargs))
+
+
+def _pixels3d():
+    from spheredb.scidb_tools import HPXPixels3D
+
+    pix = HPXPixels3D(interface=FakeInterface(), input_files=[],
+                      coverage_nside=None)
+    pix.warper = FakeWarper()
+    return pix
+
+
+def test_pixels3d_load_files_async():
+    pix = _pixels3d()
+
+    async def check(shim, address):
+        async with AsyncShimClient(address, max_sessions=2) as client:
+            await pix._load_files_async(['f0', 'f1', 'f2'], client)
+        return shim
+
+    shim = _run(check, delay=0.01)
+    assert shim.queries[0].startswith('create array py_async_')
+    assert_equal(len([q for q in shim.queries if q.startswith('insert')]), 3)
+    assert_equal(pix.arr.name, shim.queries[0].split()[2])
+    assert_equal(pix.stats.count, 6)
+
+    # the blocking interface is not called in the event loop's thread
+    (name, thread), = pix.interface.wrapped
+    assert thread != threading.get_ident()
+
+
+def test_pixels3d_queries_async():
+    pix = _pixels3d()
+    pix.arr = FakeArray('pix')
+
+    async def check(shim, address):
+        async with AsyncShimClient(address) as client:
+            loop_thread = threading.get_ident()
+            sliced, coadd = await asyncio.gather(
+                pix.time_slice_async(3, client), pix.coadd_async(client))
+        return shim, loop_thread, sliced, coadd
+
+    shim, loop_thread, sliced, coadd = _run(check, delay=0)
+    # the results wrap the stored arrays, without further queries
+    stores = dict((q.split(', ')[-1][:-1], q) for q in shim.queries)
+    sliced_name = sliced.lazy.expr.source.name
+    coadd_name = coadd.lazy.expr.source.name
+    assert_equal(stores[sliced_name],
+                 'store(slice(pix, time, 3), {0})'.format(sliced_name))
+    assert_equal(stores[coadd_name],
+                 'store(aggregate(pix, sum(val) as val, x, y), '
+                 '{0})'.format(coadd_name))
+    assert_equal(sliced.lazy.dims, ('x', 'y'))
+    assert_equal(sliced.lazy.shape, (100, 50))
+    assert all(thread != loop_thread for (name, thread)
+               in pix.interface.wrapped)
+
+
+def test_pixels3d_index_bounds_async():
+    pix = _pixels3d()
+    pix.arr = FakeArray('pix')
+    pix.stats.update(FakeWarper().records_from_fits('f0'))
+
+    async def check(shim, address):
+        bounds = np.zeros(1, dtype=binary_format(
+            [(str(i), np.int64) for i in range(6)],
+            [str(i) for i in range(6)])[1])
+        for i in range(6):
+            bounds['_null_' + str(i)] = 255
+            bounds[str(i)] = 10 * i
+        shim.results['aggregate'] = bounds.tobytes()
+
+        async with AsyncShimClient(address) as client:
+            # maintained statistics answer without a query
+            from_stats = await pix.index_bounds_async(client)
+            n_queries = len(shim.queries)
+            pix.stats = None
+            from_server = await pix.index_bounds_async(client)
+        return n_queries, from_stats, from_server
+
+    n_queries, from_stats, from_server = _run(check, delay=0)
+    assert_equal(n_queries, 0)
+    assert_equal([list(b) for b in from_stats[:2]], [[1, 2], [3, 4]])
+    assert_equal([list(b) for b in from_server], [[0, 10], [20, 30],
+                                                  [40, 50]])
+
+
+def test_load_files_async_bounded():
+    from spheredb.async_shim import load_files_async
+
+    class SlowWarper(FakeWarper):
+        """Record the warps running at once, and the files in memory"""
+        def __init__(self, shim):
+            self.shim = shim
+            self.running = self.max_running = 0
+            self.n_warped = self.max_held = 0
+            self.lock = threading.Lock()
+
+        def records_from_fits(self, fitsfile, hpx_bounds=None):
+            with self.lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            time.sleep(0.005)
+            with self.lock:
+                self.running -= 1
+                self.n_warped += 1
+                inserted = len([q for q in self.shim.queries
+                                if q.startswith('insert')])
+                self.max_held = max(self.max_held, self.n_warped - inserted)
+            return FakeWarper.records_from_fits(self, fitsfile, hpx_bounds)
+
+    async def check(shim, address):
+        warper = SlowWarper(shim)
+        async with AsyncShimClient(address, max_sessions=4) as client:
+            await load_files_async(client, warper,
+                                   [('f{0}'.format(i % 10), None)
+                                    for i in range(12)], 'pix',
+                                   max_pending=2)
+        return shim, warper
+
+    shim, warper = _run(check, delay=0.02)
+    assert_equal(len([q for q in shim.queries if q.startswith('insert')]),
+                 12)
+    # the warper is never called from two threads at once
+    assert_equal(warper.max_running, 1)
+    # a warped file is held until its insert completes
+    assert warper.max_held <= 2, warper.max_held
+
+
+def test_fetch_value_dtype():
+    class Named(object):
+        name = 'pix'
+        shape = (3, 4)
+        dim_names = ('x', 'y')
+        dtype = np.dtype([('val', np.float32)])
+
+    def result(dtype):
+        fmt, packed = binary_format([('_x', np.int64), ('_y', np.int64),
+                                     ('val', dtype)], ['val'])
+        out = np.zeros(2, dtype=packed)
+        out['_x'], out['_y'], out['val'] = [0, 2], [1, 3], [1.5, -2.25]
+        out['_null_val'] = 255
+        return out.tobytes()
+
+    async def check(shim, address):
+        lazy = LazyArray.from_scidb(Named(), None, dims=('x', 'y'))
+        async with AsyncShimClient(address) as client:
+            # compact arrays hold floats; their sums are doubles
+            shim.results['project(apply(pix'] = result(np.float32)
+            dense = await client.fetch(lazy)
+            shim.results = {'regrid': result(np.float64)}
+            regridded = await client.fetch(lazy.regrid(1, 'sum'))
+        return dense, regridded
+
+    dense, regridded = _run(check, delay=0)
+    expected = np.zeros((3, 4))
+    expected[0, 1], expected[2, 3] = 1.5, -2.25
+    assert_equal(dense, expected)
+    assert_equal(regridded, expected)
+
+
+def test_pixels3d_difference():
+    from spheredb.query import DIFFERENCE_DTYPE, difference_afl
+
+    pix = _pixels3d()
+    pix.arr = FakeArray('pix')
+
+    # scidbpy's layout: its own field order and attribute types
+    sparse = np.zeros(2, dtype=[('x', np.int64), ('y', np.int64),
+                                ('snr', np.float32), ('diff', np.float32),
+                                ('variance', np.float32)])
+    sparse['x'], sparse['y'] = [3, 7], [5, 1]
+    sparse['diff'], sparse['snr'] = [2, -3], [2, -3]
+    sparse['variance'] = [1, 1]
+    pix.interface.sparse = sparse
+
+    out = pix.difference(4, (0, 4), threshold=1.5)
+    assert_equal(out.dtype, DIFFERENCE_DTYPE)
+    for name in DIFFERENCE_DTYPE.names:
+        assert_equal(out[name], sparse[name])
+    store, remove = pix.interface.queries
+    assert_equal(store, 'store({0}, tmp0)'.format(
+        difference_afl(4, (0, 4), 1.5).format(A='pix')))
+    assert_equal(remove, 'remove(tmp0)')
+
+    async def check(shim, address):
+        fmt, packed = binary_format(
+            [('_x', np.int64), ('_y', np.int64)]
+            + [(name, np.float64) for name in ('diff', 'variance', 'snr')],
+            ['diff', 'variance', 'snr'])
+        result = np.zeros(3, dtype=packed)
+        result['_x'], result['_y'] = [3, 7, 9], [5, 1, 2]
+        result['diff'], result['variance'] = [2, -3, 0], [1, 1, 1]
+        result['snr'] = [2, -3, 0]
+        for name in ('diff', 'variance', 'snr'):
+            result['_null_' + name] = [255, 255, 0]
+        shim.results['project(apply(project(filter'] = result.tobytes()
+
+        async with AsyncShimClient(address) as client:
+            return shim, await pix.difference_async(4, client, (0, 4), 1.5)
+
+    shim, out = _run(check, delay=0)
+    assert_equal(out.dtype, DIFFERENCE_DTYPE)
+    assert_equal(out['x'], [3, 7])
+    assert_equal(out['y'], [5, 1])
+    assert_equal(out['diff'], [2, -3])
+    assert_equal(out['snr'], [2, -3])
+    query, = shim.queries
+    assert_equal(query, 'project(apply({0}, _x, x, _y, y), _x, _y, diff, '
+                 'variance, snr)'.format(difference_afl(4, (0, 4), 1.5)
+                                         .format(A='pix')))
+
+
+def test_pixels2d_temporaries():
+    pix = _pixels3d()
+    pix.arr = FakeArray('pix', (100, 50, 1000))
+    queries = pix.interface.queries
+
+    with pix.coadd() as coadd:
+        arr = coadd.arr
+        assert coadd.arr is arr
+        computed = coadd.compute()
+
+        bounds = np.zeros(1, dtype=[(str(i), np.int64) for i in range(4)])
+        bounds[0] = (2, 9, 1, 4)
+        pix.interface.dense = bounds
+        xlim, ylim = coadd.index_bounds()
+        assert_equal(xlim, [2, 9])
+        assert_equal(ylim, [1, 4])
+        assert_equal(queries[-1], 'remove({0})'.format(queries[-2][-5:-1]))
+        del queries[:]
+
+    assert_equal(sorted(queries), ['remove({0})'.format(arr.name),
+                                   'remove({0})'.format(computed.name)])
+    coadd.close()
+    assert_equal(len(queries), 2)
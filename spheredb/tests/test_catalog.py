@@ -0,0 +1,133 @@
+import os
+
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose
+from astropy.io import fits
+
+from spheredb.catalog import ExposureCatalog
+from spheredb.get_data import lsst_exposure_catalog
+from spheredb.footprint import (header_footprint, bounding_circle,
+                                angular_separation)
+
+
+def _chip_header(RA, dec, mjd, Nx=40, Ny=30, scale=0.01):
+    header = fits.Header()
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRVAL1'] = RA
+    header['CRVAL2'] = dec
+    header['CRPIX1'] = 0.5 * (Nx + 1)
+    header['CRPIX2'] = 0.5 * (Ny + 1)
+    header['CD1_1'] = -scale
+    header['CD1_2'] = 0.
+    header['CD2_1'] = 0.
+    header['CD2_2'] = scale
+    header['MJD-OBS'] = mjd
+    header['TAI'] = mjd
+    header['FILTER'] = 'r'
+    return header
+
+
+def _write_chip(path, RA, dec, mjd, Nx=40, Ny=30):
+    header = _chip_header(RA, dec, mjd, Nx, Ny)
+    hdu = fits.ImageHDU(np.zeros((Ny, Nx), dtype=np.float32), header=header)
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(path, overwrite=True)
+    return path
+
+
+def test_footprint():
+    header = _chip_header(10., 20., 0.)
+    header['NAXIS1'] = 40
+    header['NAXIS2'] = 30
+    RA, dec = header_footprint(header)
+    assert_equal(RA.shape, (4,))
+
+    RA_c, dec_c, radius = bounding_circle(RA, dec)
+    assert_allclose([RA_c, dec_c], [10, 20], atol=1E-3)
+    assert_allclose(radius, 0.01 * np.sqrt(39 ** 2 + 29 ** 2) / 2, rtol=1E-3)
+    assert_allclose(angular_separation(0, 0, 90, 0), 90)
+    assert_allclose(angular_separation(359.5, 0, 0.5, 0), 1)
+
+
+def test_catalog_query(tmpdir):
+    chips = tmpdir.mkdir('chips')
+    _write_chip(str(chips.join('S00.fits')), 10., 20., 50000.1)
+    _write_chip(str(chips.join('S01.fits')), 10.5, 20., 50000.2)
+    _write_chip(str(chips.join('S02.fits')), 200., -40., 50001.0)
+
+    cat = ExposureCatalog(str(tmpdir.join('catalog.db')))
+    assert_equal(cat.update_directory(str(chips), processes=1), 3)
+    assert_equal(len(cat), 3)
+    assert_allclose(cat.times(), [50000.1, 50000.2, 50001.0])
+
+    def names(exposures):
+        return [os.path.basename(p) for p in exposures['path']]
+
+    assert_equal(names(cat.query(10, 20, 0.1)), ['S00.fits'])
+    assert_equal(names(cat.query(10.25, 20, 0.1)), ['S00.fits', 'S01.fits'])
+    assert_equal(names(cat.query(200, -40, 1)), ['S02.fits'])
+    assert_equal(names(cat.query(tmin=50000.15)), ['S01.fits', 'S02.fits'])
+    assert_equal(names(cat.query(10, 20, 5, tmax=50000.15)), ['S00.fits'])
+    assert_equal(len(cat.query(100, 0, 5)), 0)
+    assert_equal(len(cat.query(filter='g')), 0)
+
+    exp = cat.query(200, -40, 1)[0]
+    assert exp['hpx_xmin'] < exp['hpx_xmax']
+    assert exp['hpx_ymin'] < exp['hpx_ymax']
+    assert np.isnan(exp['hpx_xmin2'])
+
+
+def test_catalog_wrap_boxes(tmpdir):
+    path = _write_chip(str(tmpdir.join('S00.fits')), 180., 10., 50000.)
+    cat = ExposureCatalog(str(tmpdir.join('catalog.db')))
+    cat.update([path], processes=1)
+
+    # a chip straddling the RA wrap has a box on each side
+    exp, = cat.query()
+    boxes = sorted([(exp['hpx_xmin'], exp['hpx_xmax']),
+                    (exp['hpx_xmin2'], exp['hpx_xmax2'])])
+    assert boxes[0][0] >= -180 and boxes[0][1] < -179
+    assert boxes[1][0] > 179 and boxes[1][1] < 180
+    assert exp['hpx_ymin'] == exp['hpx_ymin2']
+
+
+def test_catalog_incremental(tmpdir):
+    paths = [_write_chip(str(tmpdir.join('S0{0}.fits'.format(i))),
+                         10. * i, 0., 50000 + i) for i in range(3)]
+    db_path = str(tmpdir.join('catalog.db'))
+
+    cat = ExposureCatalog(db_path)
+    assert_equal(cat.update(paths, processes=2), 3)
+    assert_equal(cat.update(paths, processes=2), 0)
+
+    _write_chip(paths[1], 10., 0., 50005)
+    os.utime(paths[1], (0, 12345))
+    cat.close()
+
+    cat = ExposureCatalog(db_path)
+    assert_equal(cat.update(paths), 1)
+    assert_allclose(cat.times(), [50000, 50002, 50005])
+
+    assert_equal(cat.update(paths[:2], prune=True), 0)
+    assert_equal(len(cat), 2)
+
+
+def test_lsst_exposure_catalog(tmpdir):
+    # LSST chips are named S<raft x><raft y>.fits below visit directories
+    visit = tmpdir.mkdir('v1-fr').mkdir('R21')
+    _write_chip(str(visit.join('S00.fits')), 10., 0., 50000.)
+    _write_chip(str(visit.join('S12.fits')), 10.2, 0., 50000.)
+    _write_chip(str(visit.join('other.fits')), 10.2, 0., 50000.)
+    lsst_dir = str(tmpdir)
+
+    cat = lsst_exposure_catalog(lsst_dir, processes=1)
+    assert os.path.exists(os.path.join(lsst_dir, 'catalog.db'))
+    assert_equal([os.path.basename(p) for p in cat.query()['path']],
+                 ['S00.fits', 'S12.fits'])
+    assert_allclose(cat.query()['tai'], 50000.)
+    cat.close()
+
+    # removed chips are pruned on refresh
+    visit.join('S00.fits').remove()
+    cat = lsst_exposure_catalog(lsst_dir, processes=1)
+    assert_equal(len(cat), 1)
@@ -0,0 +1,160 @@
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose
+import pytest
+
+from spheredb.conversions import FITS_to_HPX, HPX_grid_size, HPX_grid_step
+from spheredb.footprint import HPX_valid
+from spheredb.hpx_utils import HPX_to_RAdec
+
+NSIDE = 4096
+
+# name: (RA, dec) of the chip center
+POSITIONS = {'equator': (30., 10.),
+             'seam': (180., 5.),
+             'facet_seam': (90., 60.),
+             'pole': (0., 89.9)}
+
+
+def reference_values(header, data, x, y, Nside=NSIDE):
+    """Interpolate the chip at grid pixels, independently of conversions
+
+    Bilinear interpolation of ``data[row, col]`` at the zero-based pixel
+    coordinates given by astropy; NaN outside the chip.
+    """
+    from astropy.wcs import WCS
+
+    step = HPX_grid_step(Nside)
+    RA, dec = HPX_to_RAdec(-180. + x * step, -90. + y * step)
+    wcs = WCS(dict((k, v) for (k, v) in header.items() if k != 'TAI'))
+    col, row = wcs.wcs_world2pix(RA, dec, 0)
+
+    Ny, Nx = data.shape
+    inside = ((row >= 0) & (np.ceil(row) < Ny) &
+              (col >= 0) & (np.ceil(col) < Nx))
+    r0 = np.floor(row[inside]).astype(int)
+    c0 = np.floor(col[inside]).astype(int)
+    fr, fc = row[inside] - r0, col[inside] - c0
+    r1, c1 = np.minimum(r0 + 1, Ny - 1), np.minimum(c0 + 1, Nx - 1)
+
+    values = np.full(len(row), np.nan)
+    values[inside] = ((1 - fr) * (1 - fc) * data[r0, c0]
+                      + (1 - fr) * fc * data[r0, c1]
+                      + fr * (1 - fc) * data[r1, c0]
+                      + fr * fc * data[r1, c1])
+    return values
+
+
+def neighbors(x, y, Nside=NSIDE, radius=2):
+    """Grid pixels within radius of the given pixels, wrapping in x"""
+    Nx, Ny = HPX_grid_size(Nside)
+    d = np.arange(-radius, radius + 1)
+    dx, dy = [a.ravel() for a in np.meshgrid(d, d)]
+    xn = ((x[:, None] + dx) % Nx).ravel()
+    yn = (y[:, None] + dy).ravel()
+    keep = (yn >= 0) & (yn < Ny)
+    cells = np.unique(xn[keep] * Ny + yn[keep])
+    return np.divmod(cells, Ny)
+
+
+@pytest.mark.parametrize('position', sorted(POSITIONS))
+def test_FITS_to_HPX_positions(position, kapteyn_wcs, make_chip):
+    # a non-square chip with asymmetric data: a transposed or shifted
+    # image would give other values and coverage
+    header, data = make_chip(*POSITIONS[position], Nx=50, Ny=24,
+                             rotation=30.)
+    Nx, Ny = HPX_grid_size(NSIDE)
+
+    records = FITS_to_HPX(header, data, NSIDE)
+    x, y = records['x'], records['y']
+    assert len(records) > 0
+    assert np.all((x >= 0) & (x < Nx) & (y >= 0) & (y < Ny))
+
+    # each pixel is emitted once, even on the seams
+    assert_equal(len(np.unique(x * Ny + y)), len(records))
+
+    # the values are those of the chip at the pixels
+    assert_allclose(records['val'], reference_values(header, data, x, y),
+                    rtol=1E-6)
+
+    # no pixel covered by the chip is missing near the edges
+    xn, yn = neighbors(x, y)
+    step = HPX_grid_step(NSIDE)
+    valid = HPX_valid(-180. + xn * step, -90. + yn * step)
+    covered = ~np.isnan(reference_values(header, data, xn, yn))
+    expected = set(xn[valid & covered] * Ny + yn[valid & covered])
+    assert_equal(expected - set(x * Ny + y), set())
+
+    # the sparse output holds the same pixels
+    M = FITS_to_HPX(header, data, NSIDE, return_sparse=True)
+    assert_equal(M.shape, (Nx, Ny))
+    assert_equal(M.nnz, len(records))
+    assert_allclose(M.tocsr()[x, y].A1, records['val'])
+
+
+def test_FITS_to_HPX_seam_columns(kapteyn_wcs, make_chip):
+    header, data = make_chip(180., 5.)
+    Nx, Ny = HPX_grid_size(NSIDE)
+    x = FITS_to_HPX(header, data, NSIDE)['x']
+
+    # the chip spans both ends of the grid; x = 180 maps to column 0
+    assert x.min() == 0
+    assert x.max() == Nx - 1
+    assert np.all((x < 100) | (x > Nx - 100))
+
+
+def _records_dict(records):
+    Ny = HPX_grid_size(NSIDE)[1]
+    return dict(zip(records['x'] * Ny + records['y'], records['val']))
+
+
+@pytest.mark.parametrize('position', ['equator', 'seam'])
+def test_mosaic_overlap(position, kapteyn_wcs, make_chip):
+    from spheredb.conversions import FITS_to_HPX_mosaic
+
+    # two chips overlapping over about half of their area
+    RA, dec = POSITIONS[position]
+    h1, d1 = make_chip(RA - 0.1, dec, Nx=40, Ny=30, rseed=1)
+    h2, d2 = make_chip(RA + 0.1, dec, Nx=40, Ny=30, rseed=2)
+    w1 = np.ones_like(d1)
+    w2 = 3 * np.ones_like(d2)
+
+    c1 = _records_dict(FITS_to_HPX(h1, d1, NSIDE))
+    c2 = _records_dict(FITS_to_HPX(h2, d2, NSIDE))
+    both = set(c1) & set(c2)
+    assert len(both) > 100
+    assert len(set(c1) - both) > 100
+
+    mosaic = FITS_to_HPX_mosaic([(h1, d1, w1), (h2, d2, w2)], NSIDE)
+    m = _records_dict(mosaic)
+
+    # one output pixel per HPX pixel covered by either chip
+    assert_equal(len(m), len(mosaic))
+    assert_equal(set(m), set(c1) | set(c2))
+
+    # single-chip pixels are those of FITS_to_HPX; overlaps are the
+    # weighted mean of the two chips
+    for k in set(c1) - both:
+        assert_allclose(m[k], c1[k])
+    for k in set(c2) - both:
+        assert_allclose(m[k], c2[k])
+    for k in both:
+        assert_allclose(m[k], (c1[k] + 3 * c2[k]) / 4.)
+
+    # without weights the chips count equally
+    m = _records_dict(FITS_to_HPX_mosaic([(h1, d1), (h2, d2)], NSIDE))
+    for k in both:
+        assert_allclose(m[k], 0.5 * (c1[k] + c2[k]))
+
+
+def test_mosaic_threads(kapteyn_wcs, make_chip):
+    from spheredb.conversions import FITS_to_HPX_mosaic
+
+    chips = [make_chip(30. + 0.15 * i, 10. + 0.1 * (i % 2), rseed=i)
+             for i in range(6)]
+    serial = FITS_to_HPX_mosaic(chips, NSIDE, n_threads=1)
+    threaded = FITS_to_HPX_mosaic(chips, NSIDE, n_threads=4)
+    assert_equal(threaded, serial)
+
+    M = FITS_to_HPX_mosaic(chips, NSIDE, return_sparse=True, n_threads=4)
+    assert_equal(M.nnz, len(serial))
+    assert_equal(M.tocsr()[serial['x'], serial['y']].A1, serial['val'])
@@ -0,0 +1,81 @@
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose, assert_raises
+from astropy.wcs import WCS
+
+from spheredb.coverage import CoverageMap, footprint_cells
+
+
+def _header(RA, dec, size=4000, scale=10. / 3600, mjd=50000.):
+    c, s = np.cos(np.radians(17.)), np.sin(np.radians(17.))
+    return {'NAXIS': 2, 'NAXIS1': size, 'NAXIS2': size,
+            'CTYPE1': 'RA---TAN', 'CTYPE2': 'DEC--TAN',
+            'CRVAL1': RA, 'CRVAL2': dec,
+            'CRPIX1': 0.5 * (size + 1), 'CRPIX2': 0.5 * (size + 1),
+            'CD1_1': -scale * c, 'CD1_2': scale * s,
+            'CD2_1': scale * s, 'CD2_2': scale * c, 'TAI': mjd}
+
+
+def test_footprint_rasterization():
+    # equatorial, across the RA wrap, polar, and on a pole
+    for RA, dec in [(30, 10), (180, 5), (0, 70), (0, 89.9), (45, -89.5)]:
+        header = _header(RA, dec)
+        coverage = CoverageMap(32)
+        coverage.add_header(header)
+
+        # compare to the cells of a fine grid of points within the chip
+        pix = np.vstack([a.ravel() for a in
+                         np.meshgrid(*2 * [np.linspace(0, 3999, 500)])]).T
+        k, j = coverage.cell_index(*WCS(header).wcs_pix2world(pix, 0).T)
+        hit = np.zeros(coverage.counts.shape, dtype=bool)
+        hit[k, j] = True
+        covered = coverage.coverage()
+
+        assert not np.any(covered & ~hit)
+        assert np.sum(hit & ~covered) <= 0.05 * hit.sum()
+
+
+def test_coverage_counts_and_times(tmpdir):
+    coverage = CoverageMap(32)
+    for mjd in [50000., 50010., 50005.]:
+        coverage.add_header(_header(30, 10, size=500, mjd=mjd))
+    coverage.add_header(_header(36, 10, size=500, mjd=49000.))
+    assert_equal(coverage.n_exposures, 4)
+
+    count, t_min, t_max = coverage.lookup([30, 36, 100], [10, 10, 10])
+    assert_equal(count, [3, 1, 0])
+    assert_equal(t_min[:2], [50000, 49000])
+    assert_equal(t_max[:2], [50010, 49000])
+    assert np.isnan(t_min[2])
+
+    # incremental merge and persistence
+    other = CoverageMap(32)
+    other.add_header(_header(30, 10, size=500, mjd=51000.))
+    coverage.merge(other)
+    assert_equal(coverage.lookup(30, 10)[0], 4)
+    assert_equal(coverage.lookup(30, 10)[2], 51000)
+    assert_raises(ValueError, coverage.merge, CoverageMap(16))
+
+    path = str(tmpdir.join('coverage.npz'))
+    coverage.save(path)
+    loaded = CoverageMap.load(path)
+    assert_equal(loaded.counts, coverage.counts)
+    assert_allclose(loaded.t_max, coverage.t_max)
+    assert_equal(loaded.n_exposures, 5)
+
+
+def test_coverage_hpx_bounds():
+    x0 = 30.
+    k, j = footprint_cells(*_square_boundary(), Nside=32,
+                           hpx_bounds=(x0, 40., -90., 90.))
+    step = 45. / 32
+    assert np.all(-180. + (k + 1) * step > x0)
+    coverage = CoverageMap(32)
+    coverage.add_footprint(*_square_boundary(), mjd=50000.)
+    assert_equal(coverage.depth((x0, 40., -90., 90.)).sum(), len(k))
+
+
+def _square_boundary():
+    t = np.linspace(0, 1, 32, endpoint=False)
+    RA = np.concatenate([25 + 10 * t, 35 + 0 * t, 35 - 10 * t, 25 + 0 * t])
+    dec = np.concatenate([5 + 0 * t, 5 + 10 * t, 15 + 0 * t, 15 - 10 * t])
+    return RA, dec
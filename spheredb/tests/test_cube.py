@@ -0,0 +1,172 @@
+import os
+
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose, assert_raises
+
+from spheredb.cube import SparseCube
+from spheredb.records import DEFAULT_SCHEMA
+from spheredb.util import partition_records
+
+
+def random_records(shape, n, rseed=0):
+    rng = np.random.RandomState(rseed)
+    cells = rng.choice(np.prod(shape), n, replace=False)
+    x, y, time = np.unravel_index(cells, shape)
+    records = np.zeros(n, dtype=DEFAULT_SCHEMA.dtype)
+    records['time'] = time
+    records['x'] = x
+    records['y'] = y
+    records['val'] = rng.rand(n)
+    return records
+
+
+def dense(records, shape):
+    out = np.zeros(shape)
+    out[records['x'], records['y'], records['time']] = records['val']
+    return out
+
+
+def test_cube_roundtrip(tmpdir):
+    shape = (20, 30, 5)
+    records = random_records(shape, 500)
+    cube = SparseCube.from_records(str(tmpdir), records, shape, (8, 8))
+    assert_equal(cube.nnz, 500)
+    assert_equal(len(cube.tiles), 12)
+
+    # records come out sorted by tile, then (x, y, time)
+    out = cube.to_records()
+    assert_equal(out.dtype.names, ('time', 'x', 'y', 'val'))
+    assert_equal(dense(out, shape), dense(records, shape))
+
+    pixel, indptr, time, val = cube.tile((0, 0))
+    assert isinstance(val, np.memmap)
+    assert np.all(np.diff(pixel) > 0)
+    assert np.all(np.diff(time)[np.diff(np.repeat(pixel,
+                                                  np.diff(indptr))) == 0] > 0)
+
+    # the cube can be re-opened
+    cube = SparseCube(str(tmpdir))
+    assert_equal(cube.shape, shape)
+    assert_equal(dense(cube.to_records(), shape), dense(records, shape))
+    assert_raises(ValueError, SparseCube, str(tmpdir), (1, 2, 3))
+
+
+def test_cube_append(tmpdir):
+    shape = (20, 30, 5)
+    records = random_records(shape, 300)
+    cube = SparseCube(str(tmpdir), shape, (8, 8))
+    cube.append(records[:200])
+    cube.append(partition_records(records[100:], (8, 8)))
+
+    # overlapping cells are replaced
+    update = records[:50].copy()
+    update['val'] = -1
+    cube.append(update)
+    expected = dense(records, shape)
+    expected[update['x'], update['y'], update['time']] = -1
+    assert_equal(cube.nnz, 300)
+    assert_equal(dense(cube.to_records(), shape), expected)
+
+    # superseded tile files are removed
+    assert_equal(len(os.listdir(str(tmpdir))), 4 * len(cube.tiles) + 2)
+
+    bad = records[:1].copy()
+    bad['time'] = 5
+    assert_raises(ValueError, cube.append, bad)
+
+
+def test_cube_subarray_and_reduce(tmpdir):
+    shape = (20, 30, 5)
+    records = random_records(shape, 1000)
+    full = dense(records, shape)
+    mask = np.zeros(shape, dtype=bool)
+    mask[records['x'], records['y'], records['time']] = True
+    cube = SparseCube.from_records(str(tmpdir), records, shape, (8, 8))
+
+    sub = cube.subarray(x=(5, 13), time=(1, None))
+    expected = np.zeros(shape)
+    expected[5:13, :, 1:] = full[5:13, :, 1:]
+    assert_equal(dense(sub, shape), expected)
+
+    counts = mask.sum(2)
+    for func, ref in [('sum', full.sum(2)),
+                      ('max', np.where(mask, full, -1).max(2)),
+                      ('count', counts),
+                      ('mean', full.sum(2) / np.maximum(counts, 1))]:
+        out = cube.reduce('time', func)
+        assert_equal(out.dtype.names, ('x', 'y', 'val'))
+        assert_equal(len(out), np.sum(counts > 0))
+        assert_allclose(out['val'], ref[out['x'], out['y']])
+
+    out = cube.mean(('x', 'y'), y=(10, 20))
+    assert_equal(out.dtype.names, ('time', 'val'))
+    assert_allclose(out['val'], full[:, 10:20].sum((0, 1))
+                    / mask[:, 10:20].sum((0, 1)))
+    assert_allclose(cube.sum()['val'], [full.sum()])
+
+    assert_allclose(cube.to_coo(2).toarray(), full[:, :, 2])
+    assert_allclose(cube.to_coo(time=(0, 2)).toarray(),
+                    full[:, :, :2].sum(2))
+    assert_raises(ValueError, cube.reduce, 'time', 'median')
+
+
+def test_cube_append_sparse(tmpdir):
+    from scipy import sparse
+    M = sparse.coo_matrix(([1., 2.], ([1, 3], [2, 4])), shape=(10, 10))
+    cube = SparseCube(str(tmpdir), (10, 10, 3), (4, 4))
+    cube.append_sparse(M, 1)
+    assert_equal(cube.to_coo(1).toarray(), M.toarray())
+    assert_equal(cube.to_coo(0).nnz, 0)
+
+
+def test_cube_difference(tmpdir):
+    shape = (20, 30, 6)
+    rng = np.random.RandomState(1)
+    full = rng.normal(10, 1, shape)
+    full[:, :, 4] += 4 * (rng.rand(20, 30) < 0.05)
+    x, y, t = np.nonzero(rng.rand(*shape) < 0.9)
+    records = np.zeros(len(x), dtype=DEFAULT_SCHEMA.dtype)
+    records['x'], records['y'], records['time'] = x, y, t
+    records['val'] = full[x, y, t]
+    mask = np.zeros(shape, dtype=bool)
+    mask[x, y, t] = True
+    cube = SparseCube.from_records(str(tmpdir), records, shape, (8, 8))
+
+    out = cube.difference(4, reference=(0, 4), threshold=3)
+    assert_equal(out.dtype.names, ('x', 'y', 'diff', 'variance', 'snr'))
+    assert len(out) > 0
+
+    ref = np.ma.masked_array(full[:, :, :4], ~mask[:, :, :4])
+    n = ref.count(2)
+    diff = full[:, :, 4] - ref.mean(2)
+    variance = ref.var(2, ddof=1) * (1 + 1. / n)
+    snr = diff / np.sqrt(variance)
+    expected = mask[:, :, 4] & (n >= 2) & (abs(snr) >= 3)
+    expected = np.ma.filled(expected, False)
+
+    assert_equal(len(out), expected.sum())
+    assert np.all(expected[out['x'], out['y']])
+    assert_allclose(out['diff'], diff[out['x'], out['y']])
+    assert_allclose(out['snr'], snr[out['x'], out['y']])
+
+
+def test_cube_compact_records(tmpdir):
+    from spheredb.records import RecordSchema
+
+    # int32 indices: the tile keys overflow unless computed in int64
+    schema = RecordSchema.compact_schema(epoch=50000)
+    records = schema.records([1, 2], [3, 4], [1., 2.], 50001.)
+    shape = (5, 5, schema.Nt)
+    cube = SparseCube.from_records(str(tmpdir), records, shape, (4, 4))
+
+    out = cube.to_records()
+    assert_equal(out['x'], [1, 2])
+    assert_equal(out['y'], [3, 4])
+    assert_equal(out['time'], 2 * [86400])
+    assert_allclose(out['val'], [1., 2.])
+
+    # appending to the existing tiles keeps the earlier records
+    cube.append(schema.records([2], [4], [3.], 50002.))
+    out = cube.to_records()
+    assert_equal(out['time'], [86400, 86400, 2 * 86400])
+    assert_allclose(out['val'], [1., 2., 3.])
@@ -0,0 +1,49 @@
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose, assert_raises
+from astropy.io import fits
+
+from spheredb.fits_headers import (read_header, header_mjd,
+                                   read_exposure_date, exposure_dates,
+                                   mjd_to_seconds)
+
+
+def _write_exposure(path, mjd, key='MJD-OBS', in_primary=False):
+    primary = fits.PrimaryHDU()
+    image = fits.ImageHDU(np.zeros((4, 3), dtype=np.float32))
+    if in_primary:
+        primary.header[key] = mjd
+    else:
+        image.header[key] = mjd
+    fits.HDUList([primary, image]).writeto(path)
+    return path
+
+
+def test_header_mjd():
+    assert_equal(header_mjd({'TAI': 1.5}), 1.5)
+    assert_equal(header_mjd({'TAI': 1.5, 'MJD-OBS': 2.5}), 2.5)
+    assert_raises(KeyError, header_mjd, {'DATE': 0})
+
+
+def test_read_exposure_date(tmpdir):
+    f1 = _write_exposure(str(tmpdir.join('S00.fits')), 50095.25)
+    f2 = _write_exposure(str(tmpdir.join('S01.fits')), 50096.5,
+                         key='TAI', in_primary=True)
+
+    assert_equal(read_header(f1)['NAXIS1'], 3)
+    assert_allclose(read_exposure_date(f1), 50095.25)
+    assert_allclose(read_exposure_date(f2), 50096.5)
+    assert_allclose(exposure_dates([f1, f2]), [50095.25, 50096.5])
+
+
+def test_read_exposure_date_single_hdu(tmpdir):
+    path = str(tmpdir.join('single.fits'))
+    hdu = fits.PrimaryHDU(np.zeros((4, 3), dtype=np.float32))
+    hdu.header['MJD-OBS'] = 50097.75
+    hdu.writeto(path)
+
+    assert_allclose(read_exposure_date(path), 50097.75)
+    assert_allclose(exposure_dates([path]), [50097.75])
+
+
+def test_mjd_to_seconds():
+    assert_equal(mjd_to_seconds(1.5), 129600)
@@ -0,0 +1,204 @@
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose
+from astropy.io import fits
+
+from spheredb.footprint import (points_in_polygon, polygons_intersect,
+                                HPXBox, Cone, Polygon, select_exposures,
+                                angular_separation, split_HPX_bounds,
+                                HPX_regions, HPX_pole_points, HPX_valid,
+                                HPX_wrap_bounds)
+from spheredb.hpx_utils import RAdec_to_HPX
+
+
+def _square(RA, dec, half_width):
+    """RA/dec corners of a small square centered on (RA, dec)"""
+    w = half_width / np.cos(np.radians(dec))
+    return (np.array([RA - w, RA + w, RA + w, RA - w]) % 360,
+            np.array([dec - half_width, dec - half_width,
+                      dec + half_width, dec + half_width]))
+
+
+def test_points_in_polygon():
+    px = [0, 2, 2, 0]
+    py = [0, 0, 1, 1]
+    assert_equal(points_in_polygon([1, 3, 1, -1], [0.5, 0.5, 2, 0.5],
+                                   px, py),
+                 [True, False, False, False])
+
+    # a non-convex polygon
+    px = [0, 4, 4, 3, 3, 0]
+    py = [0, 0, 3, 3, 1, 1]
+    assert_equal(points_in_polygon([2, 2, 3.5], [0.5, 2, 2], px, py),
+                 [True, False, True])
+
+
+def test_polygons_intersect():
+    square = ([0, 1, 1, 0], [0, 0, 1, 1])
+    assert polygons_intersect([0.5, 2, 2, 0.5], [0.5, 0.5, 2, 2], *square)
+    assert not polygons_intersect([2, 3, 3, 2], [0, 0, 1, 1], *square)
+
+    # a cross: no vertex is inside the other polygon
+    assert polygons_intersect([-1, 2, 2, -1], [0.4, 0.4, 0.6, 0.6],
+                              [0.4, 0.6, 0.6, 0.4], [-1, -1, 2, 2])
+
+
+def test_cone():
+    cone = Cone(10, 20, 1.0)
+    RA, dec = cone.boundary()
+    assert_allclose(angular_separation(10, 20, RA, dec), 1.0)
+
+    assert cone.intersects(*_square(10, 20, 0.1))
+    assert cone.intersects(*_square(11.4, 20, 0.5))
+    assert not cone.intersects(*_square(13, 20, 0.5))
+
+    # the cone inside a large footprint
+    assert Cone(10, 20, 0.01).intersects(*_square(10, 20, 5))
+
+    # across RA = 0
+    assert Cone(359.9, 0, 0.5).intersects(*_square(0.2, 0, 0.1))
+
+    xmin, xmax, ymin, ymax = Cone(0, 89.5, 1).HPX_bounds()
+    assert_equal((xmin, xmax, ymax), (-180, 180, 90))
+
+
+def test_box_and_polygon():
+    x, y = RAdec_to_HPX(30, 10)
+    box = HPXBox(x - 1, x + 1, y - 1, y + 1)
+    assert box.intersects(*_square(30, 10, 0.2))
+    assert not box.intersects(*_square(35, 10, 0.2))
+
+    poly = Polygon([29, 31, 30], [9, 9, 11])
+    assert poly.intersects(*_square(30, 10, 0.2))
+    assert poly.intersects(*_square(31, 9, 0.2))
+    assert not poly.intersects(*_square(31, 11, 0.2))
+
+
+def _chip_boxes(RA, dec, half_width=1.0):
+    """split_HPX_bounds of a densely sampled square chip"""
+    t = np.linspace(-half_width, half_width, 41)
+    dRA, ddec = [a.ravel() for a in np.meshgrid(t, t)]
+    dec_s = dec + ddec
+    RA_s = RA + dRA / np.cos(np.radians(np.clip(dec_s, -89.99, 89.99)))
+    x, y = RAdec_to_HPX(RA_s % 360, np.clip(dec_s, -90, 90))
+    if abs(dec) + half_width >= 90:
+        px, py = HPX_pole_points(north=(dec > 0))
+        x, y = np.concatenate([x, px]), np.concatenate([y, py])
+    return split_HPX_bounds(x, y)
+
+
+def test_split_HPX_bounds():
+    def area(boxes):
+        return sum((b[1] - b[0]) * (b[3] - b[2]) for b in boxes)
+
+    assert_equal(len(_chip_boxes(30, 10)), 1)
+
+    # across the RA wrap: two small boxes rather than one spanning the plane
+    boxes = _chip_boxes(180, 10)
+    assert_equal(len(boxes), 2)
+    assert area(boxes) < 2 * area(_chip_boxes(30, 10))
+
+    # across a seam between polar facets
+    boxes = _chip_boxes(0, 70, 2.0)
+    assert_equal(len(boxes), 2)
+    boxes = sorted(boxes)
+    assert boxes[0][1] <= 0 and boxes[1][0] >= 0
+
+    # a chip on the pole touches all four facet apexes
+    boxes = _chip_boxes(0, 89.5)
+    assert_equal(len(boxes), 4)
+    assert area(boxes) < 100
+
+    # padding never crosses region boundaries
+    boxes = split_HPX_bounds([-91, -89], [60, 61], pad=5)
+    assert_equal(boxes, [(-96, -90, 55, 65), (-90, -84, 56, 66)])
+
+
+def test_HPX_wrap_bounds():
+    box, = HPX_wrap_bounds(*_square(30, 10, 0.5))
+    assert box[1] - box[0] < 2
+
+    # across the wrap: one box on each side, rather than one spanning the
+    # plane
+    boxes = sorted(HPX_wrap_bounds(*_square(180, 10, 0.5)))
+    assert_equal(len(boxes), 2)
+    assert_allclose([boxes[0][0], boxes[1][1]], [-180, 180], atol=1)
+    assert boxes[0][1] < -179 and boxes[1][0] > 179
+
+
+def test_HPX_regions():
+    assert_equal(HPX_regions([0, -170, 100, -100, 179], [0, 50, 80, -50, -46]),
+                 [0, 1, 4, 5, 8])
+    assert_equal(HPX_valid([-135, -135, -90, -90, 0], [89, 50, 80, 40, 91]),
+                 [True, True, False, True, False])
+
+
+def _write_chip(path, RA, dec, mjd, Nx=40, Ny=30, scale=0.01):
+    header = fits.Header()
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRVAL1'] = RA
+    header['CRVAL2'] = dec
+    header['CRPIX1'] = 0.5 * (Nx + 1)
+    header['CRPIX2'] = 0.5 * (Ny + 1)
+    header['CDELT1'] = -scale
+    header['CDELT2'] = scale
+    header['MJD-OBS'] = mjd
+    hdu = fits.ImageHDU(np.zeros((Ny, Nx), dtype=np.float32), header=header)
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(path)
+    return path
+
+
+def test_select_exposures(tmpdir):
+    files = [_write_chip(str(tmpdir.join('S0{0}.fits'.format(i))),
+                         RA, 0., mjd)
+             for i, (RA, mjd) in enumerate([(10, 1.), (10.3, 2.), (50, 3.)])]
+
+    assert_equal(len(select_exposures(files)), 3)
+    selected = select_exposures(files, time_window=(1.5, None))
+    assert_equal([f for (f, bounds) in selected], files[1:])
+    assert all(bounds is None for (f, bounds) in selected)
+
+    selected = select_exposures(files, Cone(10.1, 0, 0.1))
+    assert_equal([f for (f, bounds) in selected], files[:2])
+
+    # only the overlapping part of the chip is kept
+    xmin, xmax, ymin, ymax = selected[0][1]
+    assert_allclose([xmin, xmax], [10.0, 10.195], atol=1E-3)
+    assert_allclose([ymin, ymax], RAdec_to_HPX(0, [-0.1, 0.1])[1],
+                    atol=1E-3)
+
+    selected = select_exposures(files, Cone(10.1, 0, 0.1), (1.5, 2.5))
+    assert_equal([f for (f, bounds) in selected], files[1:2])
+
+    # footprints and times from a catalog
+    from spheredb.catalog import ExposureCatalog
+    catalog = ExposureCatalog(str(tmpdir.join('catalog.db')))
+    catalog.update(files, processes=1)
+    selected = select_exposures(files, Cone(10.1, 0, 0.1), (1.5, 2.5),
+                                catalog=catalog)
+    assert_equal([f for (f, bounds) in selected], files[1:2])
+
+
+def test_select_exposures_wrap(tmpdir):
+    from spheredb.catalog import ExposureCatalog
+
+    files = [_write_chip(str(tmpdir.join('S00.fits')), 180., 0., 1.)]
+    catalog = ExposureCatalog(str(tmpdir.join('catalog.db')))
+    catalog.update(files, processes=1)
+
+    for kwargs in [{}, {'catalog': catalog}]:
+        # a box far from the chip does not select it
+        assert_equal(select_exposures(files, HPXBox(0, 10, -5, 5),
+                                      **kwargs), [])
+
+        # a box on one side of the wrap selects that side only
+        (f, bounds), = select_exposures(files, HPXBox(170, 180, -5, 5),
+                                        **kwargs)
+        assert 179.5 < bounds[0] < bounds[1] <= 180
+
+        # a cone on the wrap selects both sides, each with its own box
+        selected = select_exposures(files, Cone(180, 0, 0.05), **kwargs)
+        assert_equal([f for (f, bounds) in selected], 2 * files)
+        boxes = sorted(bounds for (f, bounds) in selected)
+        assert -180 <= boxes[0][0] < boxes[0][1] < -179.5
+        assert 179.5 < boxes[1][0] < boxes[1][1] <= 180
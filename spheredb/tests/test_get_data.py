@@ -0,0 +1,56 @@
+import bz2
+import os
+
+import numpy as np
+from numpy.testing import assert_equal
+from astropy.io import fits
+
+from spheredb.get_data import decompress_bz2, process_stripe82_frames
+
+
+def _write_frame_bz2(path, value):
+    data = value * np.ones((20, 30), dtype=np.float32)
+    fitsfile = path[:-4]
+    fits.PrimaryHDU(data).writeto(fitsfile)
+    with open(fitsfile, 'rb') as src:
+        with bz2.BZ2File(path, 'wb') as dst:
+            dst.write(src.read())
+    os.remove(fitsfile)
+    return path
+
+
+def frame_sum(hdulist):
+    return float(hdulist[0].data.sum())
+
+
+def test_decompress_bz2(tmpdir):
+    bz2file = _write_frame_bz2(str(tmpdir.join('frame.fits.bz2')), 1.)
+
+    # small chunks exercise the streaming copy
+    fitsfile = decompress_bz2(bz2file, chunk_size=100)
+    assert_equal(fitsfile, str(tmpdir.join('frame.fits')))
+    with fits.open(fitsfile) as hdulist:
+        assert_equal(hdulist[0].data.shape, (20, 30))
+    assert_equal(sorted(os.listdir(str(tmpdir))),
+                 ['frame.fits', 'frame.fits.bz2'])
+
+    # an up-to-date output is not decompressed again
+    mtime = os.path.getmtime(fitsfile)
+    assert_equal(decompress_bz2(bz2file), fitsfile)
+    assert_equal(os.path.getmtime(fitsfile), mtime)
+
+    other = str(tmpdir.join('other.fits'))
+    assert_equal(decompress_bz2(bz2file, other), other)
+    assert os.path.exists(other)
+
+
+def test_process_stripe82_frames(tmpdir):
+    bz2files = [_write_frame_bz2(str(tmpdir.join('f{0}.fits.bz2'.format(i))),
+                                 i) for i in range(3)]
+
+    paths = process_stripe82_frames(bz2files, processes=1)
+    assert_equal(paths, [f[:-4] for f in bz2files])
+
+    for processes in (1, 2):
+        sums = process_stripe82_frames(bz2files, frame_sum, processes)
+        assert_equal(sums, [0., 600., 1200.])
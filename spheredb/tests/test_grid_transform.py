@@ -0,0 +1,41 @@
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose, assert_raises
+
+from spheredb.grid_transform import CoarseGridTransform
+
+
+def gnomonic(X):
+    """A smooth, mildly non-linear transform"""
+    x, y = np.radians(X.T / 100.)
+    r = 1 + 0.1 * np.sin(x) * np.cos(y)
+    return 1000 * np.vstack([np.tan(x) * r, np.tan(y) / r]).T
+
+
+def test_coarse_grid_transform():
+    x = np.arange(-200, 300)
+    y = np.arange(50, 351)
+    exact = gnomonic(np.vstack([np.ravel(a)
+                                for a in np.meshgrid(x, y)]).T)
+
+    T = CoarseGridTransform(gnomonic, tol=1E-3)
+    approx = T(x, y)
+    assert_equal(approx.shape, (len(y), len(x), 2))
+    assert_allclose(approx.reshape(-1, 2), exact, atol=1E-3, rtol=0)
+    assert 0 < T.max_error <= 1E-3
+    assert T.n_evaluations * 100 < len(x) * len(y)
+
+
+def test_coarse_grid_transform_fallback():
+    # a kink cannot be interpolated: the grid is evaluated exactly
+    kink = lambda X: abs(X - 10.5)
+    x = np.arange(64)
+    T = CoarseGridTransform(kink, tol=1E-6)
+    assert_equal(T(x, x), kink(np.dstack(np.meshgrid(x, x))))
+    assert_equal(T.max_error, 0)
+
+    # small grids are evaluated exactly
+    T = CoarseGridTransform(gnomonic, tol=1)
+    T(np.arange(10), np.arange(10))
+    assert_equal(T.n_evaluations, 100)
+
+    assert_raises(ValueError, CoarseGridTransform, gnomonic, 1, 2, 4)
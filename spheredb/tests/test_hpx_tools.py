@@ -35,3 +35,36 @@ def test_roundtrip():
 
     assert_allclose(RA + np.zeros_like(dec), RA_out)
     assert_allclose(dec + np.zeros_like(RA), dec_out)
+
+
+def test_grid_tables():
+    from numpy.testing import assert_equal, assert_raises
+    from spheredb.hpx_utils import (HPX_grid_table, HPX_grid_to_RAdec,
+                                    HPXGridTable)
+
+    for Nside, offset in [(8, 0.), (8, 0.5), (256, 0.)]:
+        table = HPX_grid_table(Nside, offset)
+        i = np.arange(8 * Nside)
+        j = np.arange(table.shape[1])
+        RA, dec = table.RAdec_grid(i, j)
+        assert_equal(RA.shape, (len(j), len(i)))
+
+        step = 45. / Nside
+        RA2, dec2 = HPX_to_RAdec((i + offset) * step - 180,
+                                 (j[:, None] + offset) * step - 90)
+        assert_allclose(RA, RA2, atol=1E-10)
+        assert_allclose(dec, dec2 + 0 * RA2, atol=1E-10)
+
+    # tables are memoized per Nside
+    assert HPX_grid_table(8) is HPX_grid_table(8)
+    assert isinstance(HPX_grid_table(8), HPXGridTable)
+    assert_allclose(HPX_grid_to_RAdec([0, 42], [16, 20], 8),
+                    HPX_to_RAdec([-180, 56.25], [0, 22.5]))
+    assert_raises(ValueError, HPX_grid_to_RAdec, 64, 0, 8)
+    assert_raises(ValueError, HPX_grid_to_RAdec, -1, 0, 8)
+
+    # the indices are those of the pixel store
+    from spheredb.photometry import source_grid_coords
+    RA, dec = HPX_grid_to_RAdec([20, 3, 31], [8, 14, 12], 4)
+    assert_allclose(source_grid_coords(RA, dec, 4), ([20, 3, 31], [8, 14, 12]),
+                    atol=1E-10)
@@ -0,0 +1,56 @@
+"""
+Tests of the import cost of the light-weight modules.
+
+Each check runs in a fresh interpreter, so that modules imported by other
+tests do not hide an eager import of a backend.
+"""
+import subprocess
+import sys
+
+from numpy.testing import assert_equal
+
+# optional backends which must only be imported when used
+BACKENDS = ('kapteyn', 'lsst', 'scidbpy', 'matplotlib', 'astropy',
+            'pyfits', 'astroML')
+
+# import time allowed for the pure-NumPy modules, beyond numpy itself
+STARTUP_BUDGET = 0.25
+
+SCRIPT = """
+import sys
+from timeit import default_timer
+import numpy
+t0 = default_timer()
+for module in {modules!r}:
+    __import__(module)
+print(default_timer() - t0)
+print(' '.join(sorted(set(name.split('.')[0] for name in sys.modules)
+                      & set({backends!r}))))
+"""
+
+
+def _import_in_subprocess(modules):
+    output = subprocess.check_output(
+        [sys.executable, '-c', SCRIPT.format(modules=modules,
+                                             backends=BACKENDS)],
+        universal_newlines=True)
+    elapsed, loaded = output.split('\n')[:2]
+    return float(elapsed), loaded.split()
+
+
+def test_startup_budget():
+    elapsed, loaded = _import_in_subprocess(['spheredb.hpx_utils',
+                                             'spheredb.grid_interpolation'])
+    assert_equal(loaded, [])
+    assert elapsed < STARTUP_BUDGET, elapsed
+
+
+def test_backends_are_lazy():
+    modules = ['spheredb.conversions', 'spheredb.fits_headers',
+               'spheredb.footprint', 'spheredb.catalog', 'spheredb.coverage',
+               'spheredb.cube', 'spheredb.photometry',
+               'spheredb.sdb_from_warped', 'spheredb.scidb_tools',
+               'spheredb.lsst_warp', 'spheredb.get_data']
+    for module in modules:
+        elapsed, loaded = _import_in_subprocess([module])
+        assert_equal(loaded, [], module)
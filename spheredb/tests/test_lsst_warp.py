@@ -0,0 +1,205 @@
+"""
+Tests of LSSTWarper: setup caching, the warp cache, destination boxes,
+metrics and tile statistics.
+
+The LSST stack is usually not available where the tests run, so the few
+afw/daf entry points used by lsst_warp are replaced by light-weight stubs
+in the tests which reach them.  The stubs are used even where the stack
+is installed, so that these tests check the same values everywhere.
+"""
+import sys
+import types
+
+import pytest
+from numpy.testing import assert_equal
+
+from spheredb.lsst_warp import LSSTWarper
+
+
+@pytest.fixture
+def lsst_stubs(monkeypatch):
+    class PropertySet(dict):
+        def add(self, key, val):
+            self[key] = val
+
+    class Warper(object):
+        def __init__(self, kernel):
+            self.kernel = kernel
+
+    modules = {}
+    for name in ['lsst', 'lsst.afw', 'lsst.afw.geom', 'lsst.afw.image',
+                 'lsst.afw.math', 'lsst.daf', 'lsst.daf.base']:
+        modules[name] = types.ModuleType(name)
+        if '.' in name:
+            parent, child = name.rsplit('.', 1)
+            setattr(modules[parent], child, modules[name])
+    modules['lsst.afw.geom'].Point2I = lambda x, y: (x, y)
+    modules['lsst.afw.geom'].Box2I = lambda p1, p2: (p1, p2)
+    modules['lsst.afw.image'].makeWcs = lambda ps: dict(ps)
+    modules['lsst.afw.math'].Warper = Warper
+    modules['lsst.daf.base'].PropertySet = PropertySet
+    for name, module in modules.items():
+        monkeypatch.setitem(sys.modules, name, module)
+    return modules
+
+
+class CountingWarper(LSSTWarper):
+    def __init__(self, *args, **kwargs):
+        self.n_wcs = self.n_warper = 0
+        LSSTWarper.__init__(self, *args, **kwargs)
+
+    def make_wcs(self):
+        self.n_wcs += 1
+        return ('wcs', self.cdelt, self.cunit)
+
+    def make_warper(self):
+        self.n_warper += 1
+        return ('warper', self.kernel)
+
+
+def test_setup_cached():
+    W = CountingWarper(cdelt=3, cunit='arcsec', kernel='lanczos2')
+    setups = [W.warp_setup() for i in range(5)]
+
+    assert_equal(W.n_wcs, 1)
+    assert_equal(W.n_warper, 1)
+    assert all(s is setups[0] for s in setups)
+
+
+def test_setup_cache_keyed_on_parameters():
+    W = CountingWarper(cdelt=3, cunit='arcsec', kernel='lanczos2')
+    s1 = W.warp_setup()
+
+    W.kernel = 'bilinear'
+    s2 = W.warp_setup()
+    assert_equal(s2, (('wcs', 3, 'arcsec'), ('warper', 'bilinear')))
+
+    W.kernel = 'lanczos2'
+    assert W.warp_setup() is s1
+    assert_equal(W.n_warper, 2)
+
+    W.clear_setup_cache()
+    W.warp_setup()
+    assert_equal(W.n_warper, 3)
+
+
+def test_setup_uncached():
+    W = CountingWarper(cache_setup=False)
+    for i in range(3):
+        W.warp_setup()
+    assert_equal(W.n_wcs, 3)
+    assert_equal(W.n_warper, 3)
+
+
+def test_setup_time_totals():
+    class Warper(object):
+        def warpExposure(self, destWcs, srcExposure):
+            return srcExposure
+
+    W = CountingWarper()
+    W.make_warper = Warper
+    for i in range(4):
+        assert_equal(W.warped_from_exposure('exp'), 'exp')
+    assert_equal(W.n_setups, 4)
+    assert W.setup_time >= 0
+
+
+def test_default_make_wcs(lsst_stubs):
+    W = LSSTWarper(cdelt=1, cunit='arcmin')
+    wcs, warper = W.warp_setup()
+    assert_equal(wcs['CTYPE1'], 'RA---HPX')
+    assert_equal(wcs['CDELT1'], 1. / 60.)
+    assert_equal(wcs['CDELT2'], 1. / 60.)
+    assert_equal(warper.kernel, 'lanczos2')
+
+
+class FakeInterface(object):
+    def __init__(self):
+        self.uploads = []
+
+    def from_array(self, arr):
+        self.uploads.append(arr)
+        return arr
+
+    def new_array(self, **kwargs):
+        return kwargs
+
+    def query(self, *args):
+        pass
+
+
+class SingleReadWarper(LSSTWarper):
+    def __init__(self, *args, **kwargs):
+        self.reads = []
+        LSSTWarper.__init__(self, *args, **kwargs)
+
+    def exposure_from_fits(self, fitsfile):
+        self.reads.append(fitsfile)
+        return fitsfile
+
+    @staticmethod
+    def exposure_date(exposure):
+        return 50095.5
+
+    def sparse_from_exposure(self, exp, hpx_bounds=None):
+        from scipy import sparse
+        return sparse.coo_matrix(([1., 2.], ([1, 2], [3, 4])), shape=(5, 5))
+
+
+def test_scidb3d_single_read():
+    W = SingleReadWarper(interface=FakeInterface())
+    W.scidb3d_from_fits('S11.fits')
+    assert_equal(W.reads, ['S11.fits'])
+
+    uploads = W.interface.uploads
+    assert_equal(len(uploads), 1)
+    assert_equal(uploads[0]['time'], 2 * [int(50095.5 * 24 * 60 * 60)])
+    assert_equal(uploads[0]['val'], [1., 2.])
+
+
+def test_warp_cache_hit(tmpdir):
+    from spheredb.warp_cache import WarpCache
+
+    fitsfile = tmpdir.join('S11.fits')
+    fitsfile.write('not really fits')
+
+    W = SingleReadWarper(cache=WarpCache(str(tmpdir.join('cache'))))
+    W.get_exposure_date = lambda fitsfile: 50095.5
+
+    t1, sp1 = W.date_and_sparse_from_fits(str(fitsfile))
+    t2, sp2 = W.date_and_sparse_from_fits(str(fitsfile))
+
+    assert_equal(len(W.reads), 1)
+    assert_equal(t1, t2)
+    assert_equal(sp2.shape, (W.Ny, W.Nx))
+    assert_equal(sp2.row, [1, 2])
+    assert_equal(sp2.col, [3, 4])
+    assert_equal(sp2.data, [1., 2.])
+
+
+def test_dest_bbox(lsst_stubs):
+    W = LSSTWarper(cdelt=1, cunit='deg')
+    bbox = W.dest_bbox((10.5, 20, -5, 3.2))
+    assert_equal(bbox, ((9, -6), (21, 5)))
+
+
+def test_scidb3d_metrics():
+    from spheredb.metrics import Metrics
+
+    metrics = Metrics()
+    W = SingleReadWarper(interface=FakeInterface(), metrics=metrics)
+    W.scidb3d_from_fits('S11.fits')
+
+    assert_equal(sorted(metrics.stages),
+                 ['records', 'redimension', 'upload'])
+    assert_equal(metrics.counters['bytes_uploaded'], 2 * 32)
+
+
+def test_scidb3d_stats():
+    from spheredb.tile_stats import TileStats
+
+    stats = TileStats((2, 2))
+    W = SingleReadWarper(interface=FakeInterface())
+    W.scidb3d_from_fits('S11.fits', stats=stats)
+    assert_equal(stats.count, 2)
+    assert_equal(stats.index_bounds()[:4], [1, 2, 3, 4])
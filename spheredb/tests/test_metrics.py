@@ -0,0 +1,93 @@
+import json
+import threading
+
+import numpy as np
+from numpy.testing import assert_equal
+
+from spheredb.metrics import Metrics, NULL_METRICS
+
+
+def test_stages_and_counters():
+    metrics = Metrics()
+    for i in range(3):
+        with metrics.stage('read'):
+            pass
+    with metrics.stage('warp'):
+        pass
+    metrics.count('pixels', 100)
+    metrics.count('pixels', 20)
+    metrics.count('files')
+
+    stats = metrics.as_dict()
+    assert_equal(stats['stages']['read']['calls'], 3)
+    assert_equal(stats['stages']['warp']['calls'], 1)
+    assert stats['stages']['read']['seconds'] >= 0
+    assert (stats['stages']['read']['max_seconds'] <=
+            stats['stages']['read']['seconds'])
+    assert_equal(stats['counters'], {'pixels': 120, 'files': 1})
+    assert_equal(json.loads(metrics.to_json()), stats)
+
+    metrics.reset()
+    assert_equal(metrics.as_dict(), {'stages': {}, 'counters': {}})
+
+
+def test_stage_records_exceptions():
+    metrics = Metrics()
+    try:
+        with metrics.stage('read'):
+            raise IOError()
+    except IOError:
+        pass
+    assert_equal(metrics.stages['read']['calls'], 1)
+
+
+def test_prometheus():
+    metrics = Metrics()
+    with metrics.stage('read'):
+        pass
+    metrics.count('bytes_uploaded', 64)
+
+    lines = metrics.to_prometheus().splitlines()
+    assert '# TYPE spheredb_stage_seconds_total counter' in lines
+    assert 'spheredb_stage_calls_total{stage="read"} 1' in lines
+    assert 'spheredb_bytes_uploaded_total 64' in lines
+    assert not any('peak_bytes' in line for line in lines)
+
+
+def test_trace_memory_and_callback():
+    calls = []
+    metrics = Metrics(trace_memory=True,
+                      callback=lambda *args: calls.append(args))
+    with metrics.stage('alloc'):
+        x = np.ones(1000000)
+    del x
+
+    assert metrics.stages['alloc']['peak_bytes'] >= 8000000
+    assert_equal(len(calls), 1)
+    assert_equal(calls[0][0], 'alloc')
+    assert_equal(calls[0][2], metrics.stages['alloc']['peak_bytes'])
+    assert 'spheredb_stage_peak_bytes{stage="alloc"}' in \
+        metrics.to_prometheus()
+
+
+def test_threads():
+    metrics = Metrics()
+
+    def work():
+        for i in range(1000):
+            with metrics.stage('work'):
+                metrics.count('items')
+
+    threads = [threading.Thread(target=work) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equal(metrics.stages['work']['calls'], 4000)
+    assert_equal(metrics.counters['items'], 4000)
+
+
+def test_null_metrics():
+    with NULL_METRICS.stage('read'):
+        NULL_METRICS.count('pixels', 10)
+    assert not NULL_METRICS.enabled
@@ -0,0 +1,137 @@
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose, assert_raises
+
+from spheredb.cube import SparseCube
+from spheredb.hpx_utils import HPX_to_RAdec
+from spheredb.photometry import forced_photometry, source_grid_coords
+from spheredb.records import DEFAULT_SCHEMA
+
+
+def dense_cube(path, shape, tile_shape, rseed=0):
+    rng = np.random.RandomState(rseed)
+    data = rng.rand(*shape)
+    x, y, time = [a.ravel() for a in np.indices(shape)]
+    records = np.zeros(len(x), dtype=DEFAULT_SCHEMA.dtype)
+    records['time'] = time
+    records['x'] = x
+    records['y'] = y
+    records['val'] = data.ravel()
+    return data, SparseCube.from_records(path, records, shape, tile_shape)
+
+
+def source_positions(n, Nside, rseed=1):
+    # sources well within the cube, in the equatorial region
+    rng = np.random.RandomState(rseed)
+    step = 45. / Nside
+    gx = 5 + 30 * rng.rand(n)
+    gy = 105 + 30 * rng.rand(n)
+    RA, dec = HPX_to_RAdec(gx * step - 180, gy * step - 90)
+    return RA, dec
+
+
+def test_grid_coords():
+    Nside = 64
+    RA, dec = source_positions(10, Nside)
+    gx, gy = source_grid_coords(RA, dec, Nside)
+    assert np.all((gx >= 5) & (gx <= 35))
+    assert np.all((gy >= 105) & (gy <= 135))
+
+
+def test_forced_aperture(tmpdir):
+    Nside = 64
+    shape = (40, 160, 3)
+    data, cube = dense_cube(str(tmpdir), shape, (8, 8))
+    RA, dec = source_positions(50, Nside)
+
+    # small batches force sources and tiles to be split across batches
+    table = forced_photometry(cube, RA, dec, Nside, radius=2.5,
+                              batch_size=7)
+    assert_equal(len(table), 50 * 3)
+    assert_equal(table['source'], np.repeat(np.arange(50), 3))
+    assert_equal(table['time'], np.tile(np.arange(3), 50))
+
+    gx, gy = source_grid_coords(RA, dec, Nside)
+    X, Y = np.indices(shape[:2])
+    for i in range(50):
+        inside = (X - gx[i]) ** 2 + (Y - gy[i]) ** 2 <= 2.5 ** 2
+        rows = table[table['source'] == i]
+        assert_allclose(rows['flux'], data[inside].sum(0))
+        assert_equal(rows['weight'], inside.sum())
+
+    table = forced_photometry(cube, RA, dec, Nside, radius=2.5,
+                              time=(1, None))
+    assert_equal(table['time'], np.tile([1, 2], 50))
+
+    assert_raises(ValueError, forced_photometry, cube, RA, dec, Nside)
+
+
+def test_forced_interpolate(tmpdir):
+    Nside = 64
+    shape = (40, 160, 2)
+    data, cube = dense_cube(str(tmpdir), shape, (8, 8))
+    RA, dec = source_positions(50, Nside)
+
+    table = forced_photometry(cube, RA, dec, Nside, method='interpolate')
+    assert_equal(len(table), 50 * 2)
+    assert_allclose(table['weight'], 1)
+
+    gx, gy = source_grid_coords(RA, dec, Nside)
+    ix, iy = np.floor(gx).astype(int), np.floor(gy).astype(int)
+    fx, fy = (gx - ix)[:, None], (gy - iy)[:, None]
+    expected = ((1 - fx) * (1 - fy) * data[ix, iy]
+                + fx * (1 - fy) * data[ix + 1, iy]
+                + (1 - fx) * fy * data[ix, iy + 1]
+                + fx * fy * data[ix + 1, iy + 1])
+    assert_allclose(table['flux'], expected.ravel())
+
+
+def test_forced_no_data(tmpdir):
+    Nside = 64
+    data, cube = dense_cube(str(tmpdir), (4, 4, 1), (2, 2))
+    RA, dec = source_positions(5, Nside)
+    table = forced_photometry(cube, RA, dec, Nside, radius=1)
+    assert_equal(len(table), 0)
+
+
+def test_forced_empty_apertures(tmpdir):
+    Nside = 64
+    shape = (40, 160, 1)
+    data, cube = dense_cube(str(tmpdir), shape, (8, 8))
+    RA, dec = source_positions(50, Nside)
+
+    # with radius < 0.5 most apertures, and so most batches, hold no pixel
+    gx, gy = source_grid_coords(RA, dec, Nside)
+    d2 = (gx - np.round(gx)) ** 2 + (gy - np.round(gy)) ** 2
+    hit = np.nonzero(d2 <= 0.3 ** 2)[0]
+    assert 0 < len(hit) < 50
+
+    table = forced_photometry(cube, RA, dec, Nside, radius=0.3,
+                              batch_size=1)
+    assert_equal(table['source'], hit)
+    assert_allclose(table['flux'], data[np.round(gx[hit]).astype(int),
+                                        np.round(gy[hit]).astype(int), 0])
+
+
+def test_forced_seam(tmpdir):
+    # the full grid of a small Nside; grid column 0 is at RA = 180
+    Nside = 4
+    shape = (8 * Nside, 4 * Nside + 1, 1)
+    data, cube = dense_cube(str(tmpdir), shape, (8, 8))
+
+    # sources on either side of the seam, which both reach the two ends
+    step = 45. / Nside
+    gx = np.array([0.2, 8 * Nside - 0.2])
+    gy = np.array([2 * Nside + 0.3, 2 * Nside - 0.3])
+    RA, dec = HPX_to_RAdec(gx * step - 180, gy * step - 90)
+    assert_allclose(source_grid_coords(RA, dec, Nside), (gx, gy))
+
+    table = forced_photometry(cube, RA, dec, Nside, radius=1.5)
+    assert_equal(table['source'], [0, 1])
+
+    X, Y = np.indices(shape[:2])
+    for i in range(2):
+        dx = (X - gx[i] + 4 * Nside) % (8 * Nside) - 4 * Nside
+        inside = dx ** 2 + (Y - gy[i]) ** 2 <= 1.5 ** 2
+        assert np.any(inside[0]) and np.any(inside[-1])
+        assert_allclose(table['flux'][i], data[inside].sum())
+        assert_equal(table['weight'][i], inside.sum())
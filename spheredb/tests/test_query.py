@@ -0,0 +1,107 @@
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose, assert_raises
+
+from spheredb.query import LazyArray, Array, Subarray, Regrid, Slice
+from spheredb.util import regrid
+
+
+def _records(shape=(20, 16, 3), rseed=0):
+    rng = np.random.RandomState(rseed)
+    dense = rng.rand(*shape)
+    dense[rng.rand(*shape) < 0.5] = 0
+    x, y, t = np.nonzero(dense)
+    records = np.zeros(len(x), dtype=[('time', np.int64), ('x', np.int64),
+                                      ('y', np.int64), ('val', np.float64)])
+    records['x'], records['y'], records['time'] = x, y, t
+    records['val'] = dense[x, y, t]
+    return dense, records
+
+
+def test_local_evaluation():
+    dense, records = _records()
+    A = LazyArray.from_records(records, dense.shape)
+
+    assert_allclose(A.toarray(), dense)
+    assert_allclose(A.slice('time', 1).toarray(), dense[:, :, 1])
+    assert_allclose(A.sum('time').toarray(), dense.sum(2))
+    assert_allclose(A.max(2).toarray(), dense.max(2))
+    assert_allclose(A.subarray((3, 11), (2, 9)).toarray(),
+                    dense[3:11, 2:9])
+
+    B = A.slice('time', 2).subarray((4, 16), (2, 14)).regrid(4)
+    assert_equal(B.shape, (3, 3))
+    assert_allclose(B.toarray(), regrid(dense[4:16, 2:14, 2], 4))
+
+    C = A.sum('time').regrid(2).subarray((1, 4), (2, 6))
+    assert_allclose(C.toarray(), regrid(dense.sum(2), 2)[1:4, 2:6])
+
+
+def test_pushdown():
+    dense, records = _records()
+    A = LazyArray.from_records(records, dense.shape)
+    C = A.sum('time').regrid(2).subarray((1, 4), (2, 6)).subarray((1, 3))
+
+    # the subarray is applied to the source, before any aggregation
+    expr = C.optimized()
+    assert isinstance(expr, Regrid)
+    sub = expr.children[0].children[0]
+    assert isinstance(sub, Subarray) and isinstance(sub.children[0], Array)
+    assert_equal(sub.lower, (4, 4, None))
+    assert_equal(sub.upper, (7, 11, None))
+
+    assert_allclose(C.toarray(), regrid(dense.sum(2), 2)[2:4, 2:6])
+
+
+class FakeArray(object):
+    def __init__(self, name, shape=None):
+        self.name = name
+        self.shape = shape
+
+
+class FakeInterface(object):
+    def __init__(self):
+        self.queries = []
+        self.count = 0
+
+    def new_array(self):
+        self.count += 1
+        return FakeArray('tmp{0}'.format(self.count))
+
+    def query(self, query, *args):
+        self.queries.append(query.format(*[a.name for a in args]))
+
+
+def test_single_afl_query():
+    sdb = FakeInterface()
+    A = LazyArray.from_scidb(FakeArray('pix', (100, 50, 1000)), sdb)
+    B = A.slice('time', 7).subarray((10, 20), (5, 15)).regrid(5, 'max')
+
+    assert_equal(sdb.queries, [])
+    B.compute()
+    assert_equal(sdb.queries,
+                 ['store(regrid(slice(subarray(pix, 10, 5, null, 19, 14, '
+                  'null), time, 7), 5, 5, max(val) as val), tmp1)'])
+
+    assert_raises(ValueError, A.aggregate('time', 'median').afl)
+
+
+def test_aggregate_aliases():
+    sdb = FakeInterface()
+    A = LazyArray.from_scidb(FakeArray('pix', (100, 50, 1000)), sdb)
+    assert_equal(A.regrid(5, 'avg').afl(), A.regrid(5, 'mean').afl())
+    assert_equal(A.aggregate('time', 'avg').afl(),
+                 'aggregate({0}, avg(val) as val, x, y)')
+
+    dense, records = _records()
+    B = LazyArray.from_records(records, dense.shape).slice('time', 1)
+    assert_equal(B.regrid(2, 'avg').toarray(), B.regrid(2, 'mean').toarray())
+
+
+def test_difference_afl():
+    from spheredb.query import difference_afl
+    afl = difference_afl(3, (0, 10), threshold=4)
+    assert 'slice({A}, time, 3)' in afl
+    assert 'between({A}, null, null, 0, null, null, 9), time <> 3)' in afl
+    assert afl.endswith('abs(snr) >= 4.0), diff, variance, snr)')
+    assert 'between({A}, null, null, null, null, null, null)' in \
+        difference_afl(3)
@@ -0,0 +1,63 @@
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose, assert_raises
+
+from spheredb.records import RecordSchema, DEFAULT_SCHEMA
+
+
+def test_default_schema():
+    records = DEFAULT_SCHEMA.records([1, 2], [3, 4], [0.5, 1.5], 50095.5)
+    assert_equal(records.dtype.itemsize, 32)
+    assert_equal(records['time'], 2 * [int(50095.5 * 24 * 60 * 60)])
+    assert_equal(DEFAULT_SCHEMA.Nt, int(100000 * 24 * 60 * 60))
+    assert_equal(DEFAULT_SCHEMA.scidb_attribute, '<val:double>')
+
+
+def test_compact_schema():
+    schema = RecordSchema.compact_schema(epoch=50000)
+    records = schema.records([1, -2], [3, 4], [0.5, 1.5], 50001.25)
+
+    assert_equal(records.dtype.itemsize, 16)
+    assert_equal(records['x'], [1, -2])
+    assert_allclose(records['val'], [0.5, 1.5])
+    assert_equal(records['time'], 108000)
+    assert_allclose(schema.time_to_mjd(records['time']), 50001.25)
+    assert_equal(schema.scidb_attribute, '<val:float>')
+
+    # out of range for int32
+    assert_raises(ValueError, schema.records, [2 ** 31], [0], [1.], 50000)
+    assert_raises(ValueError, schema.time_index, 50000 + 30000)
+
+    # seconds since MJD 0 do not fit in int32: the epoch is required
+    assert_raises(ValueError, RecordSchema.compact_schema)
+    assert_raises(ValueError, RecordSchema, compact=True)
+    assert_equal(RecordSchema().epoch, 0)
+
+
+def test_bytes_per_record():
+    n = 1000
+    rng = np.random.RandomState(0)
+    x, y = rng.randint(0, 2 ** 20, (2, n))
+    val = rng.rand(n)
+
+    sizes = {}
+    for schema in (DEFAULT_SCHEMA, RecordSchema.compact_schema(50000)):
+        records = schema.records(x, y, val, 50095.5)
+        coo = np.zeros(n, dtype=schema.coo_dtype)
+        sizes[schema.compact] = (records.nbytes / float(n),
+                                 coo.nbytes / float(n))
+    assert_equal(sizes[False], (32, 24))
+    assert_equal(sizes[True], (16, 12))
+
+
+def test_exposure_resolution():
+    epochs = [50003.1, 50001.7, 50002.2]
+    schema = RecordSchema(compact=True, resolution='exposure', epochs=epochs)
+
+    assert_equal(schema.Nt, 3)
+    assert_equal(schema.time_index([50001.7, 50003.1]), [0, 2])
+    assert_equal(schema.records([0], [0], [1.], 50002.2)['time'], [1])
+    assert_allclose(schema.time_to_mjd(1), 50002.2)
+
+    assert_raises(ValueError, schema.time_index, 50002.0)
+    assert_raises(ValueError, RecordSchema, resolution='exposure')
+    assert_raises(ValueError, RecordSchema, resolution='day')
@@ -0,0 +1,116 @@
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose, assert_raises
+
+from spheredb.resampling import ResamplingPlan, ResamplingPlanCache, wcs_key
+
+
+def _plan(shape=(20, 30), n=500, rseed=0):
+    rng = np.random.RandomState(rseed)
+    locs = rng.rand(n, 2) * (np.array(shape) + 4) - 2
+    locs[:10] = np.floor(locs[:10])  # exact grid points
+    ind = rng.randint(0, 1000, (n, 2))
+    return ResamplingPlan.from_locations(shape, ind, locs), ind, locs
+
+
+def test_plan_linear_exact():
+    # bilinear interpolation is exact for linear functions
+    shape = (20, 30)
+    plan, ind, locs = _plan(shape)
+    i, j = np.indices(shape)
+    data = 2 * i - 3 * j + 1
+
+    x, y, val = plan.apply(data)
+    in_bounds = np.all((locs >= 0) & (locs <= np.array(shape) - 1), 1)
+
+    assert_equal(len(x), in_bounds.sum())
+    assert_equal(x, ind[in_bounds, 0])
+    assert_equal(y, ind[in_bounds, 1])
+    assert_allclose(val, 2 * locs[in_bounds, 0] - 3 * locs[in_bounds, 1] + 1,
+                    rtol=1E-5, atol=1E-5)
+
+
+def test_plan_nan_and_shape():
+    plan, ind, locs = _plan()
+    data = np.ones((20, 30))
+    data[5:, :] = np.nan
+    x, y, val = plan.apply(data)
+    assert_allclose(val, 1)
+    assert_raises(ValueError, plan.apply, np.ones((30, 20)))
+
+
+def test_plan_save_load(tmpdir):
+    plan, ind, locs = _plan()
+    fname = str(tmpdir.join('plan.npz'))
+    plan.save(fname)
+    plan2 = ResamplingPlan.load(fname)
+
+    data = np.random.RandomState(1).rand(20, 30)
+    for a, b in zip(plan.apply(data), plan2.apply(data)):
+        assert_equal(a, b)
+    # weights are held as float64 and saved as float32
+    assert_equal(plan.weights.dtype, np.float64)
+    assert_equal(plan2.weights.dtype, np.float64)
+    with np.load(fname) as f:
+        assert_equal(f['weights'].dtype, np.float32)
+    assert plan.nbytes <= len(plan) * 64
+
+
+def test_plan_matches_grid_interpolation():
+    from spheredb.grid_interpolation import GridInterpolation
+
+    shape = (20, 30)
+    plan, ind, locs = _plan(shape)
+    data = np.random.RandomState(2).rand(*shape)
+
+    expected = GridInterpolation(data, [0, 0], [1, 1])(locs)
+    good = ~np.isnan(expected)
+    x, y, val = plan.apply(data)
+    assert_equal(x, ind[good, 0])
+    assert_equal(y, ind[good, 1])
+    assert_allclose(val, expected[good], rtol=1E-6)
+
+
+def test_plan_matches_FITS_to_HPX(kapteyn_wcs, make_chip):
+    from spheredb.conversions import FITS_to_HPX
+
+    plans = ResamplingPlanCache()
+    for i, (RA, dec) in enumerate([(30., 10.), (180., 5.), (0., 70.)]):
+        header, data = make_chip(RA, dec, rotation=20. * i)
+        direct = FITS_to_HPX(header, data, 4096)
+        assert len(direct) > 0
+        for j in range(2):
+            planned = FITS_to_HPX(header, data, 4096, plans=plans)
+            assert_equal(planned['x'], direct['x'])
+            assert_equal(planned['y'], direct['y'])
+            assert_allclose(planned['val'], direct['val'], rtol=1E-5)
+    assert_equal((plans.hits, plans.misses), (3, 3))
+
+
+def test_wcs_key():
+    header = {'NAXIS1': 10, 'CRVAL1': 2.5, 'CD1_1': 0.01,
+              'TAI': 1.0, 'MJD-OBS': 1.0}
+    key = wcs_key(header, Nside=64)
+    assert_equal(wcs_key(dict(header, TAI=2.0, **{'MJD-OBS': 2.0}),
+                         Nside=64), key)
+    assert wcs_key(dict(header, CRVAL1=2.6), Nside=64) != key
+    assert wcs_key(header, Nside=128) != key
+
+
+def test_plan_cache():
+    cache = ResamplingPlanCache(max_plans=2)
+    built = []
+
+    def builder(name):
+        return lambda: built.append(name) or name
+
+    headers = [{'CRVAL1': i} for i in range(3)]
+    assert_equal(cache.get(headers[0], builder('a')), 'a')
+    assert_equal(cache.get(headers[0], builder('b')), 'a')
+    cache.get(headers[1], builder('c'))
+    cache.get(headers[0], builder('d'))
+    cache.get(headers[2], builder('e'))  # evicts headers[1]
+    assert_equal(cache.get(headers[1], builder('f')), 'f')
+
+    assert_equal(built, ['a', 'c', 'e', 'f'])
+    assert_equal((cache.hits, cache.misses), (2, 4))
+    assert_equal(len(cache), 2)
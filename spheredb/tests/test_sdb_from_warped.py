@@ -0,0 +1,136 @@
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose, assert_raises
+from astropy.io import fits
+
+from spheredb.sdb_from_warped import (sdb_from_warped, iter_warped_strips,
+                                      sdb_from_warped_files,
+                                      sdb_from_warped_dir,
+                                      warped_geometry)
+
+
+def _write_warped(path, img, crpix=(-20, -10), cdelt=1.0, ctype='HPX'):
+    header = fits.Header()
+    header['CTYPE1'] = 'RA---' + ctype
+    header['CTYPE2'] = 'DEC--' + ctype
+    header['CUNIT1'] = 'deg'
+    header['CUNIT2'] = 'deg'
+    header['CDELT1'] = cdelt
+    header['CDELT2'] = cdelt
+    header['CRPIX1'] = crpix[0]
+    header['CRPIX2'] = crpix[1]
+    header['CRVAL1'] = 0
+    header['CRVAL2'] = 0
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.ImageHDU(img, header=header)]).writeto(path)
+    return path
+
+
+def _random_image(shape, rseed=0):
+    rng = np.random.RandomState(rseed)
+    img = rng.rand(*shape)
+    img[rng.rand(*shape) < 0.3] = np.nan
+    return img
+
+
+def test_warped_geometry(tmpdir):
+    path = _write_warped(str(tmpdir.join('w.fits')), np.zeros((7, 5)))
+    header = fits.getheader(path, 1)
+    assert_equal(warped_geometry(header), (20, 100, 5, 7, 360, 180))
+
+    path = _write_warped(str(tmpdir.join('tan.fits')), np.zeros((7, 5)),
+                         ctype='TAN')
+    assert_raises(ValueError, warped_geometry, fits.getheader(path, 1))
+
+
+def test_sdb_from_warped(tmpdir):
+    img = _random_image((23, 17))
+    path = _write_warped(str(tmpdir.join('w.fits')), img)
+    M = sdb_from_warped(path)
+
+    assert_equal(M.shape, (180, 360))
+    dense = M.toarray()
+    expected = np.where(np.isnan(img), 0, img)
+    assert_equal(dense[100:123, 20:37], expected)
+    assert_equal(M.nnz, np.sum(~np.isnan(img)))
+
+
+def test_sdb_from_warped_opens_once(tmpdir, monkeypatch):
+    path = _write_warped(str(tmpdir.join('w.fits')), _random_image((9, 8)))
+    opened = []
+    fits_open = fits.open
+
+    def counting_open(*args, **kwargs):
+        opened.append(args[0])
+        return fits_open(*args, **kwargs)
+
+    monkeypatch.setattr(fits, 'open', counting_open)
+    monkeypatch.setattr(fits, 'getheader', None)
+    sdb_from_warped(path, strip_rows=4)
+    assert_equal(opened, [path])
+
+
+def test_strips_match_full_read(tmpdir):
+    img = _random_image((50, 31), rseed=1)
+    path = _write_warped(str(tmpdir.join('w.fits')), img)
+    M = sdb_from_warped(path)
+
+    for strip_rows in [1, 7, 50, 64]:
+        for n_threads in [1, 3]:
+            M2 = sdb_from_warped(path, strip_rows=strip_rows,
+                                 n_threads=n_threads)
+            assert_equal(M2.row, M.row)
+            assert_equal(M2.col, M.col)
+            assert_equal(M2.data, M.data)
+
+    strips = list(iter_warped_strips(path, strip_rows=7))
+    assert_equal(len(strips), 8)
+    assert all(np.all(s['i1'] < 100 + 7 * (i + 1))
+               for i, s in enumerate(strips))
+
+
+def test_sdb_from_warped_dir(tmpdir):
+    img1 = _random_image((10, 12), rseed=2)
+    img2 = _random_image((8, 6), rseed=3)
+    tmpdir.mkdir('a').mkdir('b')
+    f1 = _write_warped(str(tmpdir.join('a', 'w1.fits')), img1)
+    f2 = _write_warped(str(tmpdir.join('a', 'b', 'w2.fits')), img2,
+                       crpix=(-24, -12))
+    tmpdir.join('a', 'notes.txt').write('ignored')
+
+    expected = np.zeros((180, 360))
+    expected[100:110, 20:32] += np.nan_to_num(img1)
+    expected[102:110, 24:30] += np.nan_to_num(img2)
+
+    for processes in [1, 2]:
+        records = sdb_from_warped_dir(str(tmpdir), processes=processes)
+        order = np.lexsort((records['i2'], records['i1']))
+        assert_equal(order, np.arange(len(records)))
+
+        M = sdb_from_warped_dir(str(tmpdir), processes=processes,
+                                return_sparse=True)
+        assert_allclose(M.toarray(), expected)
+
+    M = sdb_from_warped_files([f1, f2], reduction='max', return_sparse=True)
+    assert_allclose(M.toarray()[102:110, 24:30],
+                    np.nan_to_num(np.fmax(img1[2:, 4:10], img2)))
+
+
+def test_sdb_from_warped_files_grid_mismatch(tmpdir):
+    f1 = _write_warped(str(tmpdir.join('w1.fits')), np.ones((2, 2)))
+    f2 = _write_warped(str(tmpdir.join('w2.fits')), np.ones((2, 2)),
+                       cdelt=0.5)
+    assert_raises(ValueError, sdb_from_warped_files, [f1, f2], processes=1)
+
+
+def test_sdb_from_warped_files_compact(tmpdir):
+    img = _random_image((23, 17))
+    f1 = _write_warped(str(tmpdir.join('w1.fits')), img)
+    f2 = _write_warped(str(tmpdir.join('w2.fits')), img, crpix=(-25, -10))
+
+    full = sdb_from_warped_files([f1, f2], processes=1)
+    compact = sdb_from_warped_files([f1, f2], processes=1, compact=True)
+
+    assert_equal(compact.dtype.itemsize, 12)
+    assert_equal(compact['i1'], full['i1'])
+    assert_equal(compact['i2'], full['i2'])
+    assert_allclose(compact['data'], full['data'], rtol=1E-6)
@@ -0,0 +1,98 @@
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose
+
+from spheredb.cube import SparseCube
+from spheredb.records import DEFAULT_SCHEMA
+from spheredb.tile_stats import TileStats, tile_stats_afl
+
+
+def random_records(shape, n, rseed=0):
+    rng = np.random.RandomState(rseed)
+    x, y, time = np.unravel_index(rng.choice(np.prod(shape), n,
+                                             replace=False), shape)
+    records = np.zeros(n, dtype=DEFAULT_SCHEMA.dtype)
+    records['time'], records['x'], records['y'] = time, x, y
+    records['val'] = rng.rand(n)
+    return records
+
+
+def assert_summary_equal(s1, s2):
+    for name in s1.dtype.names:
+        assert_allclose(s1[name], s2[name])
+
+
+def test_from_records():
+    shape = (20, 30, 5)
+    records = random_records(shape, 500)
+    stats = TileStats.from_records(records, (8, 8))
+    assert_equal(len(stats), 12)
+    assert_equal(stats.count, 500)
+
+    for row in stats.summary:
+        tile = ((records['x'] // 8 == row['tile_x'])
+                & (records['y'] // 8 == row['tile_y']))
+        val = records['val'][tile]
+        assert_equal(row['n'], tile.sum())
+        assert_allclose([row['val_sum'], row['val_sumsq'], row['val_min'],
+                         row['val_max']],
+                        [val.sum(), (val ** 2).sum(), val.min(), val.max()])
+        assert_equal([row['x_min'], row['x_max'], row['time_min']],
+                     [records['x'][tile].min(), records['x'][tile].max(),
+                      records['time'][tile].min()])
+
+    assert_equal(stats.index_bounds(),
+                 [records['x'].min(), records['x'].max(),
+                  records['y'].min(), records['y'].max(),
+                  records['time'].min(), records['time'].max()])
+    assert_allclose(stats.mean(), stats.summary['val_sum']
+                    / stats.summary['n'])
+
+    occupancy = stats.occupancy_map(shape[:2])
+    assert_equal(occupancy.shape, (3, 4))
+    assert_equal(occupancy.sum(), 500)
+    assert_equal(stats.coverage_map(shape[:2]), occupancy > 0)
+    assert_allclose(stats.depth_map(shape[:2]), occupancy / 64.)
+
+
+def test_incremental_update(tmpdir):
+    records = random_records((20, 30, 5), 500)
+    stats = TileStats((8, 8))
+    for i in range(0, 500, 150):
+        stats.update(records[i:i + 150])
+    assert_summary_equal(stats.summary,
+                         TileStats.from_records(records, (8, 8)).summary)
+
+    path = str(tmpdir.join('stats.npz'))
+    stats.save(path)
+    loaded = TileStats.load(path)
+    assert_equal(loaded.tile_shape, (8, 8))
+    assert_summary_equal(loaded.summary, stats.summary)
+
+
+def test_cube_stats(tmpdir):
+    shape = (20, 30, 5)
+    records = random_records(shape, 500)
+    cube = SparseCube(str(tmpdir), shape, (8, 8))
+    cube.append(records[:300])
+    cube.append(records[200:])
+
+    # replaced cells are not double counted
+    update = records[:10].copy()
+    update['val'] = 5
+    cube.append(update)
+    expected = TileStats.from_records(cube.to_records(), (8, 8)).summary
+
+    assert_summary_equal(cube.stats.summary, expected)
+    assert_summary_equal(SparseCube(str(tmpdir)).stats.summary, expected)
+    for processes in (1, 2):
+        assert_summary_equal(TileStats.from_cube(cube, processes).summary,
+                             expected)
+    assert_equal(cube.index_bounds(), cube.stats.index_bounds())
+
+
+def test_tile_stats_afl():
+    afl = tile_stats_afl((1000, 500), 10)
+    assert afl.startswith('regrid(apply({A}, _x, x, _y, y, _time, time, '
+                          '_sq, double(val) * val), 1000, 500, 10, ')
+    assert 'count(val) as n' in afl
+    assert afl.endswith('min(_time) as time_min, max(_time) as time_max)')
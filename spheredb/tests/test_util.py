@@ -0,0 +1,50 @@
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose, assert_raises
+
+from spheredb.util import reduce_duplicates, iter_tiles, partition_records
+
+
+def test_reduce_duplicates():
+    index = [5, 2, 5, 7, 2, 5]
+    values = [1., 2., 3., 4., 5., 6.]
+
+    for reduction, expected in [('sum', [7, 10, 4]),
+                                ('min', [2, 1, 4]),
+                                ('max', [5, 6, 4]),
+                                ('mean', [3.5, 10. / 3, 4]),
+                                ('first', [2, 1, 4]),
+                                ('last', [5, 6, 4]),
+                                (np.multiply, [10, 18, 4])]:
+        ind, red = reduce_duplicates(index, values, reduction)
+        assert_equal(ind, [2, 5, 7])
+        assert_allclose(red, expected)
+
+
+def test_reduce_duplicates_errors():
+    assert_raises(ValueError, reduce_duplicates, [1, 2], [1.])
+    assert_raises(ValueError, reduce_duplicates, [1, 2], [1., 2.], 'median')
+
+    ind, red = reduce_duplicates([], [])
+    assert_equal(len(ind), 0)
+
+
+def test_partition_records():
+    rng = np.random.RandomState(0)
+    records = np.zeros(500, dtype=[('time', np.int64), ('x', np.int64),
+                                   ('y', np.int64), ('val', np.float64)])
+    records['x'] = rng.randint(-50, 50, 500)
+    records['y'] = rng.randint(0, 40, 500)
+    records['val'] = rng.rand(500)
+
+    blocks = partition_records(records, (16, 10))
+    assert_equal(sum(len(b) for b in blocks.values()), len(records))
+    assert_equal(list(blocks.keys()), sorted(blocks.keys()))
+
+    for (i, j), block in blocks.items():
+        assert_equal(block['x'] // 16, i)
+        assert_equal(block['y'] // 10, j)
+        assert_equal(np.lexsort((block['y'], block['x'])),
+                     np.arange(len(block)))
+
+    assert_equal(len(list(iter_tiles(records[:0], (16, 10)))), 0)
+    assert_raises(ValueError, partition_records, records, (0, 10))
@@ -0,0 +1,87 @@
+import os
+
+import numpy as np
+from numpy.testing import assert_equal
+from scipy import sparse
+
+from spheredb.warp_cache import WarpCache
+
+
+def test_sparse_roundtrip(tmpdir):
+    cache = WarpCache(str(tmpdir))
+    M = sparse.coo_matrix(([1., 2., 3.], ([0, 4, 2], [1, 1, 3])),
+                          shape=(5, 6))
+
+    assert cache.get_sparse('abc', M.shape) is None
+    cache.put_sparse('abc', M)
+    M2 = cache.get_sparse('abc', M.shape)
+
+    assert_equal(M2.toarray(), M.toarray())
+    assert_equal((cache.hits, cache.misses), (1, 1))
+
+
+def test_file_key(tmpdir):
+    f1 = tmpdir.join('a.fits')
+    f2 = tmpdir.join('b.fits')
+    f1.write('some data')
+    f2.write('some data')
+
+    cache = WarpCache(str(tmpdir.join('cache')))
+    key = cache.file_key(str(f1), cdelt=3, cunit='arcsec')
+
+    # same content and parameters: same key
+    assert_equal(cache.file_key(str(f2), cunit='arcsec', cdelt=3), key)
+    assert cache.file_key(str(f1), cdelt=1, cunit='arcsec') != key
+
+    f2.write('other data')
+    assert cache.file_key(str(f2), cdelt=3, cunit='arcsec') != key
+
+
+def test_array_key(tmpdir):
+    cache = WarpCache(str(tmpdir))
+    data = np.arange(12.).reshape(3, 4)
+    header = {'NAXIS': 2, 'CTYPE1': 'RA---TAN'}
+
+    key = cache.array_key(header, data, Nside=64)
+    assert_equal(cache.array_key(dict(header), data.copy(), Nside=64), key)
+    assert cache.array_key(header, data, Nside=128) != key
+    assert cache.array_key(header, data + 1, Nside=64) != key
+    assert cache.array_key(header, data.reshape(4, 3), Nside=64) != key
+
+
+def test_lru_eviction(tmpdir):
+    cache = WarpCache(str(tmpdir), max_bytes=10 ** 9)
+    records = np.zeros(100, dtype=[('data', float), ('i1', int)])
+    for i, key in enumerate('abc'):
+        cache.put(key, records)
+        os.utime(os.path.join(cache.cache_dir, key + '.npy'), (i, i))
+
+    entry_size = cache.size() // 3
+
+    # touch 'a' so that 'b' becomes the least recently used entry
+    cache.get('a')
+    cache.evict(2 * entry_size)
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.get('c') is not None
+
+    cache.clear()
+    assert_equal(cache.size(), 0)
+
+
+def test_compact_entries(tmpdir):
+    M = sparse.coo_matrix(([1., 2., 3.], ([0, 4, 2], [1, 1, 3])),
+                          shape=(5, 6))
+    cache = WarpCache(str(tmpdir.join('full')))
+    compact = WarpCache(str(tmpdir.join('compact')), compact=True)
+
+    for c in (cache, compact):
+        c.put_sparse('abc', M)
+        assert_equal(c.get_sparse('abc', M.shape).toarray(), M.toarray())
+    assert_equal(compact.get('abc').dtype.itemsize, 12)
+    assert compact.size() < cache.size()
+
+    with open(str(tmpdir.join('f')), 'wb') as f:
+        f.write(b'data')
+    assert (cache.file_key(str(tmpdir.join('f')), Nside=8)
+            != compact.file_key(str(tmpdir.join('f')), Nside=8))
@@ -0,0 +1,281 @@
+"""
+Per-tile statistics of HPX pixel stores
+
+A TileStats object holds a small summary array with one record per
+non-empty spatial tile: the number of cells, the sum, sum of squares,
+minimum and maximum of the values, and the index bounds of the cells
+along x, y and time.  Bounds, occupancy and depth maps are derived from
+the summary without touching the pixels.
+
+Summaries are built in one pass over a record array, a
+:class:`spheredb.cube.SparseCube` (in parallel over tiles) or a SciDB
+array (with a single regrid query), and are updated incrementally as new
+records are ingested.
+"""
+from multiprocessing import Pool
+
+import numpy as np
+
+__all__ = ['TileStats', 'STATS_DTYPE']
+
+STATS_DTYPE = np.dtype([('tile_x', np.int64), ('tile_y', np.int64),
+                        ('n', np.int64),
+                        ('val_sum', np.float64), ('val_sumsq', np.float64),
+                        ('val_min', np.float64), ('val_max', np.float64),
+                        ('x_min', np.int64), ('x_max', np.int64),
+                        ('y_min', np.int64), ('y_max', np.int64),
+                        ('time_min', np.int64), ('time_max', np.int64)])
+
+# how each field of partial summaries of the same tile is combined
+COMBINE = dict([(name, np.add) for name in ('n', 'val_sum', 'val_sumsq')]
+               + [(name, np.minimum) for name in ('val_min', 'x_min',
+                                                  'y_min', 'time_min')]
+               + [(name, np.maximum) for name in ('val_max', 'x_max',
+                                                  'y_max', 'time_max')])
+
+
+def _reduce_tiles(tile_x, tile_y, columns):
+    """Combine rows sharing a tile
+
+    ``columns`` maps each summary field to an array of per-row values; the
+    result is a summary array sorted by (tile_x, tile_y).
+    """
+    order = np.lexsort((tile_y, tile_x))
+    tile_x, tile_y = tile_x[order], tile_y[order]
+    summary = np.zeros(0, dtype=STATS_DTYPE)
+    if len(order) == 0:
+        return summary
+
+    new_tile = np.concatenate([[True], (tile_x[1:] != tile_x[:-1])
+                               | (tile_y[1:] != tile_y[:-1])])
+    starts = np.nonzero(new_tile)[0]
+
+    summary = np.zeros(len(starts), dtype=STATS_DTYPE)
+    summary['tile_x'] = tile_x[starts]
+    summary['tile_y'] = tile_y[starts]
+    for name, ufunc in COMBINE.items():
+        summary[name] = ufunc.reduceat(np.asarray(columns[name])[order],
+                                       starts)
+    return summary
+
+
+def records_summary(records, tile_shape):
+    """Return the summary array of (time, x, y, val) records"""
+    records = np.asarray(records)
+    val = records['val'].astype(np.float64)
+    columns = {'n': np.ones(len(records), dtype=np.int64),
+               'val_sum': val, 'val_sumsq': val ** 2,
+               'val_min': val, 'val_max': val}
+    for d in ('x', 'y', 'time'):
+        columns[d + '_min'] = columns[d + '_max'] = records[d]
+    return _reduce_tiles(records['x'] // tile_shape[0],
+                         records['y'] // tile_shape[1], columns)
+
+
+def cube_tile_summary(args):
+    """Summary record of one tile of a SparseCube (for use in a Pool)"""
+    cube, tile = args
+    pixel, indptr, time, val = cube.tile(tile)
+    tx, ty = cube.tile_shape
+    val = np.asarray(val, dtype=np.float64)
+
+    summary = np.zeros(1, dtype=STATS_DTYPE)
+    summary['tile_x'], summary['tile_y'] = tile
+    summary['n'] = len(val)
+    if len(val) == 0:
+        return summary
+
+    summary['val_sum'] = val.sum()
+    summary['val_sumsq'] = np.dot(val, val)
+    summary['val_min'] = val.min()
+    summary['val_max'] = val.max()
+    # pixels are sorted by (x, y): the x bounds are those of the ends
+    summary['x_min'] = tile[0] * tx + pixel[0] // ty
+    summary['x_max'] = tile[0] * tx + pixel[-1] // ty
+    summary['y_min'] = tile[1] * ty + np.min(pixel % ty)
+    summary['y_max'] = tile[1] * ty + np.max(pixel % ty)
+    summary['time_min'] = np.min(time)
+    summary['time_max'] = np.max(time)
+    return summary
+
+
+def tile_stats_afl(tile_shape, Nt, attr='val'):
+    """AFL query of the per-tile statistics of an (x, y, time) array
+
+    The array appears as ``{A}``.  The output has one cell per tile, with
+    the attributes of :data:`STATS_DTYPE` other than the tile indices.
+    """
+    aggregates = ['count({0}) as n', 'sum({0}) as val_sum',
+                  'sum(_sq) as val_sumsq', 'min({0}) as val_min',
+                  'max({0}) as val_max']
+    for d in ('x', 'y', 'time'):
+        aggregates += ['min(_{0}) as {0}_min'.format(d),
+                       'max(_{0}) as {0}_max'.format(d)]
+    return ('regrid(apply({{A}}, _x, x, _y, y, _time, time, '
+            '_sq, double({0}) * {0}), {1}, {2}, {3}, {4})'.format(
+                attr, int(tile_shape[0]), int(tile_shape[1]), int(Nt),
+                ', '.join(a.format(attr) for a in aggregates)))
+
+
+class TileStats(object):
+    """Summary statistics of an HPX pixel store per spatial tile
+
+    Parameters
+    ----------
+    tile_shape : tuple
+        (tile_x, tile_y) size of the tiles
+    summary : ndarray (optional)
+        summary array with dtype :data:`STATS_DTYPE`, one record per tile
+
+    Notes
+    -----
+    :meth:`update` assumes that the new records fill cells which were
+    empty: the counts and sums of a tile are only exact if no cell is
+    written twice.  Use :meth:`replace` to overwrite the summary of tiles
+    which were rewritten.
+    """
+    def __init__(self, tile_shape, summary=None):
+        self.tile_shape = tuple(int(n) for n in tile_shape)
+        if summary is None:
+            summary = np.zeros(0, dtype=STATS_DTYPE)
+        self.summary = np.asarray(summary, dtype=STATS_DTYPE)
+
+    @classmethod
+    def from_records(cls, records, tile_shape):
+        """Summarize a (time, x, y, val) record array"""
+        return cls(tile_shape, records_summary(records, tile_shape))
+
+    @classmethod
+    def from_cube(cls, cube, processes=1):
+        """Summarize a SparseCube, one tile per task
+
+        Parameters
+        ----------
+        cube : SparseCube
+        processes : int (optional)
+            number of worker processes.  If None, the number of cpus; the
+            default (1) works serially.
+        """
+        tasks = [(cube, tile) for tile in cube.tiles]
+        if processes == 1 or len(tasks) <= 1:
+            parts = list(map(cube_tile_summary, tasks))
+        else:
+            pool = Pool(processes)
+            try:
+                parts = pool.map(cube_tile_summary, tasks)
+            finally:
+                pool.close()
+                pool.join()
+
+        summary = np.concatenate([np.zeros(0, dtype=STATS_DTYPE)] + parts)
+        return cls(cube.tile_shape, summary[summary['n'] > 0])
+
+    @classmethod
+    def from_scidb(cls, arr, interface, tile_shape, attr='val'):
+        """Summarize an (x, y, time) SciDB array with a single query"""
+        output = interface.new_array()
+        interface.query("store(" + tile_stats_afl(tile_shape, arr.shape[2],
+                                                  attr) + ", {output})",
+                        A=arr, output=output)
+        try:
+            result = output.tosparse()
+        finally:
+            interface.query("remove({0})", output)
+
+        summary = np.zeros(len(result), dtype=STATS_DTYPE)
+        summary['tile_x'] = result['x']
+        summary['tile_y'] = result['y']
+        for name in STATS_DTYPE.names[2:]:
+            summary[name] = result[name]
+        return cls(tile_shape, summary)
+
+    @classmethod
+    def load(cls, path):
+        """Load a summary written by :meth:`save`"""
+        with np.load(path) as f:
+            return cls(tuple(f['tile_shape']), f['summary'])
+
+    def save(self, path):
+        """Save the summary to an ``.npz`` file"""
+        np.savez(path, tile_shape=self.tile_shape, summary=self.summary)
+
+    def __len__(self):
+        return len(self.summary)
+
+    def __repr__(self):
+        return 'TileStats(tile_shape={0}, n_tiles={1})'.format(
+            self.tile_shape, len(self))
+
+    def _merge(self, summary):
+        both = np.concatenate([self.summary, summary])
+        self.summary = _reduce_tiles(both['tile_x'], both['tile_y'],
+                                     dict((name, both[name])
+                                          for name in COMBINE))
+
+    def update(self, records):
+        """Add newly ingested (time, x, y, val) records to the summary"""
+        self._merge(records_summary(records, self.tile_shape))
+
+    def replace(self, summary):
+        """Overwrite the summary of the tiles present in ``summary``"""
+        summary = np.asarray(summary, dtype=STATS_DTYPE)
+        keep = ~np.isin(self.summary['tile_x'] * 2 ** 32
+                        + self.summary['tile_y'],
+                        summary['tile_x'] * 2 ** 32 + summary['tile_y'])
+        self.summary = self.summary[keep]
+        self._merge(summary[summary['n'] > 0])
+
+    @property
+    def count(self):
+        """Total number of cells"""
+        return int(self.summary['n'].sum())
+
+    def index_bounds(self):
+        """Return [x_min, x_max, y_min, y_max, time_min, time_max]
+
+        This is the output of :func:`spheredb.scidb_tools.find_index_bounds`
+        for all dimensions.
+        """
+        if len(self.summary) == 0:
+            raise ValueError("no data to bound")
+        s = self.summary
+        return np.array([s['x_min'].min(), s['x_max'].max(),
+                         s['y_min'].min(), s['y_max'].max(),
+                         s['time_min'].min(), s['time_max'].max()])
+
+    def mean(self):
+        """Mean value of each tile"""
+        return self.summary['val_sum'] / self.summary['n']
+
+    def variance(self):
+        """Variance of the values of each tile"""
+        mean = self.mean()
+        return self.summary['val_sumsq'] / self.summary['n'] - mean ** 2
+
+    def _tile_map(self, values, shape, dtype):
+        if shape is None:
+            shape = (self.summary['tile_x'].max() + 1,
+                     self.summary['tile_y'].max() + 1)
+        else:
+            shape = tuple(-(-n // t) for (n, t) in zip(shape,
+                                                       self.tile_shape))
+        out = np.zeros(shape, dtype=dtype)
+        out[self.summary['tile_x'], self.summary['tile_y']] = values
+        return out
+
+    def occupancy_map(self, shape=None):
+        """Number of cells in each tile, as an array over the tile grid
+
+        ``shape`` is the (Nx, Ny) size of the pixel grid; by default, the
+        map extends to the last non-empty tile.
+        """
+        return self._tile_map(self.summary['n'], shape, np.int64)
+
+    def coverage_map(self, shape=None):
+        """Boolean map of the tiles holding any data"""
+        return self.occupancy_map(shape) > 0
+
+    def depth_map(self, shape=None):
+        """Mean number of cells (epochs) per pixel area of each tile"""
+        return (self.occupancy_map(shape)
+                / float(np.prod(self.tile_shape)))
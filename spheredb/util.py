@@ -1,9 +1,16 @@
 import numpy as np
 import itertools
+from collections import OrderedDict
 
+from .records import COO_DTYPE
 
-def coo_to_recarray(M):
-    dtype = [('data', np.float), ('i1', np.int), ('i2', np.int)]
+
+def coo_to_recarray(M, dtype=COO_DTYPE):
+    """Convert a coo_matrix to a (data, i1, i2) record array
+
+    ``dtype`` may be :data:`spheredb.records.COMPACT_COO_DTYPE` to store
+    the matrix with int32 indices and float32 values.
+    """
     A = np.empty(len(M.data), dtype=dtype)
     A['data'] = M.data
     A['i1'] = M.row
@@ -12,6 +19,128 @@ def coo_to_recarray(M):
     return A
 
 
+def recarray_to_coo(A, shape):
+    """Inverse of coo_to_recarray"""
+    from scipy import sparse
+    return sparse.coo_matrix((A['data'], (A['i1'], A['i2'])), shape=shape)
+
+
+REDUCTIONS = {'sum': np.add,
+              'min': np.minimum,
+              'max': np.maximum}
+
+
+def reduce_duplicates(index, values, reduction='sum'):
+    """Combine values which share the same index
+
+    Parameters
+    ----------
+    index : array_like
+        integer index of each value (e.g. a linearized pixel index)
+    values : array_like
+        values to combine.  Must be the same length as index.
+    reduction : string or ufunc (optional)
+        how to combine duplicates: one of 'sum', 'min', 'max', 'mean',
+        'first' or 'last', or a numpy ufunc whose ``reduceat`` method is
+        used.  Default is 'sum'.
+
+    Returns
+    -------
+    unique_index : ndarray
+        the sorted unique indices
+    reduced : ndarray
+        the combined value for each unique index
+    """
+    index = np.asarray(index)
+    values = np.asarray(values)
+    if index.shape != values.shape or index.ndim != 1:
+        raise ValueError("index and values must be 1D arrays "
+                         "of the same length")
+
+    # a stable sort keeps 'first' and 'last' meaningful
+    order = np.argsort(index, kind='mergesort')
+    index = index[order]
+    values = values[order]
+
+    if len(index) == 0:
+        return index, values
+
+    start = np.concatenate([[True], index[1:] != index[:-1]])
+    starts = np.nonzero(start)[0]
+    unique_index = index[starts]
+
+    if reduction == 'first':
+        reduced = values[starts]
+    elif reduction == 'last':
+        reduced = values[np.concatenate([starts[1:], [len(index)]]) - 1]
+    elif reduction == 'mean':
+        counts = np.diff(np.concatenate([starts, [len(index)]]))
+        reduced = np.add.reduceat(values, starts) / counts
+    else:
+        ufunc = REDUCTIONS.get(reduction, reduction)
+        if not isinstance(ufunc, np.ufunc):
+            raise ValueError("reduction '{0}' not "
+                             "recognized".format(reduction))
+        reduced = ufunc.reduceat(values, starts)
+
+    return unique_index, reduced
+
+
+def iter_tiles(records, tile_shape, fields=('x', 'y')):
+    """Iterate over the records falling in each tile of a regular grid
+
+    Parameters
+    ----------
+    records : ndarray
+        structured array of records
+    tile_shape : tuple of ints
+        size of the tiles (e.g. the chunk sizes of the storage array) along
+        each of ``fields``
+    fields : tuple of strings
+        the integer index fields on which the grid is defined
+        (default = ('x', 'y'))
+
+    Yields
+    ------
+    tile, block : tuple, ndarray
+        the tile index (``records[field] // size`` for each field) and the
+        contiguous block of records falling in that tile.  Tiles are
+        visited in lexicographic order, and the records within each block
+        are sorted by ``fields``.
+    """
+    records = np.asarray(records)
+    fields = tuple(fields)
+    tile_shape = np.zeros(len(fields), dtype=int) + np.asarray(tile_shape)
+    if np.any(tile_shape <= 0):
+        raise ValueError("tile_shape must be positive")
+
+    if len(records) == 0:
+        return
+
+    tiles = [records[f] // size for (f, size) in zip(fields, tile_shape)]
+
+    # np.lexsort sorts by the last key first
+    order = np.lexsort([records[f] for f in fields[::-1]] + tiles[::-1])
+    records = records[order]
+    tiles = np.vstack([t[order] for t in tiles]).T
+
+    new_tile = np.concatenate([[True],
+                               np.any(tiles[1:] != tiles[:-1], 1)])
+    starts = np.nonzero(new_tile)[0]
+    ends = np.concatenate([starts[1:], [len(records)]])
+    for start, end in zip(starts, ends):
+        yield tuple(int(t) for t in tiles[start]), records[start:end]
+
+
+def partition_records(records, tile_shape, fields=('x', 'y')):
+    """Partition records by a regular grid of tiles
+
+    Returns an OrderedDict mapping tile index to a sorted block of records;
+    see :func:`iter_tiles` for the parameters.
+    """
+    return OrderedDict(iter_tiles(records, tile_shape, fields))
+
+
 def regrid(X, D, agg=np.sum):
     """Regrid an N-dimensional matrix using numpy aggregates
 
@@ -44,7 +173,7 @@ def regrid(X, D, agg=np.sum):
     input_shape = D * (N // D)
 
     # Truncate the edges of X
-    X = X[[slice(None, s) for s in input_shape]]
+    X = X[tuple(slice(None, s) for s in input_shape)]
 
     # Reshape and sum over appropriate dimensions
     X = X.reshape(sum(zip(final_shape, D), ()))
@@ -95,4 +224,4 @@ if __name__ == '__main__':
     V1 = regrid(X, (4, 6, 5))
     V2 = regrid2(X, (4, 6, 5))
 
-    print np.all(V1 == V2)
+    print(np.all(V1 == V2))
@@ -0,0 +1,181 @@
+"""
+Persistent on-disk cache of warped HPX pixels
+
+Warping is by far the most expensive step of ingest.  WarpCache stores the
+warped (sparse) output of a file on disk, keyed by the content of the input
+plus the warp parameters, so that re-ingesting the same exposures only
+costs a read of the cached records.
+"""
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+
+from .records import COO_DTYPE, COMPACT_COO_DTYPE
+from .util import coo_to_recarray, recarray_to_coo
+
+__all__ = ['WarpCache']
+
+
+class WarpCache(object):
+    """Content-addressed, size-bounded cache of warped records
+
+    Parameters
+    ----------
+    cache_dir : str
+        directory in which to store the records.  It is created if needed.
+    max_bytes : int (optional)
+        maximum total size of the cache files.  When exceeded, the least
+        recently used entries are evicted.  Default is 10GB.
+    compact : bool (optional)
+        if True, sparse matrices are stored with int32 indices and float32
+        values, halving the size of the entries.  Compact entries have
+        distinct keys from full-precision ones.  Default is False.
+
+    Notes
+    -----
+    Each entry is a single ``.npy`` file holding a structured record array.
+    Recency of use is tracked through the file modification time, which is
+    updated on every hit.
+    """
+    suffix = '.npy'
+
+    def __init__(self, cache_dir, max_bytes=10 * 2 ** 30, compact=False):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_bytes = max_bytes
+        self.compact = compact
+        self.hits = 0
+        self.misses = 0
+        self._checksums = {}
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    @staticmethod
+    def _digest(*items):
+        h = hashlib.sha1()
+        for item in items:
+            h.update(repr(item).encode('utf-8'))
+        return h.hexdigest()
+
+    def file_checksum(self, filename, blocksize=2 ** 20):
+        """Return the SHA1 checksum of the contents of a file
+
+        Checksums are memoized per (path, size, mtime) for the life of the
+        cache object.
+        """
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        memo_key = (filename, stat.st_size, stat.st_mtime)
+
+        if memo_key not in self._checksums:
+            h = hashlib.sha1()
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(blocksize), b''):
+                    h.update(block)
+            self._checksums[memo_key] = h.hexdigest()
+
+        return self._checksums[memo_key]
+
+    def _params(self, params):
+        if self.compact:
+            params = dict(params, compact=True)
+        return sorted(params.items())
+
+    def file_key(self, filename, **params):
+        """Cache key for a file warped with the given parameters"""
+        return self._digest(self.file_checksum(filename),
+                            self._params(params))
+
+    def array_key(self, header, data, **params):
+        """Cache key for an in-memory (header, data) pair"""
+        data = np.ascontiguousarray(data)
+        h = hashlib.sha1()
+        h.update(data.view(np.uint8).ravel())
+        cards = sorted((str(key), repr(header[key]))
+                       for key in header.keys())
+        return self._digest(h.hexdigest(), data.shape, data.dtype.str,
+                            cards, self._params(params))
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def get(self, key):
+        """Return the cached records for key, or None if not present"""
+        path = self._path(key)
+        try:
+            records = np.load(path)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return records
+
+    def put(self, key, records):
+        """Store a record array under key, evicting old entries if needed"""
+        fd, tmpfile = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.asarray(records))
+            os.rename(tmpfile, self._path(key))
+        except:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            raise
+        self.evict()
+
+    def get_sparse(self, key, shape):
+        """Return a cached coo_matrix of the given shape, or None"""
+        records = self.get(key)
+        if records is None:
+            return None
+        return recarray_to_coo(records, shape)
+
+    def put_sparse(self, key, M):
+        """Store a sparse matrix under key"""
+        dtype = COMPACT_COO_DTYPE if self.compact else COO_DTYPE
+        self.put(key, coo_to_recarray(M.tocoo(), dtype))
+
+    def entries(self):
+        """Return a list of (mtime, size, path) for all entries, oldest first"""
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith(self.suffix):
+                continue
+            path = os.path.join(self.cache_dir, fname)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def size(self):
+        """Total size in bytes of the cached records"""
+        return sum(size for (mtime, size, path) in self.entries())
+
+    def evict(self, max_bytes=None):
+        """Remove least recently used entries until under max_bytes"""
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+
+        entries = self.entries()
+        total = sum(size for (mtime, size, path) in entries)
+        for mtime, size, path in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        """Remove all entries from the cache"""
+        self.evict(0)
@@ -9,12 +9,11 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 from spheredb.get_data import\
-    get_stripe82_file, all_lsst_exposures, get_LSST_file
+    get_stripe82_file, lsst_exposure_catalog, get_LSST_file
 from spheredb.conversions import FITS_to_HPX, HPX_grid_step
 from spheredb.util import regrid
 
 import os
-import pyfits
 
 import re
 import datetime
@@ -30,7 +29,7 @@ if 1:
     output = FITS_to_HPX(hdulist[1].header, hdulist[1].data, Nside,
                          return_sparse=True)
 
-    print output.shape
+    print(output.shape)
 
     RA_range = (output.row.min(), output.row.max())
     DEC_range = (output.col.min(), output.col.max())
@@ -50,10 +49,8 @@ if 1:
     plt.show()
 
 elif 1:
-    times = [hdulist[1].header['TAI'] for hdulist in all_lsst_exposures()]
-    times = np.asarray(times)
-    times.sort()
-    print times.min()
-    print times.max()
+    times = lsst_exposure_catalog().query()['tai']
+    print(times.min())
+    print(times.max())
     plt.plot(24 * (times - 50095), '.k')
     plt.show()